@@ -0,0 +1,56 @@
+"""
+Microbenchmark of the overhead of encoding the run endpoint's responses.
+
+Run it from the repository root:
+
+    python -m benchmarks.response_encoding
+
+For each way of creating the response for a successful run, the time per response
+is output in microseconds.
+"""
+
+import timeit
+import uuid
+from typing import Callable, Dict
+
+import click
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+
+from remote_command_server import responses, schemas
+
+
+def _pydantic_and_json(key: str) -> Response:
+    # what FastAPI does for a return value with a response model
+    model = schemas.RunSuccess(success=True, run=key)
+    return JSONResponse(jsonable_encoder(model))
+
+
+def _orjson(key: str) -> Response:
+    return ORJSONResponse({"success": True, "run": key})
+
+
+def _static(key: str) -> Response:
+    return responses.run_succeeded(key)
+
+
+BENCHMARKS: Dict[str, Callable[[str], Response]] = {
+    "pydantic + json": _pydantic_and_json,
+    "orjson": _orjson,
+    "static body": _static,
+}
+
+
+@click.command()
+@click.option("--number", default=100000, help="Number of responses per run.")
+@click.option("--repeat", default=5, help="Number of runs; the fastest is used.")
+def main(number: int, repeat: int) -> None:
+    key = uuid.uuid4().hex
+    for name, create_response in BENCHMARKS.items():
+        timer = timeit.Timer(lambda: create_response(key))
+        best = min(timer.repeat(repeat=repeat, number=number))
+        click.echo(f"{name:<20}{1e6 * best / number:8.2f} µs per response")
+
+
+if __name__ == "__main__":
+    main()
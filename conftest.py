@@ -6,6 +6,20 @@ import pytest
 from sqlalchemy.orm import Session
 
 from remote_command_server.database import Base, database_connection
+from remote_command_server.settings import get_settings
+
+
+@pytest.fixture(autouse=True)
+def clear_settings_cache() -> Generator[None, None, None]:
+    """
+    Fixture for clearing the cached settings before and after every test.
+
+    Tests can thus change settings by setting environment variables with monkeypatch.
+    """
+
+    get_settings.cache_clear()
+    yield
+    get_settings.cache_clear()
 
 
 @pytest.fixture()
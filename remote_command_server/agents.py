@@ -0,0 +1,410 @@
+"""Execution of runs on remote agents."""
+
+import asyncio
+import base64
+import dataclasses
+import json
+import logging
+import signal
+import socket
+import threading
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Set,
+    cast,
+)
+
+from remote_command_server import schemas, util
+from remote_command_server.resources import ResourceLimits, ResourceUsage
+from remote_command_server.spawn import ExecutionProfile, SpawnSpecCache
+
+logger = logging.getLogger(__name__)
+
+Message = Dict[str, Any]
+
+
+class AgentError(Exception):
+    """Raised if a run cannot be executed on an agent."""
+
+    pass
+
+
+class NoAgentAvailable(AgentError):
+    """Raised if there is no connected agent with a requested label."""
+
+    pass
+
+
+class AgentDisconnected(AgentError):
+    """Raised if an agent disconnects while it is executing a run."""
+
+    pass
+
+
+@dataclasses.dataclass(eq=False)
+class Agent:
+    """
+    An agent connected to the server.
+
+    The send function sends a message to the agent. The number of runs the agent is
+    executing is tracked, so that runs can be dispatched to the least loaded agent.
+    """
+
+    name: str
+    labels: FrozenSet[str]
+    capacity: int
+    send: Callable[[Message], Awaitable[None]]
+    active: int = 0
+
+    @property
+    def load(self) -> float:
+        """The number of active runs relative to the capacity."""
+
+        return self.active / self.capacity
+
+
+@dataclasses.dataclass(eq=False)
+class _RemoteRun:
+    agent: Agent
+    on_output: Optional[util.OutputCallback]
+    result: "asyncio.Future[util.CommandResult]"
+
+
+class AgentPool:
+    """
+    The agents connected to the server, and the runs they are executing.
+
+    A run is dispatched to the least loaded agent with the requested label. The agent
+    streams the run's output back while the command is running, and finally sends its
+    exit code and resource usage. All methods must be called in the event loop.
+    """
+
+    def __init__(self) -> None:
+        self._agents: List[Agent] = []
+        self._runs: Dict[str, _RemoteRun] = {}
+        self._tasks: Set["asyncio.Future[None]"] = set()
+
+    def register(self, agent: Agent) -> None:
+        """Add a connected agent."""
+
+        self._agents.append(agent)
+        logger.info("Agent %s connected with labels %s", agent.name, agent.labels)
+
+    def unregister(self, agent: Agent) -> None:
+        """Remove an agent, failing all runs it is executing."""
+
+        self._agents.remove(agent)
+        for key, run in list(self._runs.items()):
+            if run.agent is agent and not run.result.done():
+                run.result.set_exception(
+                    AgentDisconnected(f"Agent {agent.name} has disconnected")
+                )
+        logger.info("Agent %s disconnected", agent.name)
+
+    def agents(self) -> List[Agent]:
+        """Return the connected agents."""
+
+        return list(self._agents)
+
+    def select(self, label: str) -> Agent:
+        """
+        Select the least loaded agent with a label.
+
+        A NoAgentAvailable error is raised if there is no agent with the label.
+        """
+
+        candidates = [agent for agent in self._agents if label in agent.labels]
+        if not candidates:
+            raise NoAgentAvailable(f"No agent with the label {label} is connected")
+        return min(candidates, key=lambda agent: agent.load)
+
+    async def run(
+        self,
+        label: str,
+        key: str,
+        project_id: int,
+        command: str,
+        profile: ExecutionProfile,
+        on_output: Optional[util.OutputCallback] = None,
+    ) -> util.CommandResult:
+        """
+        Run a command on the least loaded agent with a label.
+
+        The on_output callback is called for every chunk of output received from the
+        agent. An AgentError is raised if there is no agent with the label, or if the
+        agent disconnects before the command has finished. A ValueError is raised if
+        the agent cannot run the command, for example because the directory does not
+        exist.
+        """
+
+        agent = self.select(label)
+        remote_run = _RemoteRun(
+            agent=agent,
+            on_output=on_output,
+            result=asyncio.get_event_loop().create_future(),
+        )
+        self._runs[key] = remote_run
+        agent.active += 1
+        try:
+            await agent.send(
+                {
+                    "type": "run",
+                    "key": key,
+                    "project_id": project_id,
+                    "command": command,
+                    "profile": profile_to_message(profile),
+                }
+            )
+            return await remote_run.result
+        finally:
+            agent.active -= 1
+            del self._runs[key]
+
+    def interrupt(self, key: str, sig: int) -> bool:
+        """
+        Ask the agent executing a run to send a signal to the run's command.
+
+        False is returned if no agent is executing the run.
+        """
+
+        remote_run = self._runs.get(key)
+        if remote_run is None:
+            return False
+        message = {"type": "interrupt", "key": key, "signal": int(sig)}
+        task = asyncio.ensure_future(remote_run.agent.send(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def handle_message(self, agent: Agent, message: Any) -> None:
+        """
+        Handle a message received from an agent.
+
+        A ValueError is raised if the message is malformed.
+        """
+
+        if not isinstance(message, dict):
+            raise ValueError("A message must be an object")
+        if message.get("type") == "output":
+            output = schemas.AgentOutput.parse_obj(message)
+            data = base64.b64decode(output.data, validate=True)
+            remote_run = self._run_of(agent, output.key)
+            if remote_run is not None and remote_run.on_output is not None:
+                remote_run.on_output(output.stream, data)
+        elif message.get("type") == "exit":
+            exit_message = schemas.AgentExit.parse_obj(message)
+            if exit_message.error is None and exit_message.returncode is None:
+                raise ValueError("An exit message requires a return code or an error")
+            remote_run = self._run_of(agent, exit_message.key)
+            if remote_run is None or remote_run.result.done():
+                return
+            if exit_message.error:
+                remote_run.result.set_exception(ValueError(exit_message.error))
+                return
+            usage = exit_message.usage
+            remote_run.result.set_result(
+                util.CommandResult(
+                    exit_message.command,
+                    cast(int, exit_message.returncode),
+                    None,
+                    None,
+                    ResourceUsage(**usage.dict()) if usage else None,
+                )
+            )
+        else:
+            raise ValueError(f"Unknown message type: {message.get('type')}")
+
+    def _run_of(self, agent: Agent, key: str) -> Optional[_RemoteRun]:
+        # runs which have finished or belong to another agent are ignored
+        remote_run = self._runs.get(key)
+        if remote_run is None or remote_run.agent is not agent:
+            return None
+        return remote_run
+
+
+# the agents connected to this server
+agent_pool = AgentPool()
+
+
+def profile_to_message(profile: ExecutionProfile) -> Message:
+    """Convert an execution profile into a JSON-serializable dictionary."""
+
+    return dataclasses.asdict(profile)
+
+
+def profile_from_message(message: Message) -> ExecutionProfile:
+    """Convert a dictionary created by profile_to_message into a profile."""
+
+    environment = message["environment"]
+    return ExecutionProfile(
+        directory=message["directory"],
+        environment=(
+            tuple((name, value) for name, value in environment)
+            if environment is not None
+            else None
+        ),
+        path=message["path"],
+        umask=message["umask"],
+        limits=ResourceLimits(**message["limits"]),
+    )
+
+
+class AgentWorker:
+    """
+    The worker of an agent process, which executes the runs sent by the server.
+
+    Up to capacity commands are run at the same time, each in a thread of the
+    default executor. Their output is sent to the server as it arrives.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], capacity: int) -> None:
+        self.send = send
+        self.capacity = capacity
+        self.spawn_specs = SpawnSpecCache()
+        # the pids of running commands; a pid is removed (under the lock) before its
+        # process is reaped, so that it is never signalled after it could be reused
+        self._pids: Dict[str, int] = {}
+        self._pids_lock = threading.Lock()
+        self._tasks: Set["asyncio.Future[None]"] = set()
+        self._semaphore = asyncio.Semaphore(capacity)
+        self._outgoing: "asyncio.Queue[Message]" = asyncio.Queue()
+
+    async def serve(self, messages: Any) -> None:
+        """
+        Execute the runs requested by the server.
+
+        The messages are an async iterable of the raw messages received from the
+        server. Runs still in progress when the server connection is closed are
+        killed.
+        """
+
+        sender = asyncio.ensure_future(self._send_messages())
+        try:
+            async for raw_message in messages:
+                message = json.loads(raw_message)
+                if message["type"] == "run":
+                    task = asyncio.ensure_future(self._execute(message))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                elif message["type"] == "interrupt":
+                    with self._pids_lock:
+                        pid = self._pids.get(message["key"])
+                        if pid is not None:
+                            util.kill_process_group(pid, message["signal"])
+        finally:
+            with self._pids_lock:
+                for pid in self._pids.values():
+                    util.kill_process_group(pid, signal.SIGKILL)
+            for running in list(self._tasks):
+                running.cancel()
+            sender.cancel()
+
+    async def _send_messages(self) -> None:
+        while True:
+            message = await self._outgoing.get()
+            await self.send(json.dumps(message))
+
+    async def _execute(self, message: Message) -> None:
+        loop = asyncio.get_event_loop()
+        key = message["key"]
+
+        def on_start(pid: int) -> None:
+            with self._pids_lock:
+                self._pids[key] = pid
+
+        def on_exit() -> None:
+            with self._pids_lock:
+                self._pids.pop(key, None)
+
+        def on_output(stream: str, data: bytes) -> None:
+            output = {
+                "type": "output",
+                "key": key,
+                "stream": stream,
+                "data": base64.b64encode(data).decode("ascii"),
+            }
+            loop.call_soon_threadsafe(self._outgoing.put_nowait, output)
+
+        def run() -> util.CommandResult:
+            spec = self.spawn_specs.get(
+                message["project_id"], profile_from_message(message["profile"])
+            )
+            return util.run_command(
+                directory=spec.directory,
+                command=message["command"],
+                spec=spec,
+                on_output=on_output,
+                capture_output=False,
+                on_start=on_start,
+                on_exit=on_exit,
+            )
+
+        exit_message: Message = {
+            "type": "exit",
+            "key": key,
+            "command": message["command"],
+        }
+        async with self._semaphore:
+            try:
+                result = await loop.run_in_executor(None, run)
+                exit_message["returncode"] = result.returncode
+                exit_message["usage"] = (
+                    dataclasses.asdict(result.usage) if result.usage else None
+                )
+            except Exception as e:
+                logger.exception("Could not run the command for run %s", key)
+                exit_message["error"] = str(e)
+            finally:
+                on_exit()
+        self._outgoing.put_nowait(exit_message)
+
+
+async def run_agent(
+    url: str,
+    token: str,
+    labels: List[str],
+    capacity: int,
+    name: Optional[str] = None,
+    reconnect_delay: float = 5,
+) -> None:
+    """
+    Connect to a server as an agent and execute the runs it sends.
+
+    If the connection fails or is lost, the agent reconnects after reconnect_delay
+    seconds.
+    """
+
+    try:
+        # the new asyncio implementation of websockets 13 and later
+        from websockets.asyncio.client import connect
+
+        headers_argument = "additional_headers"
+    except ImportError:  # pragma: no cover
+        from websockets import connect
+
+        headers_argument = "extra_headers"
+
+    hello = {
+        "type": "hello",
+        "name": name or socket.gethostname(),
+        "labels": labels,
+        "capacity": capacity,
+    }
+    while True:
+        try:
+            headers: Dict[str, Any] = {
+                headers_argument: {"Authorization": f"Bearer {token}"}
+            }
+            async with connect(url, **headers) as websocket:
+                logger.info("Connected to %s", url)
+                await websocket.send(json.dumps(hello))
+                await AgentWorker(websocket.send, capacity).serve(websocket)
+        except Exception:
+            logger.warning("Lost the connection to %s", url, exc_info=True)
+        await asyncio.sleep(reconnect_delay)
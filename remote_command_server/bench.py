@@ -0,0 +1,471 @@
+"""Load generation for benchmarks and soak tests of the server."""
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import math
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Counter, Dict, Iterator, List, Optional, Tuple
+
+import uvicorn
+
+from remote_command_server import crud, executor, main, schemas, util
+from remote_command_server.database import Base, database_connection
+from remote_command_server.settings import get_settings
+
+
+class LatencyHistogram:
+    """
+    Latencies in logarithmic buckets.
+
+    Percentiles have a relative error of at most 2%, and the memory needed does not
+    grow with the number of latencies, so that long soak runs don't distort the
+    memory usage they measure.
+    """
+
+    _BASE = 1.02
+    _MIN = 1e-6
+
+    def __init__(self) -> None:
+        self.counts: Counter[int] = collections.Counter()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, latency: float) -> None:
+        """Add a latency, in seconds."""
+
+        bucket = math.ceil(math.log(max(latency, self._MIN) / self._MIN, self._BASE))
+        self.counts[bucket] += 1
+        self.count += 1
+        self.max = max(self.max, latency)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Add the latencies of another histogram."""
+
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """Return a percentile of the latencies, or 0 if there are none."""
+
+        rank = math.ceil(percent / 100 * self.count)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._MIN * self._BASE**bucket, self.max)
+        return self.max
+
+
+class FakeCommand:
+    """
+    Replacement for util.run_command, which doesn't run any command.
+
+    Every run takes latency seconds and writes output_size bytes of output, in chunks
+    as a real command would. The exit code is always 0. No process is started, so that
+    the server's own overhead can be measured.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, latency: float, output_size: int) -> None:
+        self.latency = latency
+        self.output_size = output_size
+        self._chunk = b"x" * min(output_size, self.CHUNK_SIZE)
+
+    def __call__(
+        self,
+        directory: pathlib.Path,
+        command: str,
+        on_output: Optional[util.OutputCallback] = None,
+        **kwargs: object,
+    ) -> util.CommandResult:
+        if self.latency:
+            time.sleep(self.latency)
+        remaining = self.output_size
+        while remaining > 0 and on_output is not None:
+            chunk = self._chunk[:remaining]
+            on_output("stdout", chunk)
+            remaining -= len(chunk)
+        return util.CommandResult(command, 0, None, None, None)
+
+
+@contextlib.contextmanager
+def fake_executor(latency: float, output_size: int) -> Iterator[FakeCommand]:
+    """Run commands with a FakeCommand rather than util.run_command."""
+
+    original = util.run_command
+    fake = FakeCommand(latency, output_size)
+    util.run_command = fake  # type: ignore
+    try:
+        yield fake
+    finally:
+        util.run_command = original
+
+
+def provision(
+    database: pathlib.Path, directory: pathlib.Path, projects: int, command: str
+) -> List[Tuple[str, str]]:
+    """
+    Create a database with projects and a token for each of them.
+
+    The projects run the command in the directory. The project names and tokens are
+    returned.
+    """
+
+    connection = database_connection(f"sqlite:///{database}")
+    Base.metadata.create_all(bind=connection.engine)
+    db = connection.LocalSession()
+    try:
+        credentials = []
+        for i in range(projects):
+            name = f"bench-{i}"
+            crud.create_project(
+                db,
+                schemas.ProjectCreate(
+                    name=name, directory=str(directory), command=command
+                ),
+            )
+            credentials.append((name, crud.create_token(db, name)))
+        return credentials
+    finally:
+        db.close()
+
+
+@dataclasses.dataclass
+class Sample:
+    """The requests made during a report interval, and the server's resources."""
+
+    elapsed: float
+    latencies: LatencyHistogram
+    statuses: Counter[int]
+    errors: int
+    rss: Optional[int]
+    open_files: Optional[int]
+
+    @property
+    def requests(self) -> int:
+        return self.latencies.count
+
+
+@dataclasses.dataclass
+class Report:
+    """The result of a benchmark."""
+
+    duration: float
+    latencies: LatencyHistogram
+    statuses: Counter[int]
+    errors: int
+    samples: List[Sample]
+
+    @property
+    def requests(self) -> int:
+        return self.latencies.count
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.duration if self.duration else 0
+
+    def growth(self, field: str) -> Optional[int]:
+        """
+        Return the growth of a resource (rss or open_files) over the run.
+
+        The growth is measured from the end of the first interval, so that the
+        resources allocated while warming up are not counted.
+        """
+
+        values = [getattr(sample, field) for sample in self.samples]
+        if len(values) < 2 or values[0] is None or values[-1] is None:
+            return None
+        return int(values[-1] - values[0])
+
+
+def rss() -> Optional[int]:
+    """Return the resident memory of this process in bytes, if it is known."""
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def open_files() -> Optional[int]:
+    """Return the number of file descriptors open in this process, if it is known."""
+
+    for fd_directory in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(fd_directory))
+        except OSError:
+            pass
+    return None
+
+
+class _Connection:
+    """A keep-alive HTTP/1.1 connection to the server, for POST requests only."""
+
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self._streams: Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = (
+            None
+        )
+
+    async def post(self, path: str, token: str) -> int:
+        """Make a request and return the response status."""
+
+        if self._streams is None:
+            self._streams = await asyncio.open_connection("127.0.0.1", self.port)
+        reader, writer = self._streams
+        writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+            f"Authorization: Bearer {token}\r\nContent-Length: 0\r\n\r\n".encode()
+        )
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("The server has closed the connection")
+        content_length = 0
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                content_length = int(value)
+            elif name.lower() == "connection" and value.strip().lower() == "close":
+                keep_alive = False
+        await reader.readexactly(content_length)
+        if not keep_alive:
+            self.close()
+        return int(status_line.split()[1])
+
+    def close(self) -> None:
+        if self._streams is not None:
+            self._streams[1].close()
+            self._streams = None
+
+
+class LoadGenerator:
+    """
+    Concurrent clients making run requests for projects in turn.
+
+    The requests are made until the duration has passed or the given number of
+    requests has been made. Every report_interval seconds a Sample is passed to the
+    report function.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        credentials: List[Tuple[str, str]],
+        concurrency: int,
+        duration: float,
+        requests: Optional[int] = None,
+        report_interval: float = 5,
+        report: Callable[[Sample], None] = lambda sample: None,
+    ) -> None:
+        self.port = port
+        self.credentials = credentials
+        self.concurrency = concurrency
+        self.duration = duration
+        self.max_requests = requests
+        self.report_interval = report_interval
+        self.report = report
+        self._made = 0
+        self._interval = LatencyHistogram()
+        self._statuses: Counter[int] = collections.Counter()
+        self._errors = 0
+
+    async def run(self) -> Report:
+        """Generate the load and return the report."""
+
+        start = time.monotonic()
+        deadline = start + self.duration
+        total = LatencyHistogram()
+        statuses: Counter[int] = collections.Counter()
+        errors = 0
+        samples: List[Sample] = []
+
+        def take_sample() -> None:
+            nonlocal errors
+            sample = Sample(
+                elapsed=time.monotonic() - start,
+                latencies=self._interval,
+                statuses=self._statuses,
+                errors=self._errors,
+                rss=rss(),
+                open_files=open_files(),
+            )
+            total.merge(sample.latencies)
+            statuses.update(sample.statuses)
+            errors += sample.errors
+            self._interval = LatencyHistogram()
+            self._statuses = collections.Counter()
+            self._errors = 0
+            samples.append(sample)
+            self.report(sample)
+
+        # the connections are only closed after the last sample has been taken, so
+        # that they don't affect the number of open files
+        connections = [_Connection(self.port) for _ in range(self.concurrency)]
+        clients = [
+            asyncio.ensure_future(self._client(i, connection, deadline))
+            for i, connection in enumerate(connections)
+        ]
+        done = asyncio.ensure_future(asyncio.gather(*clients))
+        try:
+            while not done.done():
+                await asyncio.wait([done], timeout=self.report_interval)
+                take_sample()
+            await done
+        finally:
+            for client in clients:
+                client.cancel()
+            for connection in connections:
+                connection.close()
+        return Report(
+            duration=time.monotonic() - start,
+            latencies=total,
+            statuses=statuses,
+            errors=errors,
+            samples=samples,
+        )
+
+    async def _client(
+        self, index: int, connection: _Connection, deadline: float
+    ) -> None:
+        request = index
+        while time.monotonic() < deadline and (
+            self.max_requests is None or self._made < self.max_requests
+        ):
+            self._made += 1
+            name, token = self.credentials[request % len(self.credentials)]
+            request += self.concurrency
+            started = time.monotonic()
+            try:
+                status = await connection.post(f"/run/{name}", token)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                connection.close()
+                self._errors += 1
+                continue
+            self._interval.add(time.monotonic() - started)
+            self._statuses[status] += 1
+
+
+@contextlib.contextmanager
+def _restored_app_state() -> Iterator[None]:
+    # the server's startup handlers store their objects in the app's state and in the
+    # executor, which are restored, so that the app is left as it was
+    state = dict(main.app.state._state)
+    run_queue = executor.run_queue
+    try:
+        yield
+    finally:
+        main.app.state._state.clear()
+        main.app.state._state.update(state)
+        executor.run_queue = run_queue
+
+
+@contextlib.contextmanager
+def _environment(variables: Dict[str, str]) -> Iterator[None]:
+    # the server reads its database URL and settings from the environment
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    get_settings.cache_clear()
+    main.get_database_connection.cache_clear()
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+        get_settings.cache_clear()
+        main.get_database_connection.cache_clear()
+
+
+def run(
+    projects: int,
+    concurrency: int,
+    duration: float,
+    requests: Optional[int] = None,
+    latency: float = 0.01,
+    output_size: int = 1024,
+    command: Optional[str] = None,
+    report_interval: float = 5,
+    report: Callable[[Sample], None] = lambda sample: None,
+) -> Report:
+    """
+    Benchmark the server.
+
+    A temporary database with projects and tokens is created, and the server is
+    started on a free local port, in this process. Unless a command is given, the
+    projects' commands are run by a FakeCommand with the given latency and output
+    size. The load is generated in a thread of its own, so that the server's event
+    loop is not shared with the clients.
+
+    The event log is disabled unless it is configured in the environment, and the
+    other settings are taken from the environment as usual.
+    """
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = pathlib.Path(temporary_directory)
+        database = directory / "bench.sqlite3"
+        credentials = provision(database, directory, projects, command or "true")
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        server = uvicorn.Server(
+            uvicorn.Config(main.app, log_level="warning", access_log=False)
+        )
+        generator = LoadGenerator(
+            port,
+            credentials,
+            concurrency=concurrency,
+            duration=duration,
+            requests=requests,
+            report_interval=report_interval,
+            report=report,
+        )
+        result: List[Report] = []
+        stopped = threading.Event()
+
+        def generate_load() -> None:
+            try:
+                while not server.started:
+                    if stopped.wait(0.01):
+                        return
+                result.append(asyncio.run(generator.run()))
+            finally:
+                server.should_exit = True
+
+        variables = {
+            "SQL_ALCHEMY_DATABASE_URL": f"sqlite:///{database}",
+            "RCS_EVENT_LOG": os.environ.get("RCS_EVENT_LOG", ""),
+        }
+        with _environment(
+            variables
+        ), _restored_app_state(), contextlib.ExitStack() as stack:
+            if command is None:
+                stack.enter_context(fake_executor(latency, output_size))
+            thread = threading.Thread(target=generate_load, daemon=True)
+            thread.start()
+            try:
+                asyncio.run(server.serve(sockets=[sock]))
+            finally:
+                stopped.set()
+                thread.join()
+                sock.close()
+        if not result:
+            raise RuntimeError("The server could not be started")
+        return result[0]
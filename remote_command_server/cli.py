@@ -1,13 +1,24 @@
 """Command line interface for generating projects and tokens in the database."""
 
+import asyncio
+import logging
 import os
+import pathlib
+import secrets
+from typing import Any, Dict, List, Optional, Tuple
 
 import click
 
+from remote_command_server import agents
+from remote_command_server import bench as _bench
 from remote_command_server import crud
 from remote_command_server import database as _database
-from remote_command_server import schemas
+from remote_command_server import migrations, schemas, snapshots
+from remote_command_server import workspaces as _workspaces
+from remote_command_server.cron import CronSchedule
 from remote_command_server.database import Base
+from remote_command_server.filters import OutputPolicy
+from remote_command_server.processors import ProcessorSpec
 
 
 @click.group()
@@ -41,16 +52,287 @@ def cli() -> None:
     "A tilde prefix is not resolved.",
 )
 @click.option("--name", "-n", type=str, required=True, help="Project name.")
-def project(command: str, database: str, directory: str, name: str) -> None:
+@click.option(
+    "--debounce",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="Debounce window in seconds. If given, a burst of run requests results in a "
+    "single run, which starts once there has been no request for this time.",
+)
+@click.option(
+    "--share-window",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="Share runs between identical requests. If given, a request made while the "
+    "command is running waits for the run in progress and gets its result rather "
+    "than starting another run. The result is also returned for requests made up to "
+    "this many seconds after the run has finished; use 0 to share only runs in "
+    "progress.",
+)
+@click.option(
+    "--priority",
+    type=click.IntRange(min=-5, max=5),
+    default=None,
+    help="Priority of the project's runs, from -5 to 5. If runs have to wait for a "
+    "free slot, a project gets twice as many slots as a project whose priority is "
+    "lower by one. The default is 0.",
+)
+@click.option(
+    "--workspaces",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of workspaces for running the command in parallel. If given, every "
+    "run gets a copy of the directory of its own, which is reset to the state of the "
+    "directory before the run.",
+)
+@click.option(
+    "--workspace-method",
+    type=click.Choice(_workspaces.METHODS),
+    default=None,
+    help="How workspaces are created: as copies of the directory (using reflinks where "
+    "the file system supports them), as copies of the directory tree with hard links "
+    "to the files, or as git worktrees of the current commit. By default, git "
+    "worktrees are used for git repositories and copies otherwise.",
+)
+@click.option(
+    "--env",
+    "-e",
+    type=str,
+    multiple=True,
+    help="Environment variable for the command, in the form NAME=VALUE. This option "
+    "may be used multiple times. If it is used, the command does not inherit the "
+    "server's environment.",
+)
+@click.option(
+    "--path",
+    type=str,
+    default=None,
+    help="Value of the PATH environment variable for the command.",
+)
+@click.option(
+    "--umask",
+    type=str,
+    default=None,
+    help="Umask for the command, as an octal number such as 022.",
+)
+@click.option(
+    "--cpu-time",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum CPU time for the command, in seconds.",
+)
+@click.option(
+    "--memory",
+    type=str,
+    default=None,
+    help="Maximum memory (address space) for the command, in bytes. The suffixes K, "
+    "M and G may be used, as in 512M.",
+)
+@click.option(
+    "--open-files",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum number of open files for the command.",
+)
+@click.option(
+    "--schedule",
+    type=str,
+    default=None,
+    help="Cron expression for running the command regularly, such as "
+    '"*/15 * * * *" or "@daily". Times are in UTC.',
+)
+@click.option(
+    "--agent-label",
+    type=str,
+    default=None,
+    help="Label of the agents which should run the command. If this is given, the "
+    "command is run on the least loaded agent with this label rather than on the "
+    "server.",
+)
+@click.option(
+    "--extract",
+    type=str,
+    multiple=True,
+    help="Extract a field from the command's output, given as NAME=PATTERN. The last "
+    "match of the regular expression in a line of output is returned under the name "
+    "in the run response. This option may be used multiple times.",
+)
+@click.option(
+    "--junit",
+    is_flag=True,
+    help="Return the numbers of tests, failures, errors and skipped tests in JUnit XML "
+    "output in the run response.",
+)
+@click.option(
+    "--json-summary",
+    is_flag=True,
+    help="Return the last line of output which is a JSON object in the run response.",
+)
+@click.option(
+    "--tail",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Return the last lines of output in the run response.",
+)
+@click.option(
+    "--output-max-bytes",
+    type=str,
+    default=None,
+    help="Maximum size of the stored output of a run, in bytes. The suffixes K, M "
+    "and G may be used. Longer output is truncated in the middle, keeping its head "
+    "and its tail.",
+)
+@click.option(
+    "--output-head-bytes",
+    type=str,
+    default=None,
+    help="Size of the head kept of truncated output, in bytes. By default, half of "
+    "the maximum size is kept from the head and half from the tail.",
+)
+@click.option(
+    "--strip-ansi",
+    is_flag=True,
+    help="Remove ANSI escape sequences (such as colors) from the command's output.",
+)
+@click.option(
+    "--depends-on",
+    type=str,
+    multiple=True,
+    help="Name of a project which must be run successfully before this project in a "
+    "pipeline. This option may be used multiple times.",
+)
+def project(
+    command: str,
+    database: str,
+    directory: str,
+    name: str,
+    debounce: Optional[float],
+    share_window: Optional[float],
+    priority: Optional[int],
+    workspaces: Optional[int],
+    workspace_method: Optional[str],
+    env: Tuple[str, ...],
+    path: Optional[str],
+    umask: Optional[str],
+    cpu_time: Optional[int],
+    memory: Optional[str],
+    open_files: Optional[int],
+    schedule: Optional[str],
+    agent_label: Optional[str],
+    extract: Tuple[str, ...],
+    junit: bool,
+    json_summary: bool,
+    tail: Optional[int],
+    output_max_bytes: Optional[str],
+    output_head_bytes: Optional[str],
+    strip_ansi: bool,
+    depends_on: Tuple[str, ...],
+) -> None:
     """Create a new project in the database."""
     if not os.path.isfile(database):
         raise click.UsageError(message=f"Not a file: {database}")
     if not os.path.isdir(directory):
         raise click.UsageError(message=f"Not a directory: {directory}")
 
+    environment: Optional[Dict[str, str]] = None
+    if env:
+        environment = {}
+        for variable in env:
+            if "=" not in variable:
+                raise click.UsageError(f"Not of the form NAME=VALUE: {variable}")
+            variable_name, value = variable.split("=", 1)
+            environment[variable_name] = value
+
+    umask_value: Optional[int] = None
+    if umask is not None:
+        try:
+            umask_value = int(umask, 8)
+        except ValueError:
+            raise click.UsageError(f"Not an octal number: {umask}")
+
+    memory_limit: Optional[int] = None
+    if memory is not None:
+        try:
+            memory_limit = _parse_size(memory)
+        except ValueError:
+            raise click.UsageError(f"Not a valid memory size: {memory}")
+
+    if schedule is not None:
+        try:
+            CronSchedule.parse(schedule)
+        except ValueError:
+            raise click.UsageError(f"Not a valid cron expression: {schedule}")
+
+    output_processors: List[Dict[str, Any]] = []
+    for extractor in extract:
+        if "=" not in extractor:
+            raise click.UsageError(f"Not of the form NAME=PATTERN: {extractor}")
+        field_name, pattern = extractor.split("=", 1)
+        output_processors.append(
+            {"type": "regex", "name": field_name, "pattern": pattern}
+        )
+    if junit:
+        output_processors.append({"type": "junit"})
+    if json_summary:
+        output_processors.append({"type": "json"})
+    if tail is not None:
+        output_processors.append({"type": "tail", "lines": tail})
+    for spec in output_processors:
+        try:
+            ProcessorSpec.from_dict(spec)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    max_bytes: Optional[int] = None
+    if output_max_bytes is not None:
+        try:
+            max_bytes = _parse_size(output_max_bytes)
+        except ValueError:
+            raise click.UsageError(f"Not a valid output size: {output_max_bytes}")
+    head_bytes: Optional[int] = None
+    if output_head_bytes is not None:
+        try:
+            head_bytes = (
+                0 if output_head_bytes == "0" else _parse_size(output_head_bytes)
+            )
+        except ValueError:
+            raise click.UsageError(f"Not a valid output size: {output_head_bytes}")
+    try:
+        OutputPolicy(max_bytes=max_bytes, head_bytes=head_bytes)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
     database_connection = _database.database_connection(f"sqlite:///{database}")
-    project = schemas.ProjectCreate(command=command, directory=directory, name=name)
-    crud.create_project(database_connection.LocalSession(), project)
+    db = database_connection.LocalSession()
+    for dependency in depends_on:
+        if crud.get_project(db, dependency) is None:
+            raise click.UsageError(f"No such project: {dependency}")
+
+    project = schemas.ProjectCreate(
+        command=command,
+        directory=directory,
+        name=name,
+        debounce_window=debounce,
+        share_window=share_window,
+        priority=priority,
+        workspaces=workspaces,
+        workspace_method=workspace_method,
+        environment=environment,
+        path=path,
+        umask=umask_value,
+        cpu_time_limit=cpu_time,
+        memory_limit=memory_limit,
+        open_files_limit=open_files,
+        schedule=schedule,
+        agent_label=agent_label,
+        output_processors=output_processors or None,
+        output_max_bytes=max_bytes,
+        output_head_bytes=head_bytes,
+        strip_ansi=strip_ansi or None,
+    )
+    crud.create_project(db, project)
+    for dependency in depends_on:
+        crud.add_dependency(db, name, dependency)
 
 
 @click.option(
@@ -99,6 +381,297 @@ def initdb(filename: str) -> None:
     Base.metadata.create_all(bind=database_connection.engine)
 
 
+@click.option(
+    "--database",
+    "--db",
+    type=click.Path(exists=True, file_okay=True, resolve_path=True),
+    required=True,
+    help="Database file. This must be a Sqlite 3 file, and it must have all the "
+    "required tables and columns.",
+)
+@click.argument(
+    "filename", type=click.Path(exists=False, file_okay=True, resolve_path=True)
+)
+@click.command()
+def snapshot(database: str, filename: str) -> None:
+    """
+    Export the projects and token hashes to a snapshot in FILENAME.
+
+    A server loads the snapshot at startup if its RCS_SNAPSHOT_FILE setting points
+    to the file, so that it can verify tokens without querying the database. An
+    existing snapshot is replaced.
+    """
+    database_connection = _database.database_connection(f"sqlite:///{database}")
+    db = database_connection.LocalSession()
+    try:
+        projects, tokens = snapshots.write(db, pathlib.Path(filename))
+    finally:
+        db.close()
+    click.echo(f"Exported {projects} projects and {tokens} tokens to {filename}")
+
+
+@click.argument(
+    "filename", type=click.Path(exists=True, file_okay=True, resolve_path=True)
+)
+@click.command()
+def upgradedb(filename: str) -> None:
+    """
+    Upgrade the database in FILENAME to the current version.
+
+    Missing tables, columns and indexes are added. Existing data is kept, and a
+    database which is up to date is not changed.
+    """
+    database_connection = _database.database_connection(f"sqlite:///{filename}")
+    try:
+        changes = migrations.upgrade(database_connection.engine)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for change in changes:
+        click.echo(change)
+    if not changes:
+        click.echo("The database is up to date.")
+
+
+@click.command()
+def admintoken() -> None:
+    """Generate a token for admin features."""
+    token = secrets.token_urlsafe()
+    click.echo(f"Generated admin token: {token}")
+    click.echo(f"Token hash: {crud.hash_token(token)}")
+    click.echo(
+        click.style(
+            "Set the environment variable RCS_ADMIN_TOKEN_HASH to the token hash "
+            "before launching the server.",
+            fg="yellow",
+            bold=True,
+        )
+    )
+
+
+@click.command()
+def agenttoken() -> None:
+    """Generate a token for agents."""
+    token = secrets.token_urlsafe()
+    click.echo(f"Generated agent token: {token}")
+    click.echo(f"Token hash: {crud.hash_token(token)}")
+    click.echo(
+        click.style(
+            "Set the environment variable RCS_AGENT_TOKEN_HASH to the token hash "
+            "before launching the server, and pass the token to the agents.",
+            fg="yellow",
+            bold=True,
+        )
+    )
+
+
+@click.command()
+@click.option(
+    "--server",
+    type=str,
+    required=True,
+    help="WebSocket URL of the server's agent endpoint, such as "
+    "wss://example.com/agents/connect.",
+)
+@click.option(
+    "--token",
+    type=str,
+    envvar="RCS_AGENT_TOKEN",
+    required=True,
+    help="Agent token, as generated by the agenttoken command. The token may also "
+    "be passed with the environment variable RCS_AGENT_TOKEN.",
+)
+@click.option(
+    "--label",
+    type=str,
+    multiple=True,
+    required=True,
+    help="Label of this agent. Runs of projects with this agent label may be sent to "
+    "this agent. This option may be used multiple times.",
+)
+@click.option(
+    "--capacity",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    help="Maximum number of commands to run at the same time.",
+)
+@click.option(
+    "--name",
+    type=str,
+    default=None,
+    help="Name of this agent. The default is the host name.",
+)
+def agent(
+    server: str, token: str, label: Tuple[str, ...], capacity: int, name: Optional[str]
+) -> None:
+    """Run an agent executing commands for a server."""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(
+            agents.run_agent(
+                server, token, labels=list(label), capacity=capacity, name=name
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@click.command()
+@click.option(
+    "--projects",
+    type=click.IntRange(min=1),
+    default=10,
+    help="Number of projects, each with a token. The requests are spread evenly over "
+    "the projects.",
+)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=click.IntRange(min=1),
+    default=10,
+    help="Number of concurrent clients.",
+)
+@click.option(
+    "--duration",
+    "-d",
+    type=click.FloatRange(min=0),
+    default=10,
+    help="Duration of the benchmark in seconds. For a soak test, use a long duration.",
+)
+@click.option(
+    "--requests",
+    "-n",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of requests after which to stop, even if the duration hasn't passed.",
+)
+@click.option(
+    "--latency",
+    type=click.FloatRange(min=0),
+    default=0.01,
+    help="Time in seconds a fake command takes.",
+)
+@click.option(
+    "--output-size",
+    type=str,
+    default="1K",
+    help="Number of bytes of output a fake command writes. The suffixes K, M and G "
+    "may be used, as in 512K.",
+)
+@click.option(
+    "--command",
+    type=str,
+    default=None,
+    help="Shell command for the projects. If this is given, real commands are run "
+    "rather than fake ones.",
+)
+@click.option(
+    "--report-interval",
+    type=click.FloatRange(min=0.1),
+    default=5,
+    help="Time in seconds between reports.",
+)
+def bench(
+    projects: int,
+    concurrency: int,
+    duration: float,
+    requests: Optional[int],
+    latency: float,
+    output_size: str,
+    command: Optional[str],
+    report_interval: float,
+) -> None:
+    """
+    Benchmark the server with fake commands.
+
+    A temporary database with projects and tokens is created, and the server is
+    started on a free local port. Concurrent clients then make run requests, and the
+    throughput, latencies, memory usage and open files are reported regularly. The
+    settings are read from the environment as usual.
+    """
+
+    try:
+        output_bytes = 0 if output_size == "0" else _parse_size(output_size)
+    except ValueError:
+        raise click.UsageError(f"Not a valid output size: {output_size}")
+
+    click.echo(
+        f"{'time':>8}{'requests':>10}{'req/s':>10}{'p50 ms':>9}{'p90 ms':>9}"
+        f"{'p99 ms':>9}{'max ms':>9}{'errors':>8}{'rss MiB':>9}{'fds':>6}"
+    )
+    previous = 0.0
+
+    def report(sample: _bench.Sample) -> None:
+        nonlocal previous
+        interval = sample.elapsed - previous
+        previous = sample.elapsed
+        latencies = sample.latencies
+        click.echo(
+            f"{sample.elapsed:8.1f}{sample.requests:10d}"
+            f"{sample.requests / interval if interval else 0:10.1f}"
+            f"{1000 * latencies.percentile(50):9.2f}"
+            f"{1000 * latencies.percentile(90):9.2f}"
+            f"{1000 * latencies.percentile(99):9.2f}"
+            f"{1000 * latencies.max:9.2f}{sample.errors:8d}"
+            f"{_format(sample.rss, 1024 ** 2):>9}{_format(sample.open_files, 1):>6}"
+        )
+
+    result = _bench.run(
+        projects=projects,
+        concurrency=concurrency,
+        duration=duration,
+        requests=requests,
+        latency=latency,
+        output_size=output_bytes,
+        command=command,
+        report_interval=report_interval,
+        report=report,
+    )
+
+    latencies = result.latencies
+    statuses = ", ".join(
+        f"{status}: {count}" for status, count in sorted(result.statuses.items())
+    )
+    click.echo()
+    click.echo(f"Requests:    {result.requests} in {result.duration:.1f} s")
+    click.echo(f"Throughput:  {result.throughput:.1f} requests/s")
+    click.echo(
+        f"Latency:     p50 {1000 * latencies.percentile(50):.2f} ms, "
+        f"p90 {1000 * latencies.percentile(90):.2f} ms, "
+        f"p99 {1000 * latencies.percentile(99):.2f} ms, "
+        f"max {1000 * latencies.max:.2f} ms"
+    )
+    click.echo(f"Statuses:    {statuses or 'none'}")
+    click.echo(f"Errors:      {result.errors}")
+    click.echo(f"Memory growth: {_format(result.growth('rss'), 1024 ** 2)} MiB")
+    click.echo(f"Open files growth: {_format(result.growth('open_files'), 1)}")
+
+
+def _format(value: Optional[int], unit: int) -> str:
+    if value is None:
+        return "n/a"
+    if unit == 1:
+        return str(value)
+    return f"{value / unit:.1f}"
+
+
+def _parse_size(value: str) -> int:
+    """Parse a size in bytes, which may have a suffix K, M or G."""
+
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    multiplier = multipliers.get(value[-1:].upper(), 1)
+    number = value[:-1] if multiplier > 1 else value
+    size = int(number) * multiplier
+    if size <= 0:
+        raise ValueError(f"Not a positive size: {value}")
+    return size
+
+
 cli.add_command(project)
 cli.add_command(token)
 cli.add_command(initdb)
+cli.add_command(upgradedb)
+cli.add_command(snapshot)
+cli.add_command(admintoken)
+cli.add_command(agenttoken)
+cli.add_command(agent)
+cli.add_command(bench)
@@ -0,0 +1,210 @@
+"""Negotiated compression of responses."""
+
+import zlib
+from typing import Dict, List, Optional, Union
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from remote_command_server.settings import get_settings
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+_ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+
+def available_encodings(encodings: List[str]) -> List[str]:
+    """Return the supported content encodings of a list, in the same order."""
+
+    supported = {"gzip"} if zstandard is None else {"gzip", "zstd"}
+    return [encoding for encoding in encodings if encoding in supported]
+
+
+def negotiate(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """
+    Choose the content encoding for a response.
+
+    The encoding with the highest quality value in the Accept-Encoding header is
+    chosen, and among encodings with the same quality value the first one of the
+    given encodings. None is returned if the client accepts none of them.
+    """
+
+    qualities: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, *parameters = part.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[coding.strip().lower()] = quality
+
+    best: Optional[str] = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class _GzipCompressor:
+    def __init__(self) -> None:
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        mode = zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+
+class _ZstdCompressor:
+    def __init__(self) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        mode = (
+            zstandard.COMPRESSOBJ_FLUSH_FINISH
+            if final
+            else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware for compressing responses.
+
+    JSON and text responses are compressed with the encoding negotiated with the
+    client, if they are at least as large as the minimum size. Streamed responses
+    without a known length are always compressed, and each chunk is flushed, so that
+    clients following a log receive output as soon as it is sent. Responses which
+    are encoded already (such as precompressed logs), partial responses and
+    responses to HEAD requests are sent as they are.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        settings = get_settings()
+        encodings = available_encodings(settings.compression_encodings)
+        if scope["type"] != "http" or not encodings:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        encoding: Optional[str] = None
+        if scope["method"] != "HEAD" and "range" not in headers:
+            encoding = negotiate(headers.get("accept-encoding", ""), encodings)
+        extensions = scope.get("extensions") or {}
+        if encoding is not None and _ZEROCOPY_EXTENSION in extensions:
+            # a compressed body must pass through this middleware
+            scope = dict(scope)
+            scope["extensions"] = {
+                name: value
+                for name, value in extensions.items()
+                if name != _ZEROCOPY_EXTENSION
+            }
+
+        responder = _Responder(send, encoding, settings.compression_minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _Responder:
+    def __init__(self, send: Send, encoding: Optional[str], minimum_size: int) -> None:
+        self._send = send
+        self._encoding = encoding
+        self._minimum_size = minimum_size
+        self._start: Optional[Message] = None
+        self._compressor: Optional[Union[_GzipCompressor, _ZstdCompressor]] = None
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # the headers depend on the first chunk of the body
+            self._start = message
+            return
+        if message["type"] != "http.response.body":
+            # e.g. a zero-copy body, which is sent as it is, after the pending start
+            if self._start is not None:
+                start, self._start = self._start, None
+                self._add_vary(MutableHeaders(raw=start["headers"]))
+                await self._send(start)
+            await self._send(message)
+            return
+
+        if self._start is not None:
+            start, self._start = self._start, None
+            self._compressor = self._compressor_for(start, message)
+            if self._compressor is not None and not message.get("more_body", False):
+                body = self._compressor.compress(message.get("body", b""), final=True)
+                headers = MutableHeaders(raw=start["headers"])
+                headers["content-length"] = str(len(body))
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body})
+                return
+            await self._send(start)
+
+        if self._compressor is None:
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if more_body and not body:
+            return
+        await self._send(
+            {
+                "type": "http.response.body",
+                "body": self._compressor.compress(body, final=not more_body),
+                "more_body": more_body,
+            }
+        )
+
+    @staticmethod
+    def _add_vary(headers: MutableHeaders) -> None:
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return
+        if "content-encoding" in headers:
+            return
+        vary = {value.strip().lower() for value in headers.get("vary", "").split(",")}
+        if "accept-encoding" not in vary:
+            headers.add_vary_header("Accept-Encoding")
+
+    def _compressor_for(
+        self, start: Message, message: Message
+    ) -> Optional[Union[_GzipCompressor, _ZstdCompressor]]:
+        headers = MutableHeaders(raw=start["headers"])
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return None
+        if "content-encoding" in headers:
+            return None
+        self._add_vary(headers)
+        if self._encoding is None or start["status"] in (204, 206, 304):
+            return None
+
+        if message.get("more_body", False):
+            content_length = headers.get("content-length")
+            size = int(content_length) if content_length is not None else None
+        else:
+            size = len(message.get("body", b""))
+        if size is not None and size < self._minimum_size:
+            return None
+
+        headers["content-encoding"] = self._encoding
+        if "content-length" in headers:
+            del headers["content-length"]
+        if "accept-ranges" in headers:
+            del headers["accept-ranges"]
+        if self._encoding == "zstd":
+            return _ZstdCompressor()
+        return _GzipCompressor()
@@ -0,0 +1,160 @@
+"""Cron expressions for scheduling runs."""
+
+import calendar
+import dataclasses
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+MONTH_NAMES = {
+    name.lower(): number for number, name in enumerate(calendar.month_abbr) if name
+}
+
+DAY_NAMES = {
+    name.lower(): (number + 1) % 7 for number, name in enumerate(calendar.day_abbr)
+}
+
+# how far to look ahead before concluding that an expression never matches
+MAX_YEARS = 8
+
+
+@dataclasses.dataclass(frozen=True)
+class CronSchedule:
+    """
+    A schedule defined by a cron expression.
+
+    The usual five fields (minute, hour, day of month, month and day of week) are
+    supported, with lists, ranges, steps and month and day names, as well as macros
+    such as @daily. As in cron, if both the day of month and the day of week are
+    restricted, a day matches if either of them matches. Sunday is 0 (or 7).
+    """
+
+    expression: str
+    minutes: Tuple[int, ...]
+    hours: Tuple[int, ...]
+    days: FrozenSet[int]
+    months: FrozenSet[int]
+    weekdays: FrozenSet[int]
+    any_day: bool
+    any_weekday: bool
+
+    @staticmethod
+    def parse(expression: str) -> "CronSchedule":
+        """
+        Parse a cron expression.
+
+        A ValueError is raised if the expression is invalid or never matches.
+        """
+
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Not a cron expression with five fields: {expression}")
+        minute, hour, day, month, weekday = fields
+        weekdays = {d % 7 for d in _parse_field(weekday, 0, 7, DAY_NAMES)}
+        schedule = CronSchedule(
+            expression=expression,
+            minutes=tuple(sorted(_parse_field(minute, 0, 59))),
+            hours=tuple(sorted(_parse_field(hour, 0, 23))),
+            days=frozenset(_parse_field(day, 1, 31)),
+            months=frozenset(_parse_field(month, 1, 12, MONTH_NAMES)),
+            weekdays=frozenset(weekdays),
+            any_day=day == "*",
+            any_weekday=weekday == "*",
+        )
+        if schedule.next_after(datetime(2000, 1, 1)) is None:
+            raise ValueError(f"Cron expression never matches: {expression}")
+        return schedule
+
+    def next_after(self, when: datetime) -> Optional[datetime]:
+        """
+        Return the first time matching the schedule after a given time.
+
+        None is returned if there is no matching time within the next few years.
+        Rather than checking every minute, the search skips non-matching months, days
+        and hours.
+        """
+
+        t = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while t.year <= when.year + MAX_YEARS:
+            if t.month not in self.months:
+                t = _start_of_next_month(t)
+                continue
+            if not self._matches_day(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            hour = _next_value(self.hours, t.hour)
+            if hour is None:
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0)
+            minute = _next_value(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            return t.replace(minute=minute)
+        return None
+
+    def _matches_day(self, t: datetime) -> bool:
+        day_matches = t.day in self.days
+        weekday_matches = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_matches
+        if self.any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+
+def _parse_field(
+    field: str, minimum: int, maximum: int, names: Optional[Dict[str, int]] = None
+) -> FrozenSet[int]:
+    values: List[int] = []
+    for part in field.split(","):
+        value_range, _, step_value = part.partition("/")
+        step = _parse_number(step_value, names=None) if step_value else 1
+        if step < 1:
+            raise ValueError(f"Invalid step: {part}")
+        if value_range == "*":
+            first, last = minimum, maximum
+        elif "-" in value_range:
+            start, _, end = value_range.partition("-")
+            first, last = _parse_number(start, names), _parse_number(end, names)
+        else:
+            first = _parse_number(value_range, names)
+            last = maximum if step_value else first
+        if first < minimum or last > maximum or first > last:
+            raise ValueError(f"Value out of range: {part}")
+        values.extend(range(first, last + 1, step))
+    return frozenset(values)
+
+
+def _parse_number(value: str, names: Optional[Dict[str, int]]) -> int:
+    if names is not None and value.lower() in names:
+        return names[value.lower()]
+    if not value.isdigit():
+        raise ValueError(f"Not a number: {value}")
+    return int(value)
+
+
+def _next_value(values: Tuple[int, ...], current: int) -> Optional[int]:
+    for value in values:
+        if value >= current:
+            return value
+    return None
+
+
+def _start_of_next_month(t: datetime) -> datetime:
+    if t.month == 12:
+        return datetime(t.year + 1, 1, 1)
+    return datetime(t.year, t.month + 1, 1)
@@ -1,10 +1,18 @@
 import hashlib
+import hmac
 import secrets
-from typing import cast
+from datetime import datetime
+from typing import Any, List, Optional, Sequence, Tuple, cast
 
+from sqlalchemy import event, inspect
 from sqlalchemy.orm import Session
 
 from remote_command_server import models, schemas
+from remote_command_server.settings import get_settings
+
+# columns of projects which change while the server runs, and which don't affect the
+# credentials
+VOLATILE_PROJECT_COLUMNS = {"last_scheduled_run"}
 
 
 def create_project(db: Session, project: schemas.ProjectCreate) -> models.Project:
@@ -16,6 +24,87 @@ def create_project(db: Session, project: schemas.ProjectCreate) -> models.Projec
     return db_project
 
 
+def get_project(db: Session, name: str) -> Optional[models.Project]:
+    """Get the project with a given name."""
+
+    return cast(
+        Optional[models.Project],
+        db.query(models.Project).filter(models.Project.name == name).first(),
+    )
+
+
+def add_dependency(db: Session, project_name: str, dependency_name: str) -> None:
+    """
+    Make a project depend on another project.
+
+    A ValueError is raised if either project does not exist, or if the dependency
+    would create a cycle.
+    """
+
+    project = get_project(db, project_name)
+    dependency = get_project(db, dependency_name)
+    if project is None or dependency is None:
+        raise ValueError("Project name not found in database")
+    upstream_projects, _ = get_dependency_graph(db, dependency)
+    if project.id in {p.id for p in upstream_projects}:
+        raise ValueError("The dependency would create a cycle")
+
+    project.dependencies.append(dependency)
+    db.commit()
+
+
+def get_dependency_graph(
+    db: Session, project: models.Project
+) -> Tuple[List[models.Project], List[Tuple[int, int]]]:
+    """
+    Get the dependency graph of a project.
+
+    The graph consists of the project and all the projects it depends on, directly or
+    indirectly, and of the dependency edges between them, as pairs of the ids of a
+    project and of a project it depends on. The graph is loaded with two queries per
+    level of dependencies.
+    """
+
+    projects = {project.id: project}
+    edges: List[Tuple[int, int]] = []
+    level = [project.id]
+    while level:
+        level_edges = [
+            (edge.project_id, edge.dependency_id)
+            for edge in db.query(models.project_dependencies).filter(
+                models.project_dependencies.c.project_id.in_(level)
+            )
+        ]
+        edges.extend(level_edges)
+        level = list(
+            {dependency_id for _, dependency_id in level_edges} - projects.keys()
+        )
+        if level:
+            for p in db.query(models.Project).filter(models.Project.id.in_(level)):
+                projects[p.id] = p
+    return list(projects.values()), edges
+
+
+def get_scheduled_projects(db: Session) -> List[models.Project]:
+    """Get all projects with a schedule."""
+
+    return cast(
+        List[models.Project],
+        db.query(models.Project).filter(models.Project.schedule.isnot(None)).all(),
+    )
+
+
+def set_last_scheduled_run(
+    db: Session, project_ids: Sequence[int], when: datetime
+) -> None:
+    """Record the time of the last scheduled run for projects."""
+
+    db.query(models.Project).filter(models.Project.id.in_(project_ids)).update(
+        {models.Project.last_scheduled_run: when}, synchronize_session=False
+    )
+    db.commit()
+
+
 def create_token(db: Session, project_name: str) -> str:
     """
     Create a new token in the database.
@@ -74,3 +163,167 @@ def hash_token(token: str) -> str:
     """Hash a token value."""
 
     return hashlib.sha256(token.encode("UTF-8")).hexdigest()
+
+
+def get_credentials_version(db: Session) -> int:
+    """
+    Get the version of the projects and tokens.
+
+    The version is increased whenever a project or token is added, changed or removed
+    through a session, and it is 0 if there have been no such changes.
+    """
+
+    version = (
+        db.query(models.CredentialsVersion.version)
+        .filter(models.CredentialsVersion.id == 1)
+        .scalar()
+    )
+    return cast(int, version or 0)
+
+
+def _changes_credentials(db: Session, instance: object) -> bool:
+    if isinstance(instance, models.Token):
+        return True
+    if not isinstance(instance, models.Project):
+        return False
+    if instance in db.new or instance in db.deleted:
+        return True
+    state = inspect(instance)
+    return any(
+        state.attrs[column.key].history.has_changes()
+        for column in state.mapper.column_attrs
+        if column.key not in VOLATILE_PROJECT_COLUMNS
+    )
+
+
+@event.listens_for(Session, "before_flush")
+def _increase_credentials_version(
+    db: Session, flush_context: Any, instances: Any
+) -> None:
+    # The version is increased in the transaction which changes the projects or
+    # tokens, so that the changes can't be committed without it.
+    changed = (*db.new, *db.dirty, *db.deleted)
+    if not any(_changes_credentials(db, instance) for instance in changed):
+        return
+    table = models.CredentialsVersion.__table__
+    result = db.execute(table.update().values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        db.execute(table.insert().values(id=1, version=1))
+
+
+def get_credentials(db: Session) -> Tuple[List[str], List[str]]:
+    """Get the names of all projects and the hashes of all tokens."""
+
+    project_names = [name for (name,) in db.query(models.Project.name)]
+    hashed_tokens = [hashed for (hashed,) in db.query(models.Token.hashed_token)]
+    return project_names, hashed_tokens
+
+
+def get_projects(db: Session) -> List[models.Project]:
+    """Get all projects."""
+
+    return cast(List[models.Project], db.query(models.Project).all())
+
+
+def get_token_hashes(db: Session) -> List[Tuple[str, int]]:
+    """Get the hashes of all tokens, with the ids of their projects."""
+
+    return [
+        (hashed, project_id)
+        for hashed, project_id in db.query(
+            models.Token.hashed_token, models.Token.project_id
+        )
+    ]
+
+
+def verify_admin_token(token: str) -> bool:
+    """
+    Verify whether a token is the admin token.
+
+    No token is accepted if no admin token hash is defined in the settings.
+    """
+
+    return _verify_token_hash(token, get_settings().admin_token_hash)
+
+
+def verify_agent_token(token: str) -> bool:
+    """
+    Verify whether a token is the agent token.
+
+    No token is accepted if no agent token hash is defined in the settings.
+    """
+
+    return _verify_token_hash(token, get_settings().agent_token_hash)
+
+
+def _verify_token_hash(token: str, token_hash: Optional[str]) -> bool:
+    if not token_hash:
+        return False
+    return hmac.compare_digest(hash_token(token), token_hash)
+
+
+def create_runs(db: Session, runs: Sequence[schemas.RunCreate]) -> None:
+    """
+    Create new runs in the database.
+
+    All runs are inserted with a single bulk insert and a single commit.
+    """
+
+    db.bulk_insert_mappings(models.Run, [run.dict() for run in runs])
+    db.commit()
+
+
+def get_run(db: Session, key: str) -> Optional[models.Run]:
+    """Get the run with a given key."""
+
+    return cast(
+        Optional[models.Run],
+        db.query(models.Run).filter(models.Run.key == key).first(),
+    )
+
+
+def get_runs(
+    db: Session, project_id: int, since: Optional[datetime] = None, limit: int = 100
+) -> List[models.Run]:
+    """
+    Get the most recent runs of a project.
+
+    The runs are sorted by start time, with the most recent run first. If since is
+    given, only runs started at or after that time are included.
+    """
+
+    query = db.query(models.Run).filter(models.Run.project_id == project_id)
+    if since is not None:
+        query = query.filter(models.Run.started_at >= since)
+    return cast(
+        List[models.Run],
+        query.order_by(models.Run.started_at.desc()).limit(limit).all(),
+    )
+
+
+def delete_runs_before(
+    db: Session, before: datetime, chunk_size: int
+) -> Tuple[int, List[str]]:
+    """
+    Delete up to chunk_size runs which started before a given time.
+
+    The oldest runs are deleted first. The number of deleted runs is returned, so that
+    the caller can tell whether there might be more runs to delete, together with the
+    paths of the deleted runs' logs, so that the caller can remove them.
+    """
+
+    runs = (
+        db.query(models.Run.id, models.Run.log_path)
+        .filter(models.Run.started_at < before)
+        .order_by(models.Run.started_at)
+        .limit(chunk_size)
+        .all()
+    )
+    if not runs:
+        return 0, []
+
+    db.query(models.Run).filter(models.Run.id.in_([run.id for run in runs])).delete(
+        synchronize_session=False
+    )
+    db.commit()
+    return len(runs), [run.log_path for run in runs if run.log_path]
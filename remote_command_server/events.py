@@ -0,0 +1,205 @@
+"""Structured logging of server events."""
+
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import orjson
+
+from remote_command_server.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+DROP_NEWEST = "newest"
+DROP_OLDEST = "oldest"
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Handler putting log records into a bounded queue without ever blocking.
+
+    If the queue is full, either the new record (drop policy "newest") or the oldest
+    queued record (drop policy "oldest") is dropped, and the number of dropped records
+    is counted.
+
+    Unlike the standard QueueHandler, records are not formatted before they are
+    queued, as the queue is not shared with other processes. All formatting is thus
+    done in the listener's thread.
+    """
+
+    def __init__(self, queue_size: int, drop_policy: str = DROP_NEWEST) -> None:
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Invalid drop policy: {drop_policy}")
+        self.bounded_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(
+            maxsize=queue_size
+        )
+        super().__init__(self.bounded_queue)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.bounded_queue.put_nowait(record)
+        except queue.Full:
+            with self._drop_lock:
+                self.dropped += 1
+                if self.drop_policy == DROP_OLDEST:
+                    try:
+                        self.bounded_queue.get_nowait()
+                        self.bounded_queue.put_nowait(record)
+                    except (queue.Empty, queue.Full):
+                        pass
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # wait for a free slot, as the queue may be full when the listener is stopped
+        self.queue.put(self._sentinel)  # type: ignore
+
+
+class JSONFormatter(logging.Formatter):
+    """Formatter writing events as JSON objects, one per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        event.update(getattr(record, "fields", {}))
+        return orjson.dumps(event, default=str).decode()
+
+
+class EventLog:
+    """
+    Asynchronous log of structured events.
+
+    Events are put into a bounded queue, and written by a listener thread, so that
+    emitting an event never blocks on log I/O. Before the log has been started, events
+    are discarded.
+
+    Informational events of a project's runs can be sampled. The sampling decision is
+    derived from the run key, so that either all or none of a run's events are
+    logged. Warnings and errors are never sampled.
+    """
+
+    def __init__(self) -> None:
+        self.handler: Optional[BoundedQueueHandler] = None
+        self.sample_rate = 1.0
+        self.sample_rates: Dict[str, float] = {}
+        self._listener: Optional[_Listener] = None
+
+    def start(
+        self,
+        target: logging.Handler,
+        queue_size: int = 10000,
+        drop_policy: str = DROP_NEWEST,
+        sample_rate: float = 1.0,
+        sample_rates: Optional[Dict[str, float]] = None,
+    ) -> None:
+        """Start writing events to a handler."""
+
+        self.stop()
+        target.setFormatter(JSONFormatter())
+        self.handler = BoundedQueueHandler(queue_size, drop_policy)
+        self.sample_rate = sample_rate
+        self.sample_rates = dict(sample_rates or {})
+        self._listener = _Listener(self.handler.queue, target)
+        self._listener.start()
+        logger.addHandler(self.handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    def start_from_settings(self, settings: Settings) -> None:
+        """Start writing events as defined by the settings, if the log is enabled."""
+
+        if not settings.event_log:
+            return
+        target: logging.Handler = (
+            logging.StreamHandler(sys.stderr)
+            if settings.event_log == "-"
+            else logging.FileHandler(settings.event_log)
+        )
+        self.start(
+            target,
+            queue_size=settings.event_log_queue_size,
+            drop_policy=settings.event_log_drop_policy,
+            sample_rate=settings.event_sample_rate,
+            sample_rates=settings.event_sample_rates,
+        )
+
+    def stop(self) -> None:
+        """
+        Write the queued events and stop the listener.
+
+        If events have been dropped, an events_dropped event with their number is
+        written last.
+        """
+
+        if self._listener is None or self.handler is None:
+            return
+        logger.removeHandler(self.handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            if self.handler.dropped:
+                handler.handle(
+                    _record(
+                        "events_dropped",
+                        logging.WARNING,
+                        {"count": self.handler.dropped},
+                    )
+                )
+            handler.close()
+        self._listener = None
+        self.handler = None
+
+    def sampled(self, project: Optional[str], run: Optional[str]) -> bool:
+        """Check whether the informational events of a project's run are logged."""
+
+        rate = self.sample_rates.get(project, self.sample_rate) if project else 1.0
+        if rate >= 1:
+            return True
+        if run is None:
+            return random.random() < rate  # nosec
+        return zlib.crc32(run.encode()) < rate * 2**32
+
+    def emit(
+        self,
+        event: str,
+        level: int = logging.INFO,
+        project: Optional[str] = None,
+        run: Optional[str] = None,
+        **fields: Any,
+    ) -> None:
+        """Log an event with fields, unless it is sampled out."""
+
+        if self.handler is None:
+            return
+        if level < logging.WARNING and not self.sampled(project, run):
+            return
+        if project is not None:
+            fields["project"] = project
+        if run is not None:
+            fields["run"] = run
+        logger.handle(_record(event, level, fields))
+
+
+def _record(event: str, level: int, fields: Dict[str, Any]) -> logging.LogRecord:
+    # the record is created directly, as finding the caller is comparatively slow
+    return logger.makeRecord(
+        logger.name, level, "", 0, event, (), None, extra={"fields": fields}
+    )
+
+
+# the log of server events
+event_log = EventLog()
@@ -0,0 +1,625 @@
+"""Execution of project commands."""
+
+import asyncio
+import dataclasses
+import functools
+import logging
+import pathlib
+import signal
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from remote_command_server import (
+    agents,
+    events,
+    history,
+    logfiles,
+    models,
+    processors,
+    queueing,
+    schemas,
+    util,
+    workspaces,
+)
+from remote_command_server.filters import OutputFilter, OutputPolicy
+from remote_command_server.processors import OutputProcessor, ProcessorSpec
+from remote_command_server.resources import (
+    Cgroup,
+    ResourceLimits,
+    ResourceUsage,
+)
+from remote_command_server.settings import get_settings
+from remote_command_server.spawn import (
+    ExecutionProfile,
+    SpawnSpecCache,
+    compile_spec,
+)
+
+logger = logging.getLogger(__name__)
+
+spawn_specs = SpawnSpecCache()
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+    """
+    A project's command to run.
+
+    Unlike a project model, a job does not depend on a database session, so that it
+    can be run after the request which created it has finished.
+    """
+
+    project_id: int
+    project_name: str
+    command: str
+    profile: ExecutionProfile
+    agent_label: Optional[str] = None
+    share_window: Optional[float] = None
+    priority: int = 0
+    processors: Tuple[ProcessorSpec, ...] = ()
+    workspaces: int = 0
+    workspace_method: Optional[str] = None
+    output_policy: OutputPolicy = OutputPolicy()
+
+    @property
+    def directory(self) -> str:
+        return self.profile.directory
+
+    @staticmethod
+    def from_project(project: models.Project) -> "Job":
+        """Create the job for a project."""
+
+        environment = (
+            tuple(sorted(project.environment.items()))
+            if project.environment is not None
+            else None
+        )
+        return Job(
+            project_id=project.id,
+            project_name=project.name,
+            command=project.command,
+            profile=ExecutionProfile(
+                directory=project.directory,
+                environment=environment,
+                path=project.path,
+                umask=project.umask,
+                limits=ResourceLimits(
+                    cpu_time=project.cpu_time_limit,
+                    memory=project.memory_limit,
+                    open_files=project.open_files_limit,
+                ),
+            ),
+            agent_label=project.agent_label,
+            share_window=project.share_window,
+            priority=project.priority or 0,
+            processors=tuple(
+                ProcessorSpec.from_dict(spec)
+                for spec in project.output_processors or []
+            ),
+            workspaces=project.workspaces or 0,
+            workspace_method=project.workspace_method,
+            output_policy=OutputPolicy(
+                max_bytes=project.output_max_bytes,
+                head_bytes=project.output_head_bytes,
+                strip_ansi=bool(project.strip_ansi),
+            ),
+        )
+
+
+@dataclasses.dataclass
+class ActiveRun:
+    """
+    A run in progress.
+
+    The pid is set while the command's process exists, and may only be used for
+    signalling the process while the lock is held, as the process could otherwise be
+    reaped (and its pid reused) meanwhile.
+    """
+
+    key: str
+    job: Job
+    started_at: datetime
+    log_path: Optional[pathlib.Path] = None
+    output_bytes: int = 0
+    pid: Optional[int] = None
+    interrupted: bool = False
+    processors: List[OutputProcessor] = dataclasses.field(default_factory=list)
+    output_filter: Optional[OutputFilter] = None
+    workspace: Optional[pathlib.Path] = None
+    queue_time: float = 0
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+
+@dataclasses.dataclass(frozen=True)
+class RunResult:
+    """The result of running a job."""
+
+    key: str
+    returncode: int
+    started_at: datetime
+    duration: float
+    output_size: int
+    usage: Optional[ResourceUsage] = None
+    log_path: Optional[pathlib.Path] = None
+    interrupted: bool = False
+    output: Dict[str, Any] = dataclasses.field(default_factory=dict)
+
+
+# the runs in progress (including queued runs), by run key
+active_runs: Dict[str, ActiveRun] = {}
+
+# the queue of runs waiting for an execution slot; there is no limit until the server
+# replaces it with the queue defined by the settings
+run_queue = queueing.RunQueue(capacity=0)
+
+_background_tasks: Set["asyncio.Future[None]"] = set()
+
+
+async def execute(
+    job: Job, recorder: Optional[history.RunRecorder] = None
+) -> RunResult:
+    """
+    Run a job and record the run in the run history.
+
+    If the job has a share window, an identical job which is being run (or has been
+    run within the share window) is not run again, but its result is returned; see
+    SingleFlight.
+
+    The command is run in the thread pool, so that the event loop is not blocked. If
+    the job has an agent label, the command is run on the least loaded agent with
+    that label instead, and an AgentError is raised if there is no such agent. The
+    run is only recorded if a recorder is passed. If the job has workspaces, a local
+    run leases one of the project's workspaces and runs the command in it; see
+    workspaces.WorkspacePool.
+
+    If a log directory is defined in the settings, the output is written to a log
+    file while the command is running, and compressed copies of the log file are
+    created in the background once it has finished. The output is not kept in memory.
+    """
+
+    if job.share_window is not None:
+        return await shared_runs.run(job, lambda job: _execute(job, recorder))
+    return await _execute(job, recorder)
+
+
+async def _execute(job: Job, recorder: Optional[history.RunRecorder]) -> RunResult:
+    settings = get_settings()
+    key = uuid.uuid4().hex
+    active_run = ActiveRun(
+        key=key,
+        job=job,
+        started_at=datetime.utcnow(),
+        log_path=(
+            logfiles.log_path(pathlib.Path(settings.log_directory), key)
+            if settings.log_directory
+            else None
+        ),
+        processors=processors.create_all(job.processors),
+        output_filter=(
+            OutputFilter(job.output_policy)
+            if job.output_policy != OutputPolicy()
+            else None
+        ),
+    )
+
+    active_runs[key] = active_run
+    events.event_log.emit(
+        "run_queued", project=job.project_name, run=key, agent_label=job.agent_label
+    )
+    start = time.monotonic()
+    try:
+        if job.agent_label is not None:
+            completed_process = await _run_on_agent(active_run, job.agent_label)
+        else:
+            completed_process = await _run_locally(active_run, start)
+    except Exception as e:
+        events.event_log.emit(
+            "run_error",
+            level=logging.ERROR,
+            project=job.project_name,
+            run=key,
+            error=f"{type(e).__name__}: {e}",
+        )
+        raise
+    finally:
+        del active_runs[key]
+    duration = time.monotonic() - start
+
+    result = RunResult(
+        key=key,
+        returncode=completed_process.returncode,
+        started_at=active_run.started_at,
+        duration=duration,
+        output_size=active_run.output_bytes,
+        usage=completed_process.usage,
+        log_path=active_run.log_path,
+        interrupted=active_run.interrupted,
+        output=processors.results(active_run.processors),
+    )
+    events.event_log.emit(
+        "run_finished",
+        level=logging.WARNING if result.interrupted else logging.INFO,
+        project=job.project_name,
+        run=key,
+        returncode=result.returncode,
+        duration=round(duration, 6),
+        queue_time=round(active_run.queue_time, 6),
+        output_size=result.output_size,
+        interrupted=result.interrupted,
+    )
+    if result.log_path is not None:
+        _run_in_background(logfiles.precompress, result.log_path)
+    if recorder is not None:
+        recorder.record(_run_create(job, result))
+    return result
+
+
+def _log_writer(active_run: ActiveRun) -> Optional[logfiles.LogWriter]:
+    if active_run.log_path is None:
+        return None
+    return logfiles.LogWriter(active_run.log_path)
+
+
+def _output_handler(
+    active_run: ActiveRun, writer: Optional[logfiles.LogWriter]
+) -> util.OutputCallback:
+    output_filter = active_run.output_filter
+
+    def on_output(stream: str, data: bytes) -> None:
+        active_run.output_bytes += len(data)
+        if output_filter is not None:
+            data = output_filter.strip(stream, data)
+        for processor in active_run.processors:
+            processor.feed(stream, data)
+        if writer is not None:
+            if output_filter is not None:
+                data = output_filter.truncate(data)
+            if data:
+                writer.write(data)
+
+    return on_output
+
+
+def _close_log_writer(
+    active_run: ActiveRun, writer: Optional[logfiles.LogWriter]
+) -> None:
+    if writer is None:
+        return
+    # the tail of truncated output is only written once the run has finished
+    if active_run.output_filter is not None:
+        remainder = active_run.output_filter.finish()
+        if remainder:
+            writer.write(remainder)
+    writer.close()
+
+
+class _OutputQueue:
+    """
+    Queue for the output of an agent run, which is handled on the thread pool.
+
+    The output of an agent run arrives in the event loop, where filtering, processing
+    and writing it would block other requests. So the chunks are queued, and a task
+    passes all queued chunks at once to the thread pool, in the order they arrived.
+    """
+
+    def __init__(self, on_output: util.OutputCallback) -> None:
+        self._on_output = on_output
+        self._chunks: List[Tuple[str, bytes]] = []
+        self._queued = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.ensure_future(self._handle())
+
+    def put(self, stream: str, data: bytes) -> None:
+        """Queue a chunk of output."""
+
+        self._chunks.append((stream, data))
+        self._queued.set()
+
+    async def close(self) -> None:
+        """Wait until all queued chunks have been handled."""
+
+        self._closed = True
+        self._queued.set()
+        await self._task
+
+    async def _handle(self) -> None:
+        while True:
+            await self._queued.wait()
+            self._queued.clear()
+            chunks, self._chunks = self._chunks, []
+            if chunks:
+                await run_in_threadpool(self._handle_chunks, chunks)
+            if self._closed and not self._chunks:
+                return
+
+    def _handle_chunks(self, chunks: List[Tuple[str, bytes]]) -> None:
+        for stream, data in chunks:
+            self._on_output(stream, data)
+
+
+async def _run_on_agent(active_run: ActiveRun, label: str) -> util.CommandResult:
+    job = active_run.job
+    writer = await run_in_threadpool(_log_writer, active_run)
+    output = _OutputQueue(_output_handler(active_run, writer))
+    try:
+        completed_process = await agents.agent_pool.run(
+            label,
+            key=active_run.key,
+            project_id=job.project_id,
+            command=job.command,
+            profile=job.profile,
+            on_output=output.put,
+        )
+    except agents.AgentDisconnected:
+        active_run.interrupted = True
+        return util.CommandResult(job.command, -1, None, None, None)
+    finally:
+        try:
+            await output.close()
+        finally:
+            await run_in_threadpool(_close_log_writer, active_run, writer)
+    return completed_process
+
+
+async def _run_locally(active_run: ActiveRun, start: float) -> util.CommandResult:
+    job = active_run.job
+    async with run_queue.slot(active_run.key, job.project_id, job.priority):
+        active_run.queue_time = time.monotonic() - start
+        if active_run.interrupted:
+            # a run interrupted while it was queued has been granted a slot beyond
+            # the capacity, for which there is no thread
+            return util.CommandResult(job.command, -1, None, None, None)
+        if not job.workspaces:
+            return await run_queue.run(_run, active_run)
+
+        # The workspace is only leased (and reset) once the run holds a slot, so
+        # that queued runs don't hold workspaces which runs with slots wait for.
+        pool = workspaces.pools.get(
+            job.project_id,
+            job.directory,
+            job.workspaces,
+            method=job.workspace_method,
+            root=get_settings().workspace_root,
+        )
+        async with pool.lease() as workspace:
+            active_run.workspace = workspace
+            return await run_queue.run(_run, active_run)
+
+
+def _run(active_run: ActiveRun) -> util.CommandResult:
+    job = active_run.job
+    # the run may have been interrupted while it was queued
+    if active_run.interrupted:
+        return util.CommandResult(job.command, -1, None, None, None)
+    if active_run.workspace is not None:
+        # runs get different workspaces, so their specs aren't cached
+        spec = compile_spec(
+            dataclasses.replace(job.profile, directory=str(active_run.workspace))
+        )
+    else:
+        spec = spawn_specs.get(job.project_id, job.profile)
+    writer = _log_writer(active_run)
+    cgroup_root = get_settings().cgroup_root
+    cgroup = (
+        Cgroup.create(
+            pathlib.Path(cgroup_root),
+            f"rcs-{active_run.key}",
+            memory_limit=job.profile.limits.memory,
+        )
+        if cgroup_root
+        else None
+    )
+
+    def on_start(pid: int) -> None:
+        with active_run.lock:
+            active_run.pid = pid
+            # the run may have been interrupted before the process was started
+            if active_run.interrupted:
+                util.kill_process_group(pid, signal.SIGTERM)
+        events.event_log.emit(
+            "run_spawned", project=job.project_name, run=active_run.key, pid=pid
+        )
+
+    def on_exit() -> None:
+        with active_run.lock:
+            active_run.pid = None
+
+    try:
+        return util.run_command(
+            directory=spec.directory,
+            command=job.command,
+            spec=spec,
+            on_output=_output_handler(active_run, writer),
+            capture_output=False,
+            cgroup=cgroup,
+            on_start=on_start,
+            on_exit=on_exit,
+        )
+    finally:
+        _close_log_writer(active_run, writer)
+        if cgroup is not None:
+            cgroup.remove()
+
+
+def _run_create(job: Job, result: RunResult) -> schemas.RunCreate:
+    usage = result.usage
+    return schemas.RunCreate(
+        key=result.key,
+        project_id=job.project_id,
+        started_at=result.started_at,
+        finished_at=result.started_at + timedelta(seconds=result.duration),
+        exit_code=result.returncode,
+        duration=result.duration,
+        output_size=result.output_size,
+        log_path=str(result.log_path) if result.log_path is not None else None,
+        user_cpu=usage.user_cpu if usage else None,
+        system_cpu=usage.system_cpu if usage else None,
+        max_rss=usage.max_rss if usage else None,
+        io_read_bytes=usage.io_read_bytes if usage else None,
+        io_write_bytes=usage.io_write_bytes if usage else None,
+        interrupted=result.interrupted,
+    )
+
+
+class SingleFlight:
+    """
+    Sharing of runs between identical jobs.
+
+    While a job is being run, an identical job does not start another run. Instead it
+    waits for the run in progress and gets the same result. If the job's share window
+    is positive, the result is also returned for identical jobs until share_window
+    seconds after the run has finished. Interrupted or failing runs are never reused
+    after they have finished.
+
+    The run is executed in a task of its own, so that it is not cancelled if the
+    caller which started it goes away. All methods must be called in the event loop.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.shared = 0
+        self._runs: Dict[Job, "asyncio.Future[RunResult]"] = {}
+        self._results: Dict[Job, Tuple[float, RunResult]] = {}
+
+    async def run(
+        self, job: Job, execute: Callable[[Job], Awaitable[RunResult]]
+    ) -> RunResult:
+        """Run a job with an execute function, unless its result can be shared."""
+
+        self.requests += 1
+        now = time.monotonic()
+        finished = self._results.get(job)
+        if finished is not None:
+            expiry, result = finished
+            if now < expiry:
+                self.shared += 1
+                events.event_log.emit(
+                    "run_shared", project=job.project_name, run=result.key
+                )
+                return result
+            del self._results[job]
+
+        run = self._runs.get(job)
+        if run is None:
+            run = asyncio.ensure_future(execute(job))
+            run.add_done_callback(functools.partial(self._finish, job))
+            self._runs[job] = run
+        else:
+            self.shared += 1
+            events.event_log.emit("run_shared", project=job.project_name)
+        return await asyncio.shield(run)
+
+    def in_progress(self) -> int:
+        """Return the number of runs in progress which can be shared."""
+
+        return len(self._runs)
+
+    def _finish(self, job: Job, run: "asyncio.Future[RunResult]") -> None:
+        del self._runs[job]
+        now = time.monotonic()
+        for other, (expiry, _) in list(self._results.items()):
+            if expiry <= now:
+                del self._results[other]
+        if run.cancelled() or run.exception() is not None:
+            return
+        result = run.result()
+        if job.share_window and not result.interrupted:
+            self._results[job] = (now + job.share_window, result)
+
+
+# the runs which may be shared between identical jobs
+shared_runs = SingleFlight()
+
+
+def interrupt(key: str, sig: int = signal.SIGTERM) -> bool:
+    """
+    Interrupt a run in progress.
+
+    The signal is sent to the command's process group, so that the command's child
+    processes receive it as well. A queued run is taken out of the queue without
+    running its command. The run is marked as interrupted, and it is recorded as usual
+    once the command has exited. False is returned if there is no run in progress with
+    the given key.
+    """
+
+    active_run = active_runs.get(key)
+    if active_run is None:
+        return False
+    # the lock keeps the command's process from being reaped while it is signalled
+    with active_run.lock:
+        active_run.interrupted = True
+        if active_run.job.agent_label is not None:
+            agents.agent_pool.interrupt(key, sig)
+        elif active_run.pid is not None:
+            util.kill_process_group(active_run.pid, sig)
+        else:
+            run_queue.grant(key)
+    return True
+
+
+class Drainer:
+    """
+    Draining of runs before the server stops.
+
+    While draining, no new runs should be admitted. Runs in progress are given a grace
+    period to finish; any run still in progress afterwards is interrupted with SIGTERM,
+    and finally killed with SIGKILL if it hasn't exited within the kill timeout.
+    Interrupted runs are recorded like any other run.
+    """
+
+    def __init__(self, poll_interval: float = 0.1) -> None:
+        self.draining = False
+        self.poll_interval = poll_interval
+
+    def start(self) -> None:
+        """Stop admitting new runs."""
+
+        self.draining = True
+
+    async def drain(
+        self,
+        grace_period: float,
+        kill_timeout: float,
+        pending: Callable[[], int] = lambda: 0,
+    ) -> List[str]:
+        """
+        Drain the runs in progress.
+
+        The pending function should return the number of runs which have been admitted
+        but not started yet, such as debounced runs. Such runs are waited for during
+        the grace period as well.
+
+        The keys of the interrupted runs are returned.
+        """
+
+        self.start()
+        await self._wait(lambda: bool(active_runs) or pending() > 0, grace_period)
+        if pending():
+            logger.warning("Dropping %d pending runs", pending())
+
+        interrupted = [key for key in list(active_runs) if interrupt(key)]
+        if interrupted:
+            logger.warning("Interrupted %d runs", len(interrupted))
+            await self._wait(lambda: bool(active_runs), kill_timeout)
+            for key in list(active_runs):
+                interrupt(key, signal.SIGKILL)
+            await self._wait(lambda: bool(active_runs), kill_timeout)
+        return interrupted
+
+    async def _wait(self, busy: Callable[[], bool], timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while busy() and time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+
+
+def _run_in_background(func: Callable[..., Any], *args: Any) -> None:
+    # keep a reference to the task, so that it isn't garbage collected before it is
+    # done
+    task = asyncio.ensure_future(run_in_threadpool(func, *args))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,175 @@
+"""Filters applied to the output of runs while it is streamed."""
+
+import collections
+import dataclasses
+import re
+from typing import Deque, Dict, Optional
+
+# CSI sequences (colors, cursor movement), OSC sequences (titles, hyperlinks)
+# terminated by BEL or ST, and two-byte escape sequences
+_ANSI_SEQUENCE = re.compile(
+    rb"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])"
+)
+_INCOMPLETE_SEQUENCE = re.compile(rb"\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?)?")
+
+# longer incomplete sequences are not held back, so that malformed output can't
+# make a stripper buffer without bounds
+MAX_SEQUENCE_LENGTH = 4096
+
+
+@dataclasses.dataclass(frozen=True)
+class OutputPolicy:
+    """
+    A project's policy for the output of its runs.
+
+    If max_bytes is given, the stored output is truncated to at most this many bytes
+    (plus an omission marker): the first head_bytes are kept (by default half of
+    max_bytes) and the remainder is kept from the end of the output.
+    """
+
+    max_bytes: Optional[int] = None
+    head_bytes: Optional[int] = None
+    strip_ansi: bool = False
+
+    def __post_init__(self) -> None:
+        if self.max_bytes is not None and self.max_bytes <= 0:
+            raise ValueError(f"Not a positive size: {self.max_bytes}")
+        if self.head_bytes is None:
+            return
+        if self.max_bytes is None:
+            raise ValueError("A head size requires a maximum size")
+        if not 0 <= self.head_bytes <= self.max_bytes:
+            raise ValueError(
+                f"Not a head size within the maximum size: {self.head_bytes}"
+            )
+
+
+class AnsiStripper:
+    """
+    Remover of ANSI escape sequences from a stream of output.
+
+    An escape sequence may be split across chunks, so an incomplete sequence at the
+    end of a chunk is held back until the next chunk arrives.
+    """
+
+    def __init__(self) -> None:
+        self._pending = b""
+
+    def feed(self, data: bytes) -> bytes:
+        """Return a chunk of output without escape sequences."""
+
+        if self._pending:
+            data = self._pending + data
+            self._pending = b""
+        lower = max(0, len(data) - MAX_SEQUENCE_LENGTH)
+        start = data.rfind(b"\x1b", lower)
+        if start >= 0 and start == len(data) - 1:
+            # a trailing escape may begin the terminator of an OSC sequence
+            previous = data.rfind(b"\x1b", lower, start)
+            if previous >= 0 and _INCOMPLETE_SEQUENCE.fullmatch(data, previous):
+                start = previous
+        if start >= 0 and _INCOMPLETE_SEQUENCE.fullmatch(data, start):
+            self._pending = data[start:]
+            data = data[:start]
+        return _ANSI_SEQUENCE.sub(b"", data)
+
+    def flush(self) -> bytes:
+        """Return the output held back at the end of the stream."""
+
+        pending, self._pending = self._pending, b""
+        return pending
+
+
+class HeadTailTruncator:
+    """
+    Truncator of a stream of output to its head and tail.
+
+    The head is passed through as it arrives, while the tail is held back in memory
+    until the end of the stream, as it is only known then.
+    """
+
+    def __init__(self, max_bytes: int, head_bytes: Optional[int] = None) -> None:
+        self.head_bytes = max_bytes // 2 if head_bytes is None else head_bytes
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.total = 0
+        self._tail: Deque[bytes] = collections.deque()
+        self._tail_size = 0
+
+    def feed(self, data: bytes) -> bytes:
+        """Return the part of a chunk of output to pass through now."""
+
+        head = b""
+        if self.total < self.head_bytes:
+            size = self.head_bytes - self.total
+            head, data = data[:size], data[size:]
+        self.total += len(head) + len(data)
+        if data and self.tail_bytes:
+            self._tail.append(data)
+            self._tail_size += len(data)
+            # drop whole chunks, then trim the oldest remaining one
+            while self._tail_size - len(self._tail[0]) >= self.tail_bytes:
+                self._tail_size -= len(self._tail.popleft())
+            excess = self._tail_size - self.tail_bytes
+            if excess > 0:
+                self._tail[0] = self._tail[0][excess:]
+                self._tail_size -= excess
+        return head
+
+    def finish(self) -> bytes:
+        """Return the tail, preceded by a marker if output was omitted."""
+
+        tail = b"".join(self._tail)
+        self._tail.clear()
+        omitted = self.total - min(self.total, self.head_bytes) - len(tail)
+        if omitted <= 0:
+            return tail
+        return b"\n[... %d bytes omitted ...]\n" % omitted + tail
+
+
+class OutputFilter:
+    """
+    Application of an output policy to the output of a run.
+
+    The output of each stream is stripped separately, as escape sequences don't span
+    streams. The stripped output is what output processors see, and the truncated
+    output is what is stored in the log.
+    """
+
+    def __init__(self, policy: OutputPolicy) -> None:
+        self._strippers: Optional[Dict[str, AnsiStripper]] = (
+            {} if policy.strip_ansi else None
+        )
+        self._truncator = (
+            HeadTailTruncator(policy.max_bytes, policy.head_bytes)
+            if policy.max_bytes is not None
+            else None
+        )
+
+    def strip(self, stream: str, data: bytes) -> bytes:
+        """Return a chunk of a stream's output without escape sequences."""
+
+        if self._strippers is None:
+            return data
+        stripper = self._strippers.get(stream)
+        if stripper is None:
+            stripper = self._strippers[stream] = AnsiStripper()
+        return stripper.feed(data)
+
+    def truncate(self, data: bytes) -> bytes:
+        """Return the part of a chunk of stripped output to store now."""
+
+        if self._truncator is None:
+            return data
+        return self._truncator.feed(data)
+
+    def finish(self) -> bytes:
+        """Return the output to store at the end of the run."""
+
+        remainder = b""
+        if self._strippers is not None:
+            remainder = self.truncate(
+                b"".join(stripper.flush() for stripper in self._strippers.values())
+            )
+        if self._truncator is not None:
+            remainder += self._truncator.finish()
+        return remainder
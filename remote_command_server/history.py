@@ -0,0 +1,174 @@
+"""Recording and pruning of the run history."""
+
+import asyncio
+import logging
+import pathlib
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, logfiles, schemas
+
+logger = logging.getLogger(__name__)
+
+
+class RunRecorder:
+    """
+    Batched writer for the run history.
+
+    Runs are put into a queue by record, which never touches the database. A
+    background thread takes the runs from the queue and writes them in batches of up to
+    batch_size runs, waiting at most flush_interval seconds before writing an
+    incomplete batch.
+
+    If the queue is full (which should only happen if the database is unavailable for
+    some time), new runs are dropped rather than blocking the caller.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10000,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: "queue.Queue[schemas.RunCreate]" = queue.Queue(max_queue_size)
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, run: schemas.RunCreate) -> None:
+        """Add a run to the queue of runs to write."""
+
+        try:
+            self._queue.put_nowait(run)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Run history queue is full, dropping run %s", run.key)
+
+    def start(self) -> None:
+        """Start the background thread writing the runs."""
+
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._work, name="run-recorder", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread, after writing all queued runs."""
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self) -> int:
+        """Write all queued runs and return the number of runs written."""
+
+        written = 0
+        while True:
+            batch = self._take_batch(timeout=None)
+            if not batch:
+                return written
+            self._write(batch)
+            written += len(batch)
+
+    def _work(self) -> None:
+        while not self._stopped.is_set():
+            batch = self._take_batch(timeout=self.flush_interval)
+            if batch:
+                self._write(batch)
+
+    def _take_batch(self, timeout: Optional[float]) -> List[schemas.RunCreate]:
+        # Without a timeout only the runs already in the queue are taken. Otherwise
+        # the method waits up to timeout seconds for the batch to fill up.
+        batch: List[schemas.RunCreate] = []
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[schemas.RunCreate]) -> None:
+        with self._write_lock:
+            db = self.session_factory()
+            try:
+                crud.create_runs(db, batch)
+            except Exception:
+                logger.exception("Could not write %d runs to the database", len(batch))
+            finally:
+                db.close()
+
+
+def prune_runs(
+    session_factory: Callable[[], Session],
+    max_age: timedelta,
+    chunk_size: int,
+    pause: float = 0.1,
+) -> int:
+    """
+    Delete all runs older than max_age.
+
+    The runs are deleted in chunks of chunk_size runs, with a pause (in seconds)
+    between chunks, so that the database is never locked for long. The logs of the
+    runs (and their compressed copies) are removed once the runs are deleted. The
+    total number of deleted runs is returned.
+    """
+
+    before = datetime.utcnow() - max_age
+    total = 0
+    while True:
+        db = session_factory()
+        try:
+            deleted, log_paths = crud.delete_runs_before(
+                db, before=before, chunk_size=chunk_size
+            )
+        finally:
+            db.close()
+        for log_path in log_paths:
+            logfiles.remove(pathlib.Path(log_path))
+        total += deleted
+        if deleted < chunk_size:
+            return total
+        time.sleep(pause)
+
+
+async def retention_loop(
+    session_factory: Callable[[], Session],
+    max_age: timedelta,
+    interval: float,
+    chunk_size: int,
+) -> None:
+    """Prune the run history every interval seconds."""
+
+    while True:
+        try:
+            deleted = await run_in_threadpool(
+                prune_runs, session_factory, max_age=max_age, chunk_size=chunk_size
+            )
+            if deleted:
+                logger.info("Pruned %d runs from the run history", deleted)
+        except Exception:
+            logger.exception("Could not prune the run history")
+        await asyncio.sleep(interval)
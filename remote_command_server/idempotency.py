@@ -0,0 +1,232 @@
+"""Idempotency keys for retried run requests."""
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+
+from remote_command_server import events, util
+from remote_command_server.responses import StaticJSONResponse
+from remote_command_server.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# idempotency keys are chosen by the clients, so their length is limited
+MAX_KEY_LENGTH = 255
+
+
+class StoredResponse:
+    """The response to a request with an idempotency key, until it expires."""
+
+    __slots__ = ("status_code", "body", "expires")
+
+    def __init__(self, status_code: int, body: bytes, expires: float) -> None:
+        self.status_code = status_code
+        self.body = body
+        self.expires = expires
+
+
+class ResponseStore:
+    """
+    SQLite persistence for stored responses.
+
+    New responses are not written on every request. Instead, they are saved
+    periodically and when the server shuts down, and expired responses are deleted at
+    the same time. The responses are loaded when the server starts.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with util.sqlite_connection(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "status_code INTEGER NOT NULL, body BLOB NOT NULL, "
+                "expires REAL NOT NULL)"
+            )
+
+    def load(self, now: float) -> List[Tuple[str, StoredResponse]]:
+        """Load the responses which haven't expired, in the order of their expiry."""
+
+        with util.sqlite_connection(self.path) as connection:
+            rows = connection.execute(
+                "SELECT key, status_code, body, expires FROM responses "
+                "WHERE expires > ? ORDER BY expires",
+                (now,),
+            )
+            return [
+                (key, StoredResponse(status_code, body, expires))
+                for key, status_code, body, expires in rows
+            ]
+
+    def save(self, responses: Iterable[Tuple[str, StoredResponse]], now: float) -> None:
+        """Add new responses, and delete the responses which have expired."""
+
+        with util.sqlite_connection(self.path) as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO responses (key, status_code, body, expires) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (key, response.status_code, response.body, response.expires)
+                    for key, response in responses
+                ),
+            )
+            connection.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+
+
+class IdempotencyTable:
+    """
+    The responses to run requests with idempotency keys.
+
+    The first request with a key is handled as usual, and its response is stored for
+    ttl seconds. A retry with the same key within this time gets the stored response
+    without running the command again; a retry made while the first request is still
+    being handled waits for it and gets the same response. Keys are scoped by project,
+    so that the same key may be used for different projects.
+
+    Responses with the status 503 (such as for interrupted runs) are not stored, so
+    that a retry runs the command again.
+
+    As the time to live is the same for all responses, the table is ordered by expiry,
+    and expired responses are swept from its start. If there are more than max_keys
+    responses, the oldest ones are removed. All methods but save must be called in the
+    event loop.
+    """
+
+    def __init__(
+        self, ttl: float, max_keys: int = 100000, store: Optional[ResponseStore] = None
+    ) -> None:
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.store = store
+        self.requests = 0
+        self.replayed = 0
+        self._responses: Dict[str, StoredResponse] = {}
+        self._unsaved: List[Tuple[str, StoredResponse]] = []
+        self._in_progress: Dict[str, "asyncio.Future[Response]"] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_settings(settings: Settings) -> "IdempotencyTable":
+        """Create the table defined by the settings."""
+
+        store = (
+            ResponseStore(settings.idempotency_database)
+            if settings.idempotency_database
+            else None
+        )
+        return IdempotencyTable(
+            ttl=settings.idempotency_ttl,
+            max_keys=settings.idempotency_max_keys,
+            store=store,
+        )
+
+    async def respond(
+        self, project_name: str, key: str, handle: Callable[[], Awaitable[Response]]
+    ) -> Response:
+        """
+        Return the response to a request with an idempotency key.
+
+        The handle function is only called if there is no response for the key yet.
+        It is run in a task of its own, so that it is not cancelled if the client
+        which made the request goes away.
+        """
+
+        self.requests += 1
+        table_key = f"{project_name}:{key}"
+        stored = self._responses.get(table_key)
+        if stored is not None:
+            if stored.expires > time.time():
+                self.replayed += 1
+                events.event_log.emit("run_replayed", project=project_name)
+                return _replay(stored.status_code, stored.body)
+            del self._responses[table_key]
+
+        in_progress = self._in_progress.get(table_key)
+        if in_progress is not None:
+            self.replayed += 1
+            events.event_log.emit(
+                "run_replayed", project=project_name, in_progress=True
+            )
+            response = await asyncio.shield(in_progress)
+            return _replay(response.status_code, response.body)
+
+        task = asyncio.ensure_future(handle())
+        task.add_done_callback(functools.partial(self._finish, table_key))
+        self._in_progress[table_key] = task
+        return await asyncio.shield(task)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Remove the expired responses, and return their number."""
+
+        now = time.time() if now is None else now
+        expired: List[str] = []
+        for key, stored in self._responses.items():
+            if stored.expires > now:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._responses[key]
+        return len(expired)
+
+    def load(self) -> None:
+        """Load the persisted responses, if there is a store."""
+
+        if self.store is None:
+            return
+        for key, stored in self.store.load(time.time()):
+            self._responses[key] = stored
+
+    def save(self) -> None:
+        """Persist the new responses, if there is a store."""
+
+        if self.store is None:
+            return
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, []
+        self.store.save(unsaved, time.time())
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    def _finish(self, key: str, task: "asyncio.Future[Response]") -> None:
+        del self._in_progress[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        response = task.result()
+        if response.status_code == 503:
+            return
+
+        stored = StoredResponse(
+            response.status_code, response.body, time.time() + self.ttl
+        )
+        # re-inserting the key moves it to the end, which keeps the table ordered
+        self._responses.pop(key, None)
+        self._responses[key] = stored
+        if self.store is not None:
+            with self._lock:
+                self._unsaved.append((key, stored))
+        if len(self._responses) > self.max_keys:
+            self._responses.pop(next(iter(self._responses)))
+
+
+def _replay(status_code: int, body: bytes) -> Response:
+    return StaticJSONResponse(
+        body, status_code=status_code, headers={"Idempotent-Replayed": "true"}
+    )
+
+
+async def sweep_loop(table: IdempotencyTable, interval: float) -> None:
+    """Remove expired responses and persist new ones every interval seconds."""
+
+    while True:
+        await asyncio.sleep(interval)
+        table.sweep()
+        try:
+            await run_in_threadpool(table.save)
+        except Exception:
+            logger.exception("Could not persist the idempotency keys")
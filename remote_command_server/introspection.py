@@ -0,0 +1,140 @@
+"""Snapshots of the server's internal state for admins."""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy.pool import Pool
+
+from remote_command_server import (
+    agents,
+    events,
+    executor,
+    idempotency,
+    schemas,
+    shedding,
+    snapshots,
+)
+
+
+def active_runs() -> List[schemas.ActiveRun]:
+    """
+    Return the runs in progress, including queued runs.
+
+    This must be called in the event loop, which owns the runs and the queue, so that
+    no locks are needed. Counters which are updated by the threads running commands
+    (such as the output bytes) are read without locking, as they may be slightly out
+    of date anyway.
+    """
+
+    now = datetime.utcnow()
+    positions = {
+        queued_run.key: position for queued_run, position in executor.run_queue.queued()
+    }
+    snapshot = []
+    for active_run in list(executor.active_runs.values()):
+        job = active_run.job
+        if job.agent_label is not None or active_run.pid is not None:
+            state = "running"
+        else:
+            state = "queued"
+        snapshot.append(
+            schemas.ActiveRun(
+                run=active_run.key,
+                project=job.project_name,
+                state=state,
+                elapsed=(now - active_run.started_at).total_seconds(),
+                output_bytes=active_run.output_bytes,
+                pid=active_run.pid,
+                queue_position=positions.get(active_run.key),
+                agent_label=job.agent_label,
+                workspace=(
+                    str(active_run.workspace)
+                    if active_run.workspace is not None
+                    else None
+                ),
+            )
+        )
+    return snapshot
+
+
+def server_stats(
+    pool: Pool,
+    auth_gate: Optional[shedding.AuthGate] = None,
+    idempotency_table: Optional[idempotency.IdempotencyTable] = None,
+    snapshot: Optional[snapshots.Snapshot] = None,
+) -> schemas.ServerStats:
+    """
+    Return the utilization of the executor, the state of the database connection
+    pool and the hit ratios of the caches.
+
+    Like active_runs, this must be called in the event loop, and it only reads
+    counters which the hot paths maintain anyway.
+    """
+
+    caches: Dict[str, schemas.CacheStats] = {
+        "spawn_specs": _cache_stats(
+            executor.spawn_specs.hits,
+            executor.spawn_specs.hits + executor.spawn_specs.misses,
+        ),
+        "shared_runs": _cache_stats(
+            executor.shared_runs.shared, executor.shared_runs.requests
+        ),
+    }
+    if auth_gate is not None:
+        caches["auth_negative_cache"] = _cache_stats(
+            auth_gate.negative_cache.hits, auth_gate.negative_cache.lookups
+        )
+    if idempotency_table is not None:
+        caches["idempotency_keys"] = _cache_stats(
+            idempotency_table.replayed, idempotency_table.requests
+        )
+    if snapshot is not None:
+        caches["snapshot"] = _cache_stats(snapshot.hits, snapshot.lookups)
+
+    handler = events.event_log.handler
+    return schemas.ServerStats(
+        executor=_executor_stats(),
+        database_pool=_pool_stats(pool),
+        caches=caches,
+        auth_rejected=auth_gate.rejected if auth_gate is not None else 0,
+        events_dropped=handler.dropped if handler is not None else 0,
+    )
+
+
+def _executor_stats() -> schemas.ExecutorStats:
+    run_queue = executor.run_queue
+    connected_agents = agents.agent_pool.agents()
+    return schemas.ExecutorStats(
+        active=len(executor.active_runs),
+        running=run_queue.running,
+        queued=len(run_queue.queued()),
+        capacity=run_queue.capacity,
+        utilization=(
+            run_queue.running / run_queue.capacity if run_queue.capacity else None
+        ),
+        agents=len(connected_agents),
+        agent_capacity=sum(agent.capacity for agent in connected_agents),
+        agent_active=sum(agent.active for agent in connected_agents),
+    )
+
+
+def _pool_stats(pool: Pool) -> schemas.DatabasePoolStats:
+    # only queue pools have a size; the pools SQLite uses by default don't
+    counters: Dict[str, Optional[int]] = {}
+    for field, method in (
+        ("size", "size"),
+        ("checked_in", "checkedin"),
+        ("checked_out", "checkedout"),
+        ("overflow", "overflow"),
+    ):
+        counter = getattr(pool, method, None)
+        counters[field] = counter() if callable(counter) else None
+    return schemas.DatabasePoolStats(
+        pool=type(pool).__name__, status=pool.status(), **counters
+    )
+
+
+def _cache_stats(hits: int, lookups: int) -> schemas.CacheStats:
+    return schemas.CacheStats(
+        hits=hits, lookups=lookups, hit_ratio=hits / lookups if lookups else None
+    )
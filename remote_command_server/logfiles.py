@@ -0,0 +1,253 @@
+"""Storage and serving of run logs."""
+
+import asyncio
+import gzip
+import os
+import pathlib
+import shutil
+from typing import IO, Callable, Dict, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+# content encodings of precompressed logs, in order of preference
+ENCODINGS: List[Tuple[str, str]] = [("zstd", ".zst"), ("gzip", ".gz")]
+
+CHUNK_SIZE = 65536
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised if a requested byte range cannot be served."""
+
+    pass
+
+
+def log_path(log_directory: pathlib.Path, key: str) -> pathlib.Path:
+    """
+    Return the path of the log file for a run.
+
+    The logs are spread across subdirectories, so that no directory contains too many
+    files.
+    """
+
+    return log_directory / key[:2] / f"{key}.log"
+
+
+class LogWriter:
+    """
+    Writer for the output of a run.
+
+    The output is written unbuffered, so that it can be followed while the run is in
+    progress.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "wb", buffering=0)
+
+    def write(self, data: bytes) -> None:
+        """Write a chunk of output."""
+
+        self._file.write(data)
+
+    def close(self) -> None:
+        """Close the log file."""
+
+        self._file.close()
+
+
+def precompress(path: pathlib.Path) -> None:
+    """
+    Create compressed copies of a log file.
+
+    A gzip copy is always created, a zstd copy only if the zstandard package is
+    installed. The files are compressed in a streaming fashion, and each copy only
+    appears under its final name once it is complete.
+    """
+
+    for encoding, suffix in ENCODINGS:
+        if encoding == "zstd" and zstandard is None:
+            continue
+        compressed_path = path.with_name(path.name + suffix)
+        temporary_path = path.with_name(path.name + suffix + ".tmp")
+        with open(path, "rb") as source, open(temporary_path, "wb") as target:
+            if encoding == "zstd":
+                zstandard.ZstdCompressor().copy_stream(source, target)
+            else:
+                with gzip.GzipFile(fileobj=target, mode="wb") as compressed:
+                    shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+        os.replace(temporary_path, compressed_path)
+
+
+def remove(path: pathlib.Path) -> None:
+    """Remove a log file and its compressed copies, as far as they exist."""
+
+    paths = [path] + [path.with_name(path.name + suffix) for _, suffix in ENCODINGS]
+    for log_file in paths:
+        try:
+            log_file.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def precompressed_variant(
+    path: pathlib.Path, accept_encoding: str
+) -> Optional[Tuple[pathlib.Path, str]]:
+    """
+    Find the preferred precompressed variant of a log file accepted by a client.
+
+    The path and content encoding of the variant are returned, or None if there is no
+    suitable variant.
+    """
+
+    accepted = {
+        part.split(";")[0].strip().lower() for part in accept_encoding.split(",")
+    }
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted:
+            compressed_path = path.with_name(path.name + suffix)
+            if compressed_path.exists():
+                return compressed_path, encoding
+    return None
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse the value of a Range header.
+
+    The first and last byte position (inclusive) are returned. Only single byte ranges
+    are supported, and None is returned for anything else, so that the full content
+    is served instead. A RangeNotSatisfiable is raised if the range lies outside the
+    content.
+    """
+
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # a suffix range, such as "-500" for the last 500 bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+class LogFileResponse(Response):
+    """
+    Response for serving (part of) a log file.
+
+    The file is never loaded fully into memory. If the server supports the ASGI
+    zero-copy send extension, the file is sent with sendfile; otherwise it is read and
+    sent in chunks.
+
+    If a function for checking whether the run is still active is passed, the
+    response follows the file, like tail -f: it keeps sending new output until the run
+    has finished and all output has been sent, or until the client disconnects.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        start: int = 0,
+        end: Optional[int] = None,
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+        media_type: str = "text/plain",
+        is_active: Optional[Callable[[], bool]] = None,
+        follow_interval: float = 0.5,
+    ) -> None:
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.is_active = is_active
+        self.follow_interval = follow_interval
+        self.background = None  # type: ignore
+        self.init_headers(headers)  # type: ignore
+        if is_active is None and end is not None:
+            self.headers["content-length"] = str(end - start + 1)
+        self.headers["accept-ranges"] = "bytes"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as f:
+            if self.is_active is not None:
+                await self._follow(f, receive, send)
+            elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": self.start,
+                        "count": self._length(),
+                    }
+                )
+            else:
+                await self._send_chunks(f, send)
+
+    def _length(self) -> int:
+        end = self.end if self.end is not None else os.stat(self.path).st_size - 1
+        return end - self.start + 1
+
+    async def _send_chunks(self, f: IO[bytes], send: Send) -> None:
+        remaining = self._length()
+        await run_in_threadpool(f.seek, self.start)
+        while remaining > 0:
+            chunk = await run_in_threadpool(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _follow(self, f: IO[bytes], receive: Receive, send: Send) -> None:
+        async def wait_for_disconnect() -> None:
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await run_in_threadpool(f.seek, self.start)
+            while not disconnect.done():
+                # check whether the run is active before reading, so that no output
+                # written just before the run finishes is missed
+                active = self.is_active is not None and self.is_active()
+                chunk = await run_in_threadpool(f.read, CHUNK_SIZE)
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                elif not active:
+                    break
+                else:
+                    await asyncio.wait([disconnect], timeout=self.follow_interval)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnect.cancel()
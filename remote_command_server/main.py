@@ -1,50 +1,831 @@
+import asyncio
+import functools
+import logging
+import math
 import os
 import pathlib
-from typing import Dict, Union
+import signal
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
 
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from remote_command_server import crud, models, schemas, util
-from remote_command_server.database import database_connection
+from remote_command_server import (
+    agents,
+    compression,
+    crud,
+    events,
+    executor,
+    history,
+    idempotency,
+    introspection,
+    logfiles,
+    models,
+    pipeline,
+    queueing,
+    responses,
+    scheduler,
+    schemas,
+    shedding,
+    snapshots,
+    throttling,
+    timing,
+)
+from remote_command_server.database import (
+    DatabaseConnection,
+    database_connection,
+)
+from remote_command_server.settings import get_settings
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(timing.TimingMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
+app.add_exception_handler(StarletteHTTPException, responses.http_exception_handler)
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def get_db() -> Session:  # pragma: no cover
+@functools.lru_cache()
+def get_database_connection() -> DatabaseConnection:  # pragma: no cover
     database_url = os.environ["SQL_ALCHEMY_DATABASE_URL"]
-    LocalSession = database_connection(database_url).LocalSession
-    return LocalSession()
+    return database_connection(database_url)
+
+
+def get_db() -> Session:  # pragma: no cover
+    with timing.phase("get_db"):
+        LocalSession = get_database_connection().LocalSession
+        return LocalSession()
+
+
+def get_run_recorder(request: Request) -> Optional[history.RunRecorder]:
+    return getattr(request.app.state, "run_recorder", None)
+
+
+def get_throttle(request: Request) -> Optional[throttling.Throttle]:
+    return getattr(request.app.state, "throttle", None)
+
+
+def get_idempotency_table(request: Request) -> Optional[idempotency.IdempotencyTable]:
+    return getattr(request.app.state, "idempotency_table", None)
+
+
+def get_auth_gate(request: Request) -> Optional[shedding.AuthGate]:
+    return getattr(request.app.state, "auth_gate", None)
+
+
+def get_snapshot(request: Request) -> Optional[snapshots.Snapshot]:
+    loader = getattr(request.app.state, "snapshot_loader", None)
+    return loader.snapshot if loader is not None else None
+
+
+def get_drainer(request: Request) -> Optional[executor.Drainer]:
+    return getattr(request.app.state, "drainer", None)
+
+
+def check_admin_token(token: str = Depends(oauth_scheme)) -> None:
+    if not crud.verify_admin_token(token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+
+
+def check_accepting_runs(
+    drainer: Optional[executor.Drainer] = Depends(get_drainer),
+) -> None:
+    if drainer is not None and drainer.draining:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The server is shutting down.",
+            headers={"Retry-After": str(get_settings().drain_retry_after)},
+        )
+
+
+def get_client(request: Request) -> str:
+    return str(request.client.host) if request.client else ""
+
+
+async def check_client_rate_limit(
+    client: str = Depends(get_client),
+    throttle: Optional[throttling.Throttle] = Depends(get_throttle),
+) -> None:
+    # This dependency does not access the database, so that clients making too many
+    # requests are rejected before a database session is created.
+    if throttle is None:
+        return
+    retry_after = throttle.check_client(client)
+    if retry_after:
+        events.event_log.emit("rate_limited", client=client)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+async def check_credentials(
+    project_name: str,
+    token: str = Depends(oauth_scheme),
+    client: str = Depends(get_client),
+    gate: Optional[shedding.AuthGate] = Depends(get_auth_gate),
+) -> None:
+    # This dependency does not access the database, so that requests with invalid
+    # credentials can be rejected before a database session is created.
+    if gate is None:
+        return
+    retry_after = gate.retry_after(client)
+    if retry_after:
+        events.event_log.emit("auth_throttled", project=project_name, client=client)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed requests.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    hashed_token = crud.hash_token(token)
+    if gate.rejects(project_name, hashed_token):
+        gate.record_failure(project_name, hashed_token, client)
+        events.event_log.emit(
+            "auth_failed", project=project_name, client=client, shed=True
+        )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
 
 
 def get_project(
-    project_name: str, db: Session = Depends(get_db), token: str = Depends(oauth_scheme)
+    project_name: str,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth_scheme),
+    client: str = Depends(get_client),
+    gate: Optional[shedding.AuthGate] = Depends(get_auth_gate),
+    snapshot: Optional[snapshots.Snapshot] = Depends(get_snapshot),
 ) -> models.Project:
-    if not crud.verify_token(db=db, token=token, project_name=project_name):
+    if snapshot is not None:
+        # projects and tokens created after the snapshot are looked up in the
+        # database
+        with timing.phase("snapshot_lookup"):
+            snapshot_project = snapshot.project(project_name, crud.hash_token(token))
+        if snapshot_project is not None:
+            return snapshot_project
+
+    with timing.phase("verify_token"):
+        verified = crud.verify_token(db=db, token=token, project_name=project_name)
+    if not verified:
+        if gate is not None:
+            gate.record_failure(project_name, crud.hash_token(token), client)
+        events.event_log.emit(
+            "auth_failed", project=project_name, client=client, shed=False
+        )
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
 
-    project: models.Project = (
-        db.query(models.Project).filter(models.Project.name == project_name).first()
-    )
+    with timing.phase("project_query"):
+        project: models.Project = (
+            db.query(models.Project).filter(models.Project.name == project_name).first()
+        )
     return project
 
 
-@app.post("/run/{project_name}", responses={500: {"model": schemas.Message}})
+async def check_rate_limits(
+    project: models.Project = Depends(get_project),
+    token: str = Depends(oauth_scheme),
+    throttle: Optional[throttling.Throttle] = Depends(get_throttle),
+) -> None:
+    # The token and project buckets are only charged once the token has been
+    # verified, so that requests with invalid tokens can't use up a project's
+    # requests.
+    if throttle is None:
+        return
+    retry_after = throttle.check(project.name, crud.hash_token(token))
+    if retry_after:
+        events.event_log.emit("rate_limited", project=project.name)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+@app.on_event("startup")
+async def start_event_log() -> None:  # pragma: no cover
+    events.event_log.start_from_settings(get_settings())
+
+
+@app.on_event("startup")
+async def start_run_queue() -> None:  # pragma: no cover
+    executor.run_queue = queueing.RunQueue.from_settings(get_settings())
+
+
+@app.on_event("startup")
+async def start_run_history() -> None:  # pragma: no cover
+    settings = get_settings()
+    LocalSession = get_database_connection().LocalSession
+    app.state.run_recorder = history.RunRecorder(
+        LocalSession,
+        batch_size=settings.run_history_batch_size,
+        flush_interval=settings.run_history_flush_interval,
+        max_queue_size=settings.run_history_max_queue_size,
+    )
+    app.state.run_recorder.start()
+    app.state.retention_task = asyncio.create_task(
+        history.retention_loop(
+            LocalSession,
+            max_age=timedelta(days=settings.run_retention_days),
+            interval=settings.run_retention_interval,
+            chunk_size=settings.run_retention_chunk_size,
+        )
+    )
+
+
+@app.on_event("startup")
+async def start_throttle() -> None:  # pragma: no cover
+    settings = get_settings()
+    app.state.throttle = throttling.Throttle.from_settings(settings)
+    await run_in_threadpool(app.state.throttle.load)
+    app.state.throttle_persist_task = asyncio.create_task(
+        throttling.persist_loop(
+            app.state.throttle, interval=settings.rate_limit_persist_interval
+        )
+    )
+
+
+@app.on_event("startup")
+async def start_idempotency_table() -> None:  # pragma: no cover
+    settings = get_settings()
+    app.state.idempotency_table = idempotency.IdempotencyTable.from_settings(settings)
+    await run_in_threadpool(app.state.idempotency_table.load)
+    app.state.idempotency_sweep_task = asyncio.create_task(
+        idempotency.sweep_loop(
+            app.state.idempotency_table,
+            interval=settings.idempotency_sweep_interval,
+        )
+    )
+
+
+@app.on_event("startup")
+async def start_auth_gate() -> None:  # pragma: no cover
+    settings = get_settings()
+    app.state.auth_gate = shedding.AuthGate.from_settings(settings)
+    app.state.auth_gate_refresh_task = asyncio.create_task(
+        shedding.refresh_loop(
+            app.state.auth_gate,
+            get_database_connection().LocalSession,
+            interval=settings.auth_filter_refresh_interval,
+        )
+    )
+
+
+@app.on_event("startup")
+async def load_snapshot() -> None:  # pragma: no cover
+    settings = get_settings()
+    if settings.snapshot_file is None:
+        return
+    # the snapshot is loaded by the refresh loop, and until then requests are checked
+    # against the database
+    loader = snapshots.SnapshotLoader(pathlib.Path(settings.snapshot_file))
+    app.state.snapshot_loader = loader
+    app.state.snapshot_refresh_task = asyncio.create_task(
+        snapshots.refresh_loop(
+            loader,
+            get_database_connection().LocalSession,
+            interval=settings.snapshot_check_interval,
+        )
+    )
+
+
+@app.on_event("startup")
+async def start_drainer() -> None:  # pragma: no cover
+    app.state.drainer = executor.Drainer()
+
+    # Uvicorn stops accepting connections as soon as it receives SIGTERM, and then
+    # waits for all runs in progress. So SIGTERM is intercepted to drain the runs
+    # first, while new callers still get a 503 response. Uvicorn is then asked to
+    # shut down with SIGINT. A second SIGTERM stops draining right away.
+    async def drain_and_exit() -> None:
+        settings = get_settings()
+        try:
+            await app.state.drainer.drain(
+                grace_period=settings.drain_grace_period,
+                kill_timeout=settings.drain_kill_timeout,
+                pending=app.state.throttle.debouncer.pending,
+            )
+        finally:
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def handle_sigterm() -> None:
+        if getattr(app.state, "drain_task", None) is None:
+            app.state.drain_task = asyncio.ensure_future(drain_and_exit())
+        else:
+            app.state.drain_task.cancel()
+
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, handle_sigterm)
+
+
+@app.on_event("startup")
+async def start_scheduler() -> None:  # pragma: no cover
+    settings = get_settings()
+
+    async def run_scheduled(job: executor.Job) -> None:
+        if app.state.drainer.draining:
+            return
+        await executor.execute(job, app.state.run_recorder)
+
+    app.state.scheduler = scheduler.Scheduler(
+        get_database_connection().LocalSession, run_scheduled
+    )
+    app.state.scheduler_task = asyncio.create_task(
+        scheduler.schedule_loop(
+            app.state.scheduler, reload_interval=settings.schedule_reload_interval
+        )
+    )
+
+
+@app.on_event("shutdown")
+async def stop_auth_gate() -> None:  # pragma: no cover
+    app.state.auth_gate_refresh_task.cancel()
+
+
+@app.on_event("shutdown")
+async def unload_snapshot() -> None:  # pragma: no cover
+    loader = getattr(app.state, "snapshot_loader", None)
+    if loader is not None:
+        app.state.snapshot_refresh_task.cancel()
+        loader.close()
+
+
+@app.on_event("shutdown")
+async def stop_scheduler() -> None:  # pragma: no cover
+    app.state.scheduler_task.cancel()
+
+
+@app.on_event("shutdown")
+async def stop_run_history() -> None:  # pragma: no cover
+    app.state.retention_task.cancel()
+    app.state.run_recorder.stop()
+
+
+@app.on_event("shutdown")
+async def stop_throttle() -> None:  # pragma: no cover
+    app.state.throttle_persist_task.cancel()
+    await run_in_threadpool(app.state.throttle.save)
+
+
+@app.on_event("shutdown")
+async def stop_idempotency_table() -> None:  # pragma: no cover
+    app.state.idempotency_sweep_task.cancel()
+    await run_in_threadpool(app.state.idempotency_table.save)
+
+
+@app.on_event("shutdown")
+async def stop_run_queue() -> None:  # pragma: no cover
+    executor.run_queue.close()
+
+
+@app.on_event("shutdown")
+async def stop_event_log() -> None:  # pragma: no cover
+    await run_in_threadpool(events.event_log.stop)
+
+
+@app.post(
+    "/run/{project_name}",
+    dependencies=[
+        Depends(check_accepting_runs),
+        Depends(check_client_rate_limit),
+        Depends(check_credentials),
+        Depends(check_rate_limits),
+    ],
+    responses={
+        200: {"model": schemas.RunSuccess},
+        202: {"model": schemas.Message},
+        400: {"model": schemas.Message},
+        429: {"model": schemas.Message},
+        500: {"model": schemas.RunMessage},
+        503: {"model": schemas.Message},
+    },
+)
 async def run(
     project: models.Project = Depends(get_project),
-) -> Union[Dict[str, bool], JSONResponse]:
+    recorder: Optional[history.RunRecorder] = Depends(get_run_recorder),
+    throttle: Optional[throttling.Throttle] = Depends(get_throttle),
+    idempotency_table: Optional[idempotency.IdempotencyTable] = Depends(
+        get_idempotency_table
+    ),
+    idempotency_key: Optional[str] = Header(None),
+) -> Response:
+    """
+    Run a project's command.
+
+    If the request has an Idempotency-Key header, a retry with the same key gets the
+    response to the first request, without running the command again.
+    """
+
+    # The responses are returned directly, with precomputed bodies, so that they are
+    # neither validated nor encoded by FastAPI.
+
+    job = executor.Job.from_project(project)
+    debounce_window = project.debounce_window
+
+    async def handle() -> Response:
+        if debounce_window and throttle is not None:
+
+            async def run_debounced(job: executor.Job) -> None:
+                await executor.execute(job, recorder)
+
+            throttle.debouncer.trigger(job, debounce_window, run_debounced)
+            events.event_log.emit("run_debounced", project=job.project_name)
+            return responses.run_scheduled()
+
+        try:
+            result = await executor.execute(job, recorder)
+        except agents.NoAgentAvailable:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="No agent is available for running the command.",
+            )
+        if result.interrupted:
+            return ORJSONResponse(
+                content={"message": "The run was interrupted.", "run": result.key},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(get_settings().drain_retry_after)},
+            )
+        if result.returncode:
+            return responses.run_failed(result.key, result.output)
+
+        return responses.run_succeeded(result.key, result.output)
+
+    if idempotency_key is None or idempotency_table is None:
+        return await handle()
+    if not idempotency_key or len(idempotency_key) > idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The idempotency key must have 1 to "
+            f"{idempotency.MAX_KEY_LENGTH} characters.",
+        )
+    return await idempotency_table.respond(job.project_name, idempotency_key, handle)
+
+
+def get_pipeline(
+    project: models.Project = Depends(get_project), db: Session = Depends(get_db)
+) -> pipeline.Pipeline:
+    try:
+        return pipeline.Pipeline.for_project(db, project)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+
+@app.post(
+    "/pipeline/{project_name}",
+    dependencies=[
+        Depends(check_accepting_runs),
+        Depends(check_client_rate_limit),
+        Depends(check_credentials),
+        Depends(check_rate_limits),
+    ],
+    response_model=schemas.PipelineResult,
+    responses={
+        429: {"model": schemas.Message},
+        500: {"model": schemas.PipelineResult},
+        503: {"model": schemas.PipelineResult},
+    },
+)
+async def run_pipeline(
+    project_pipeline: pipeline.Pipeline = Depends(get_pipeline),
+    recorder: Optional[history.RunRecorder] = Depends(get_run_recorder),
+) -> Union[schemas.PipelineResult, ORJSONResponse]:
+    """
+    Run a project after all the projects it depends on.
+
+    Projects which don't depend on each other are run in parallel. If a project's
+    command fails, the projects depending on it are skipped. The response lists the
+    results of all steps; its status is 500 if any step has failed or has been
+    skipped.
+    """
+
+    async def execute(job: executor.Job) -> executor.RunResult:
+        return await executor.execute(job, recorder)
+
+    steps = await project_pipeline.run(execute)
+    result = schemas.PipelineResult(
+        success=all(step.status == pipeline.StepStatus.SUCCEEDED for step in steps),
+        steps=[
+            schemas.PipelineStep(
+                project=step.project_name,
+                status=step.status.value,
+                run=step.result.key if step.result else None,
+                exit_code=step.result.returncode if step.result else None,
+                output=(step.result.output or None) if step.result else None,
+            )
+            for step in steps
+        ],
+    )
+    if result.success:
+        return result
+
+    if any(step.status == pipeline.StepStatus.INTERRUPTED for step in steps):
+        return ORJSONResponse(
+            content=result.dict(),
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(get_settings().drain_retry_after)},
+        )
+    return ORJSONResponse(
+        content=result.dict(), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+    )
+
+
+@app.websocket("/agents/connect")
+async def agent_connection(websocket: WebSocket) -> None:
+    """
+    Connection of an agent.
+
+    The agent must authenticate with the agent token. Its first message must
+    introduce it with its name, labels and capacity; afterwards it receives runs to
+    execute and sends their output and results.
+    """
+
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not crud.verify_agent_token(token):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    # receive_json raises a KeyError for binary messages
+    try:
+        hello = schemas.AgentHello.parse_obj(await websocket.receive_json())
+    except (KeyError, ValueError) as e:
+        events.event_log.emit("agent_rejected", level=logging.WARNING, reason=str(e))
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    agent = agents.Agent(
+        name=hello.name,
+        labels=frozenset(hello.labels),
+        capacity=max(hello.capacity, 1),
+        send=websocket.send_json,
+    )
+    agents.agent_pool.register(agent)
+    try:
+        while True:
+            agents.agent_pool.handle_message(agent, await websocket.receive_json())
+    except WebSocketDisconnect:
+        pass
+    except (KeyError, ValueError) as e:
+        events.event_log.emit(
+            "agent_rejected", level=logging.WARNING, agent=agent.name, reason=str(e)
+        )
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    finally:
+        agents.agent_pool.unregister(agent)
+
+
+@app.post(
+    "/admin/drain",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=schemas.Message,
+    responses={503: {"model": schemas.Message}},
+)
+def drain(
+    _: None = Depends(check_admin_token),
+    drainer: Optional[executor.Drainer] = Depends(get_drainer),
+) -> Dict[str, str]:
+    """
+    Stop admitting new runs.
+
+    From now on the /run endpoint returns a 503 response. Runs in progress are not
+    affected. This is useful before stopping the server, for example in a pre-stop hook.
+    """
+
+    if drainer is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Draining is not available.",
+        )
+    drainer.start()
+    return {"message": f"Draining {len(executor.active_runs)} runs in progress."}
+
+
+@app.get(
+    "/admin/runs",
+    dependencies=[Depends(check_admin_token)],
+    response_model=List[schemas.ActiveRun],
+)
+async def admin_runs() -> List[schemas.ActiveRun]:
+    """
+    Get the runs in progress of all projects, including queued runs.
+
+    Queued runs have their position in the run queue; running commands have the
+    process id of their process group, unless they run on an agent.
+    """
+
+    return introspection.active_runs()
+
+
+@app.post(
+    "/admin/runs/{run_key}/interrupt",
+    dependencies=[Depends(check_admin_token)],
+    response_model=schemas.Message,
+    responses={404: {"model": schemas.Message}},
+)
+async def admin_interrupt(run_key: str, kill: bool = False) -> Dict[str, str]:
+    """
+    Interrupt a run in progress.
+
+    The command is sent SIGTERM, or SIGKILL if kill is true. A queued run is taken out
+    of the queue without running its command. The run is recorded as interrupted.
+    """
+
+    if not executor.interrupt(run_key, signal.SIGKILL if kill else signal.SIGTERM):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No such run in progress."
+        )
+    return {"message": f"Interrupted run {run_key}."}
+
+
+@app.get(
+    "/admin/stats",
+    dependencies=[Depends(check_admin_token)],
+    response_model=schemas.ServerStats,
+)
+async def admin_stats(
+    db: Session = Depends(get_db),
+    auth_gate: Optional[shedding.AuthGate] = Depends(get_auth_gate),
+    idempotency_table: Optional[idempotency.IdempotencyTable] = Depends(
+        get_idempotency_table
+    ),
+    snapshot: Optional[snapshots.Snapshot] = Depends(get_snapshot),
+) -> schemas.ServerStats:
+    """
+    Get the utilization of the executor, the state of the database connection pool
+    and the hit ratios of the server's caches.
+
+    The hit ratio of the shared runs is the fraction of requests which got the result
+    of another run, and that of the idempotency keys is the fraction of requests with
+    a key which got a stored response. The hit ratio of the snapshot is the fraction
+    of project lookups answered without querying the database.
+    """
+
+    return introspection.server_stats(
+        db.get_bind().pool,
+        auth_gate=auth_gate,
+        idempotency_table=idempotency_table,
+        snapshot=snapshot,
+    )
+
+
+@app.get(
+    "/projects/{project_name}/runs",
+    dependencies=[Depends(check_credentials)],
+    response_model=List[schemas.Run],
+)
+def runs(
+    since: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    project: models.Project = Depends(get_project),
+    db: Session = Depends(get_db),
+) -> List[models.Run]:
+    """
+    Get the most recent runs of a project.
 
-    completed_process = util.run_command(
-        directory=pathlib.Path(project.directory), command=project.command
+    Runs are written to the database in batches, so a run may only be listed a second
+    or so after it has finished.
+    """
+
+    return crud.get_runs(db, project_id=project.id, since=since, limit=limit)
+
+
+@app.get(
+    "/projects/{project_name}/queue",
+    dependencies=[Depends(check_credentials)],
+    response_model=schemas.QueueStatus,
+)
+async def queue(
+    project: models.Project = Depends(get_project),
+) -> schemas.QueueStatus:
+    """
+    Get the runs of a project which are waiting for an execution slot.
+
+    The position of a run is the number of runs of all projects which will be started
+    before it. The number of running commands includes all projects.
+    """
+
+    run_queue = executor.run_queue
+    now = time.monotonic()
+    return schemas.QueueStatus(
+        running=run_queue.running,
+        capacity=run_queue.capacity,
+        queued=[
+            schemas.QueuedRun(
+                run=queued_run.key,
+                position=position,
+                waiting=now - queued_run.enqueued_at,
+            )
+            for queued_run, position in run_queue.queued()
+            if queued_run.flow == project.id
+        ],
     )
-    if completed_process.returncode:
-        return JSONResponse(
-            content={"message": "Command returned with a non-zero return code."},
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+
+
+def get_log_file(
+    run_key: str, db: Session = Depends(get_db), token: str = Depends(oauth_scheme)
+) -> Tuple[pathlib.Path, bool]:
+    """Get the log file of a run, and whether the run is still in progress."""
+
+    active_run = executor.active_runs.get(run_key)
+    if active_run is not None:
+        project_name = active_run.job.project_name
+        log_path = active_run.log_path
+    else:
+        db_run = crud.get_run(db, run_key)
+        if db_run is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        project_name = db_run.project.name
+        log_path = pathlib.Path(db_run.log_path) if db_run.log_path else None
+
+    if not crud.verify_token(db=db, token=token, project_name=project_name):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    if log_path is None or not log_path.exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No log for this run."
+        )
+    return log_path, active_run is not None
+
+
+@app.get(
+    "/runs/{run_key}/log",
+    response_class=Response,
+    responses={
+        200: {"content": {"text/plain": {}}},
+        206: {"content": {"text/plain": {}}},
+        404: {"model": schemas.Message},
+        416: {"model": schemas.Message},
+    },
+)
+def run_log(
+    request: Request,
+    run_key: str,
+    follow: bool = False,
+    offset: int = Query(0, ge=0),
+    log_file: Tuple[pathlib.Path, bool] = Depends(get_log_file),
+) -> Response:
+    """
+    Get the output of a run.
+
+    Single byte ranges can be requested with a Range header. If the client accepts
+    zstd or gzip encoding, a precompressed log is returned, if available.
+
+    If follow is true and the run is still in progress, the output is streamed, like
+    with tail -f, until the run has finished. In this case output before the offset is
+    skipped.
+    """
+
+    path, active = log_file
+    if follow and active:
+        return logfiles.LogFileResponse(
+            path,
+            start=offset,
+            is_active=lambda: run_key in executor.active_runs,
+            follow_interval=get_settings().log_follow_interval,
         )
 
-    return {"success": True}
+    size = path.stat().st_size
+    range_header = request.headers.get("range")
+    if range_header:
+        try:
+            byte_range = logfiles.parse_range(range_header, size)
+        except logfiles.RangeNotSatisfiable:
+            return ORJSONResponse(
+                content={"message": "Range not satisfiable."},
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={"Content-Range": f"bytes */{size}"},
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            return logfiles.LogFileResponse(
+                path,
+                start=start,
+                end=end,
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                headers={"Content-Range": f"bytes {start}-{end}/{size}"},
+            )
+
+    headers = {"Vary": "Accept-Encoding"}
+    variant = (
+        logfiles.precompressed_variant(path, request.headers.get("accept-encoding", ""))
+        if not active
+        else None
+    )
+    if variant is not None:
+        path, encoding = variant
+        size = path.stat().st_size
+        headers["Content-Encoding"] = encoding
+    return logfiles.LogFileResponse(path, start=0, end=size - 1, headers=headers)
@@ -0,0 +1,72 @@
+"""Upgrades of databases created by earlier versions of the server."""
+
+from typing import List
+
+from sqlalchemy import Column, inspect, literal, text
+from sqlalchemy.engine import Engine
+
+from remote_command_server import models
+
+# Columns are only ever added, so that upgrading does not need to copy tables (which
+# SQLite requires for most other changes).
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """
+    Bring the schema of a database up to date with the models.
+
+    Missing tables and indexes are created, and missing columns are added to existing
+    tables. Existing columns are left unchanged. Descriptions of the changes are
+    returned, so that upgrading a database which is up to date returns an empty
+    list. A ValueError is raised if a missing column cannot be added, as it is not
+    nullable and has no default.
+    """
+
+    changes: List[str] = []
+    # all models share the metadata of their declarative base
+    metadata = models.Project.metadata
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(bind=connection)
+                changes.append(f"Created table {table.name}")
+                continue
+
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    connection.execute(
+                        text(
+                            f'ALTER TABLE "{table.name}" ADD COLUMN '
+                            f"{_column_definition(column, engine)}"
+                        )
+                    )
+                    changes.append(f"Added column {table.name}.{column.name}")
+
+            existing_indexes = {
+                index["name"] for index in inspector.get_indexes(table.name)
+            }
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=connection)
+                    changes.append(f"Created index {index.name}")
+    return changes
+
+
+def _column_definition(column: Column, engine: Engine) -> str:
+    definition = f'"{column.name}" {column.type.compile(dialect=engine.dialect)}'
+    if column.nullable:
+        return definition
+    if column.default is None or not column.default.is_scalar:
+        raise ValueError(
+            f"Cannot add the column {column.table.name}.{column.name}, as it is "
+            "not nullable and has no default"
+        )
+    default = literal(column.default.arg).compile(
+        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+    )
+    return f"{definition} NOT NULL DEFAULT {default}"
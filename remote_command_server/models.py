@@ -1,11 +1,42 @@
 """SQL Alchemy models."""
 
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    JSON,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+)
 from sqlalchemy.orm import relationship
 
 from remote_command_server.database import Base
 
+# dependency edges between projects; a project is run after its dependencies in a
+# pipeline
+project_dependencies = Table(
+    "project_dependencies",
+    Base.metadata,
+    Column(
+        "project_id",
+        Integer,
+        ForeignKey("projects.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "dependency_id",
+        Integer,
+        ForeignKey("projects.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    ),
+)
+
 
 class Project(Base):
     """A project with a command to run in a directory."""
@@ -16,8 +47,33 @@ class Project(Base):
     command = Column(String, nullable=False)
     directory = Column(String, nullable=False)
     name = Column(String, nullable=False, unique=True, index=True)
+    debounce_window = Column(Float, nullable=True)
+    environment = Column(JSON, nullable=True)
+    path = Column(String, nullable=True)
+    umask = Column(Integer, nullable=True)
+    cpu_time_limit = Column(Integer, nullable=True)
+    memory_limit = Column(Integer, nullable=True)
+    open_files_limit = Column(Integer, nullable=True)
+    schedule = Column(String, nullable=True)
+    last_scheduled_run = Column(DateTime, nullable=True)
+    agent_label = Column(String, nullable=True)
+    share_window = Column(Float, nullable=True)
+    priority = Column(Integer, nullable=True)
+    workspaces = Column(Integer, nullable=True)
+    workspace_method = Column(String, nullable=True)
+    output_processors = Column(JSON, nullable=True)
+    output_max_bytes = Column(Integer, nullable=True)
+    output_head_bytes = Column(Integer, nullable=True)
+    strip_ansi = Column(Boolean, nullable=True)
 
     tokens = relationship("Token", back_populates="project")
+    runs = relationship("Run", back_populates="project", passive_deletes=True)
+    dependencies = relationship(
+        "Project",
+        secondary=project_dependencies,
+        primaryjoin=id == project_dependencies.c.project_id,
+        secondaryjoin=id == project_dependencies.c.dependency_id,
+    )
 
 
 class Token(Base):
@@ -30,3 +86,47 @@ class Token(Base):
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
 
     project = relationship("Project", back_populates="tokens")
+
+
+class CredentialsVersion(Base):
+    """
+    The version of the projects and tokens.
+
+    The table has a single row, whose version is increased in every transaction which
+    adds, changes or removes a project or token, so that servers can tell cheaply
+    whether their snapshot and filters are up to date.
+    """
+
+    __tablename__ = "credentials_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class Run(Base):
+    """A run of a project's command."""
+
+    __tablename__ = "runs"
+    __table_args__ = (
+        Index("ix_runs_project_id_started_at", "project_id", "started_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, nullable=False, unique=True, index=True)
+    project_id = Column(
+        Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False
+    )
+    started_at = Column(DateTime, nullable=False, index=True)
+    finished_at = Column(DateTime, nullable=False)
+    exit_code = Column(Integer, nullable=False)
+    duration = Column(Float, nullable=False)
+    output_size = Column(Integer, nullable=False)
+    log_path = Column(String, nullable=True)
+    user_cpu = Column(Float, nullable=True)
+    system_cpu = Column(Float, nullable=True)
+    max_rss = Column(Integer, nullable=True)
+    io_read_bytes = Column(Integer, nullable=True)
+    io_write_bytes = Column(Integer, nullable=True)
+    interrupted = Column(Boolean, nullable=False, default=False)
+
+    project = relationship("Project", back_populates="runs")
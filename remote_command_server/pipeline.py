@@ -0,0 +1,137 @@
+"""Pipelines of projects depending on each other."""
+
+import asyncio
+import dataclasses
+import enum
+import logging
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+)
+
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models
+from remote_command_server.executor import Job, RunResult
+
+logger = logging.getLogger(__name__)
+
+
+class StepStatus(str, enum.Enum):
+    """The status of a pipeline step."""
+
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    INTERRUPTED = "interrupted"
+    SKIPPED = "skipped"
+
+
+@dataclasses.dataclass(frozen=True)
+class StepResult:
+    """The result of a pipeline step."""
+
+    project_name: str
+    status: StepStatus
+    result: Optional[RunResult] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class Pipeline:
+    """
+    A project together with all the projects it depends on.
+
+    The jobs are keyed by project id, and the dependencies map each project id to the
+    ids of the projects it depends on directly. The order lists the project ids in a
+    topological order, so that every project comes after its dependencies.
+    """
+
+    jobs: Dict[int, Job]
+    dependencies: Dict[int, FrozenSet[int]]
+    order: Sequence[int]
+
+    @staticmethod
+    def for_project(db: Session, project: models.Project) -> "Pipeline":
+        """
+        Create the pipeline for a project.
+
+        A ValueError is raised if the dependencies contain a cycle.
+        """
+
+        projects, edges = crud.get_dependency_graph(db, project)
+        dependencies: Dict[int, FrozenSet[int]] = {p.id: frozenset() for p in projects}
+        for project_id, dependency_id in edges:
+            dependencies[project_id] |= {dependency_id}
+        return Pipeline(
+            jobs={p.id: Job.from_project(p) for p in projects},
+            dependencies=dependencies,
+            order=_topological_order(dependencies),
+        )
+
+    async def run(
+        self, execute: Callable[[Job], Awaitable[RunResult]]
+    ) -> List[StepResult]:
+        """
+        Run the pipeline.
+
+        Every step is started as soon as all its dependencies have succeeded, so that
+        independent branches run in parallel. If a step fails, all steps depending on
+        it (directly or indirectly) are skipped, but independent branches still run.
+        A step whose command cannot be run at all counts as failed.
+
+        The step results are returned in the pipeline's topological order.
+        """
+
+        steps: Dict[int, "asyncio.Future[StepResult]"] = {}
+
+        async def run_step(project_id: int) -> StepResult:
+            job = self.jobs[project_id]
+            upstream = await asyncio.gather(
+                *(steps[d] for d in self.dependencies[project_id])
+            )
+            if any(step.status != StepStatus.SUCCEEDED for step in upstream):
+                return StepResult(job.project_name, StepStatus.SKIPPED)
+            try:
+                result = await execute(job)
+            except Exception:
+                logger.exception("Pipeline step %s failed", job.project_name)
+                return StepResult(job.project_name, StepStatus.FAILED)
+            if result.interrupted:
+                status = StepStatus.INTERRUPTED
+            elif result.returncode:
+                status = StepStatus.FAILED
+            else:
+                status = StepStatus.SUCCEEDED
+            return StepResult(job.project_name, status, result)
+
+        for project_id in self.order:
+            steps[project_id] = asyncio.ensure_future(run_step(project_id))
+        try:
+            return list(await asyncio.gather(*(steps[p] for p in self.order)))
+        finally:
+            for step in steps.values():
+                step.cancel()
+
+
+def _topological_order(dependencies: Dict[int, FrozenSet[int]]) -> List[int]:
+    # Kahn's algorithm; project ids are sorted to make the order deterministic
+    remaining = {p: set(d) for p, d in dependencies.items()}
+    order: List[int] = []
+    ready = sorted(p for p, d in remaining.items() if not d)
+    while ready:
+        project_id = ready.pop(0)
+        order.append(project_id)
+        del remaining[project_id]
+        for other, other_dependencies in remaining.items():
+            if project_id in other_dependencies:
+                other_dependencies.remove(project_id)
+                if not other_dependencies:
+                    ready.append(other)
+        ready.sort()
+    if remaining:
+        raise ValueError("The project dependencies contain a cycle")
+    return order
@@ -0,0 +1,255 @@
+"""Streaming processors extracting information from a command's output."""
+
+import abc
+import collections
+import dataclasses
+import re
+from typing import Any, Deque, Dict, Iterable, List, Optional, Pattern
+
+import orjson
+
+# longer lines are truncated, so that processors need constant memory
+MAX_LINE_LENGTH = 4096
+
+# a tail keeps at most this many lines, so that it needs constant memory as well
+MAX_TAIL_LINES = 1000
+
+_ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcessorSpec:
+    """
+    The definition of an output processor.
+
+    The type is one of
+
+    * "regex": the last match of the pattern in a line is stored under the name. For a
+      pattern with named groups, the value is a dictionary of the groups; for a pattern
+      with a single group, it is the group; otherwise it is the matching text.
+    * "junit": the numbers of tests, failures, errors and skipped tests are added up
+      over all testsuite elements of JUnit XML output.
+    * "json": the last line which is a JSON object is stored.
+    * "tail": the last lines lines are stored, at most MAX_TAIL_LINES.
+    """
+
+    type: str
+    name: Optional[str] = None
+    pattern: Optional[str] = None
+    lines: Optional[int] = None
+
+    @staticmethod
+    def from_dict(spec: Dict[str, Any]) -> "ProcessorSpec":
+        """
+        Create a processor definition from a dictionary, as stored for a project.
+
+        A ValueError is raised if the definition is invalid.
+        """
+
+        processor_spec = ProcessorSpec(
+            type=spec.get("type", ""),
+            name=spec.get("name"),
+            pattern=spec.get("pattern"),
+            lines=spec.get("lines"),
+        )
+        processor_spec.create()
+        return processor_spec
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the definition into a dictionary, omitting unset fields."""
+
+        return {
+            key: value
+            for key, value in dataclasses.asdict(self).items()
+            if value is not None
+        }
+
+    def create(self) -> "OutputProcessor":
+        """
+        Create a processor for a run.
+
+        A ValueError is raised if the definition is invalid.
+        """
+
+        if self.type == "regex":
+            if not self.name or not self.pattern:
+                raise ValueError("A regex processor requires a name and a pattern")
+            try:
+                return RegexExtractor(self.name, re.compile(self.pattern))
+            except re.error as e:
+                raise ValueError(f"Invalid pattern {self.pattern}: {e}")
+        if self.type == "junit":
+            return JUnitSummary()
+        if self.type == "json":
+            return JSONSummary()
+        if self.type == "tail":
+            if self.lines is None or self.lines < 1:
+                raise ValueError("A tail processor requires a positive number of lines")
+            return TailSummary(self.lines)
+        raise ValueError(f"Unknown output processor type: {self.type}")
+
+
+class OutputProcessor(abc.ABC):
+    """
+    Base class for processors of a command's output.
+
+    The output is fed in chunks as it arrives. It is split into lines, with separate
+    buffers for stdout and stderr, and every line is passed to process_line. Lines
+    longer than MAX_LINE_LENGTH characters are truncated.
+    """
+
+    def __init__(self) -> None:
+        self._buffers: Dict[str, bytearray] = {}
+
+    def feed(self, stream: str, data: bytes) -> None:
+        """Process a chunk of output."""
+
+        buffer = self._buffers.setdefault(stream, bytearray())
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end == -1:
+                break
+            self._append(buffer, data[start:end])
+            self._process(stream, buffer)
+            buffer.clear()
+            start = end + 1
+        self._append(buffer, data[start:])
+
+    def close(self) -> None:
+        """Process the last lines if they don't end with a newline."""
+
+        for stream, buffer in self._buffers.items():
+            if buffer:
+                self._process(stream, buffer)
+                buffer.clear()
+
+    @abc.abstractmethod
+    def process_line(self, stream: str, line: str) -> None:
+        """Process a line of output."""
+
+    @abc.abstractmethod
+    def result(self) -> Dict[str, Any]:
+        """Return the extracted fields."""
+
+    def _append(self, buffer: bytearray, data: bytes) -> None:
+        buffer += data[: max(MAX_LINE_LENGTH - len(buffer), 0)]
+
+    def _process(self, stream: str, buffer: bytearray) -> None:
+        line = buffer.decode("UTF-8", errors="replace").rstrip("\r")
+        self.process_line(stream, line)
+
+
+class RegexExtractor(OutputProcessor):
+    """Processor storing the last match of a regular expression."""
+
+    def __init__(self, name: str, pattern: Pattern[str]) -> None:
+        super().__init__()
+        self.name = name
+        self.pattern = pattern
+        self._value: Any = None
+        self._matched = False
+
+    def process_line(self, stream: str, line: str) -> None:
+        match = self.pattern.search(line)
+        if match is None:
+            return
+        if self.pattern.groupindex:
+            self._value = match.groupdict()
+        elif self.pattern.groups == 1:
+            self._value = match.group(1)
+        else:
+            self._value = match.group(0)
+        self._matched = True
+
+    def result(self) -> Dict[str, Any]:
+        return {self.name: self._value} if self._matched else {}
+
+
+class JUnitSummary(OutputProcessor):
+    """Processor adding up the test counts of JUnit XML testsuite elements."""
+
+    _TESTSUITE = re.compile(r"<testsuite\s([^>]*)>")
+    _COUNTS = ("tests", "failures", "errors", "skipped")
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._counts: Optional[Dict[str, int]] = None
+
+    def process_line(self, stream: str, line: str) -> None:
+        for match in self._TESTSUITE.finditer(line):
+            attributes = dict(_ATTRIBUTE.findall(match.group(1)))
+            if self._counts is None:
+                self._counts = dict.fromkeys(self._COUNTS, 0)
+            for name in self._COUNTS:
+                try:
+                    self._counts[name] += int(attributes.get(name, 0))
+                except ValueError:
+                    pass
+
+    def result(self) -> Dict[str, Any]:
+        return {"junit": self._counts} if self._counts is not None else {}
+
+
+class JSONSummary(OutputProcessor):
+    """
+    Processor storing the last line which is a JSON object.
+
+    Lines are parsed with orjson, so that the stored object can always be encoded in
+    responses: integers beyond 64 bits are parsed as floats, and NaN and infinities
+    are rejected.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._value: Optional[Dict[str, Any]] = None
+
+    def process_line(self, stream: str, line: str) -> None:
+        line = line.strip()
+        if not (line.startswith("{") and line.endswith("}")):
+            return
+        try:
+            value = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            return
+        if isinstance(value, dict):
+            self._value = value
+
+    def result(self) -> Dict[str, Any]:
+        return {"json": self._value} if self._value is not None else {}
+
+
+class TailSummary(OutputProcessor):
+    """
+    Processor storing the last lines of the output.
+
+    Like for all processors, the lines are truncated to MAX_LINE_LENGTH characters
+    while they are buffered, and at most MAX_TAIL_LINES lines are kept, so that the
+    tail's memory is bounded however long and many the lines of the output are.
+    """
+
+    def __init__(self, lines: int) -> None:
+        super().__init__()
+        self._lines: Deque[str] = collections.deque(maxlen=min(lines, MAX_TAIL_LINES))
+
+    def process_line(self, stream: str, line: str) -> None:
+        self._lines.append(line)
+
+    def result(self) -> Dict[str, Any]:
+        return {"tail": list(self._lines)}
+
+
+def create_all(specs: Iterable[ProcessorSpec]) -> List[OutputProcessor]:
+    """Create the processors for a run."""
+
+    return [spec.create() for spec in specs]
+
+
+def results(processors: Iterable[OutputProcessor]) -> Dict[str, Any]:
+    """Close processors and merge their extracted fields."""
+
+    fields: Dict[str, Any] = {}
+    for processor in processors:
+        processor.close()
+        fields.update(processor.result())
+    return fields
@@ -0,0 +1,220 @@
+"""Fair queueing of runs across projects."""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import heapq
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from remote_command_server.settings import Settings
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass(eq=False)
+class QueuedRun:
+    """A run waiting for an execution slot."""
+
+    key: str
+    flow: int
+    priority: int
+    finish_tag: float
+    sequence: int
+    enqueued_at: float
+    granted: "asyncio.Future[None]"
+
+    @property
+    def waiting(self) -> bool:
+        return not self.granted.done()
+
+
+class RunQueue:
+    """
+    Weighted fair queue of runs waiting for one of capacity execution slots.
+
+    Every project is a flow with weight 2 ** priority, and runs are served in the order
+    of their virtual finish times (self-clocked fair queueing). A project which keeps
+    requesting runs thus gets its share of the slots, but cannot make other projects
+    wait behind all its runs: a run of a project with nothing queued is served after
+    at most one run of every other project with the same priority. A project whose
+    priority is higher by one gets twice as many slots under contention.
+
+    To protect low-priority projects from starvation, a run which has been waiting
+    for more than max_wait seconds is served before all other runs.
+
+    The commands are run on a thread pool of their own with a thread per slot, so
+    that a run holding a slot never waits for a thread, and that running commands
+    can't take all threads of the default pool (which serves the endpoints' blocking
+    work). A capacity of zero means that there is no limit, so that runs never wait
+    and commands are run on the default pool. All methods must be called in the event
+    loop.
+    """
+
+    def __init__(self, capacity: int, max_wait: float = 60) -> None:
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.running = 0
+        self._virtual_time = 0.0
+        self._finish_tags: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int, QueuedRun]] = []
+        self._arrivals: Deque[QueuedRun] = collections.deque()
+        self._sequence = itertools.count()
+        self._pool = (
+            ThreadPoolExecutor(max_workers=capacity, thread_name_prefix="rcs-run")
+            if capacity
+            else None
+        )
+
+    @staticmethod
+    def from_settings(settings: Settings) -> "RunQueue":
+        """Create the queue defined by the settings."""
+
+        capacity = settings.max_concurrent_runs
+        if capacity is None:
+            capacity = min(32, (os.cpu_count() or 1) + 4)
+        return RunQueue(capacity=capacity, max_wait=settings.max_queue_wait)
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a blocking function (the command of a run holding a slot) in a thread.
+
+        Like run_in_threadpool, the function is run in a copy of the current context.
+        """
+
+        context = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(
+            self._pool, functools.partial(context.run, func, *args)
+        )
+
+    def close(self) -> None:
+        """Shut the thread pool down once the running commands have finished."""
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: str, flow: int, priority: int = 0) -> AsyncIterator[None]:
+        """
+        Wait for an execution slot for a run of a flow, and hold it.
+
+        The flow is the project id. If the waiting task is cancelled, the run is
+        removed from the queue.
+        """
+
+        await self._acquire(key, flow, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def queued(self) -> List[Tuple[QueuedRun, int]]:
+        """
+        Return the waiting runs with their queue positions.
+
+        The position is the number of runs which will be served before the run, unless
+        another run is served early because it has waited for too long. The runs are
+        returned in the order of their positions, starting with zero.
+        """
+
+        waiting = sorted(entry for entry in self._heap if entry[2].waiting)
+        return [(run, position) for position, (_, _, run) in enumerate(waiting)]
+
+    def position(self, key: str) -> Optional[int]:
+        """Return the queue position of a run, or None if it isn't waiting."""
+
+        for run, position in self.queued():
+            if run.key == key:
+                return position
+        return None
+
+    def grant(self, key: str) -> bool:
+        """
+        Serve a waiting run right away, even if all slots are taken.
+
+        This is meant for interrupted runs, which finish without running their
+        command. False is returned if the run isn't waiting.
+        """
+
+        for queued_run in self._arrivals:
+            if queued_run.key == key and queued_run.waiting:
+                self.running += 1
+                queued_run.granted.set_result(None)
+                return True
+        return False
+
+    async def _acquire(self, key: str, flow: int, priority: int) -> None:
+        if not self.capacity or (self.running < self.capacity and not self._heap):
+            self.running += 1
+            return
+
+        start_tag = max(self._virtual_time, self._finish_tags.get(flow, 0))
+        finish_tag = start_tag + 1 / 2**priority
+        self._finish_tags[flow] = finish_tag
+        queued_run = QueuedRun(
+            key=key,
+            flow=flow,
+            priority=priority,
+            finish_tag=finish_tag,
+            sequence=next(self._sequence),
+            enqueued_at=time.monotonic(),
+            granted=asyncio.get_event_loop().create_future(),
+        )
+        heapq.heappush(self._heap, (finish_tag, queued_run.sequence, queued_run))
+        self._arrivals.append(queued_run)
+        self._dispatch()
+        try:
+            await queued_run.granted
+        except asyncio.CancelledError:
+            if queued_run.granted.done() and not queued_run.granted.cancelled():
+                # the slot was granted just before the task was cancelled
+                self._release()
+            else:
+                queued_run.granted.cancel()
+                self._dispatch()
+            raise
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.running < self.capacity:
+            queued_run = self._next()
+            if queued_run is None:
+                break
+            self._virtual_time = max(self._virtual_time, queued_run.finish_tag)
+            self.running += 1
+            queued_run.granted.set_result(None)
+        if not self._heap:
+            # all flows are idle, so their finish tags are no longer needed
+            self._finish_tags.clear()
+
+    def _next(self) -> Optional[QueuedRun]:
+        # runs which are no longer waiting (because they were cancelled or served
+        # early) are removed lazily
+        while self._arrivals and not self._arrivals[0].waiting:
+            self._arrivals.popleft()
+        while self._heap and not self._heap[0][2].waiting:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        if self._arrivals[0].enqueued_at + self.max_wait <= time.monotonic():
+            return self._arrivals.popleft()
+        return heapq.heappop(self._heap)[2]
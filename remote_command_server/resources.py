@@ -0,0 +1,204 @@
+"""Resource limits and accounting for commands."""
+
+import dataclasses
+import logging
+import os
+import pathlib
+import resource
+import shlex
+import sys
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ResourceLimit = Tuple[int, int]
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceLimits:
+    """
+    Resource limits for a command.
+
+    The CPU time is given in seconds and the memory (the size of the address space) in
+    bytes. None means that there is no limit.
+    """
+
+    cpu_time: Optional[int] = None
+    memory: Optional[int] = None
+    open_files: Optional[int] = None
+
+    def rlimits(self) -> Tuple[ResourceLimit, ...]:
+        """Return the limits as a tuple of resource ids and values for setrlimit."""
+
+        limits = (
+            (resource.RLIMIT_CPU, self.cpu_time),
+            (resource.RLIMIT_AS, self.memory),
+            (resource.RLIMIT_NOFILE, self.open_files),
+        )
+        return tuple((rid, value) for rid, value in limits if value is not None)
+
+
+# the ulimit options for the limits, and the units of their values in bytes or seconds
+_ULIMIT_OPTIONS = {
+    resource.RLIMIT_CPU: ("-t", 1),
+    resource.RLIMIT_AS: ("-v", 1024),
+    resource.RLIMIT_NOFILE: ("-n", 1),
+}
+
+
+def ulimit_commands(rlimits: Tuple[ResourceLimit, ...]) -> Tuple[str, ...]:
+    """
+    Return shell commands applying resource limits.
+
+    The commands are meant to be run by the shell of a command before the command
+    itself, so that the limits apply to the shell and all its descendants. ulimit sets
+    the soft and the hard limit, so that the command cannot raise them. Values are
+    rounded up to ulimit's units, so that a small limit doesn't become 0.
+    """
+
+    commands = []
+    for rid, value in rlimits:
+        option, unit = _ULIMIT_OPTIONS[rid]
+        commands.append(f"ulimit {option} {-(-value // unit)}")
+    return tuple(commands)
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceUsage:
+    """
+    The resources used by a command.
+
+    CPU times are in seconds, and the maximum resident set size and I/O are in bytes.
+    Without a cgroup, the I/O is estimated from the number of block operations.
+    """
+
+    user_cpu: float
+    system_cpu: float
+    max_rss: int
+    io_read_bytes: int
+    io_write_bytes: int
+
+
+def usage_from_rusage(rusage: "resource.struct_rusage") -> ResourceUsage:
+    """Convert the rusage returned by wait4 into a resource usage."""
+
+    # ru_maxrss is given in kilobytes on Linux, but in bytes on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == "darwin" else 1024 * rusage.ru_maxrss
+    return ResourceUsage(
+        user_cpu=rusage.ru_utime,
+        system_cpu=rusage.ru_stime,
+        max_rss=max_rss,
+        io_read_bytes=512 * rusage.ru_inblock,
+        io_write_bytes=512 * rusage.ru_oublock,
+    )
+
+
+class Cgroup:
+    """
+    A cgroup (version 2) for a single command.
+
+    The cgroup is created as a child of a root cgroup, which must have been delegated
+    to the server user. The command's shell joins the cgroup before running the
+    command, so that all its descendants are accounted for. The cgroup's accounting is
+    more accurate than the rusage, as it includes the actual I/O bytes and processes
+    which haven't been waited for.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+
+    @staticmethod
+    def create(
+        root: pathlib.Path, name: str, memory_limit: Optional[int] = None
+    ) -> Optional["Cgroup"]:
+        """
+        Create a cgroup.
+
+        None is returned if the cgroup cannot be created, for example because cgroups
+        v2 are not available.
+        """
+
+        path = root / name
+        try:
+            path.mkdir()
+        except OSError:
+            logger.warning("Could not create the cgroup %s", path, exc_info=True)
+            return None
+        try:
+            if memory_limit is not None:
+                (path / "memory.max").write_text(str(memory_limit))
+            if not os.access(path / "cgroup.procs", os.W_OK):
+                raise PermissionError(f"Cannot write to {path / 'cgroup.procs'}")
+        except OSError:
+            logger.warning("Could not set up the cgroup %s", path, exc_info=True)
+            try:
+                path.rmdir()
+            except OSError:
+                pass
+            return None
+        return Cgroup(path)
+
+    def join_command(self) -> str:
+        """
+        Return a shell command moving the shell into the cgroup.
+
+        echo is a builtin of the shell, so writing 0 (the writing process) to the
+        cgroup's process list moves the shell itself.
+        """
+
+        return f"echo 0 > {shlex.quote(str(self.path / 'cgroup.procs'))}"
+
+    def usage(self, usage: ResourceUsage) -> ResourceUsage:
+        """
+        Update a resource usage with the cgroup's accounting.
+
+        Values which the cgroup does not provide are taken from the given usage.
+        """
+
+        cpu = self._stat("cpu.stat")
+        io = self._io_stat()
+        try:
+            max_rss = int((self.path / "memory.peak").read_text())
+        except (OSError, ValueError):
+            max_rss = usage.max_rss
+        return ResourceUsage(
+            user_cpu=cpu.get("user_usec", 1e6 * usage.user_cpu) / 1e6,
+            system_cpu=cpu.get("system_usec", 1e6 * usage.system_cpu) / 1e6,
+            max_rss=max_rss,
+            io_read_bytes=io.get("rbytes", usage.io_read_bytes),
+            io_write_bytes=io.get("wbytes", usage.io_write_bytes),
+        )
+
+    def remove(self) -> None:
+        """Remove the cgroup. The cgroup must not contain any process."""
+
+        try:
+            self.path.rmdir()
+        except OSError:
+            logger.warning("Could not remove the cgroup %s", self.path, exc_info=True)
+
+    def _stat(self, filename: str) -> Dict[str, int]:
+        try:
+            lines = (self.path / filename).read_text().splitlines()
+        except OSError:
+            return {}
+        stat: Dict[str, int] = {}
+        for line in lines:
+            key, _, value = line.partition(" ")
+            if value.isdigit():
+                stat[key] = int(value)
+        return stat
+
+    def _io_stat(self) -> Dict[str, int]:
+        # io.stat has a line per device, such as "8:0 rbytes=123 wbytes=456 ..."
+        try:
+            lines = (self.path / "io.stat").read_text().splitlines()
+        except OSError:
+            return {}
+        stat: Dict[str, int] = {}
+        for line in lines:
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if value.isdigit():
+                    stat[key] = stat.get(key, 0) + int(value)
+        return stat
@@ -0,0 +1,115 @@
+"""Fast JSON responses."""
+
+import functools
+import json
+from typing import Any, Dict, Optional
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+from starlette.exceptions import HTTPException
+
+# the response bodies of the run endpoint, apart from the run key; run keys are hex
+# strings, so that they can be inserted without any escaping
+_RUN_SUCCEEDED = (b'{"success":true,"run":"', b'"}')
+_RUN_FAILED_MESSAGE = "Command returned with a non-zero return code."
+_RUN_FAILED = (b'{"message":"' + _RUN_FAILED_MESSAGE.encode() + b'","run":"', b'"}')
+_RUN_SCHEDULED = b'{"message":"The run has been scheduled."}'
+
+
+class StaticJSONResponse(Response):
+    """
+    JSON response with a body which has been encoded already.
+
+    Unlike for a JSONResponse, the content is not encoded again, and unless additional
+    headers are passed, the raw headers are created directly rather than by parsing a
+    dictionary.
+    """
+
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        body: bytes,
+        status_code: int = 200,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.status_code = status_code
+        self.body = body
+        self.background = None  # type: ignore
+        if headers:
+            self.init_headers(headers)
+        else:
+            self.raw_headers = [
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"content-type", b"application/json"),
+            ]
+
+
+def _encode_run(content: Dict[str, Any]) -> bytes:
+    # the output of a run comes from its command, so it is encoded with the standard
+    # library if orjson can't encode it (e.g. integers beyond 64 bits), rather than
+    # failing a run which has finished
+    try:
+        return orjson.dumps(content)
+    except TypeError:
+        return json.dumps(content, separators=(",", ":"), default=str).encode()
+
+
+def run_succeeded(key: str, output: Optional[Dict[str, Any]] = None) -> Response:
+    """
+    Return the response for a successful run.
+
+    The fields extracted from the output are included if there are any.
+    """
+
+    if output:
+        return StaticJSONResponse(
+            _encode_run({"success": True, "run": key, "output": output})
+        )
+    return StaticJSONResponse(_RUN_SUCCEEDED[0] + key.encode() + _RUN_SUCCEEDED[1])
+
+
+def run_failed(key: str, output: Optional[Dict[str, Any]] = None) -> Response:
+    """
+    Return the response for a run whose command returned a non-zero exit code.
+
+    The fields extracted from the output are included if there are any.
+    """
+
+    if output:
+        return StaticJSONResponse(
+            _encode_run({"message": _RUN_FAILED_MESSAGE, "run": key, "output": output}),
+            status_code=500,
+        )
+    return StaticJSONResponse(
+        _RUN_FAILED[0] + key.encode() + _RUN_FAILED[1], status_code=500
+    )
+
+
+def run_scheduled() -> StaticJSONResponse:
+    """Return the response for a run which has been scheduled."""
+
+    return StaticJSONResponse(_RUN_SCHEDULED, status_code=202)
+
+
+@functools.lru_cache(maxsize=256)
+def _error_body(detail: str) -> bytes:
+    return orjson.dumps({"detail": detail})
+
+
+async def http_exception_handler(request: Any, exc: HTTPException) -> Response:
+    """
+    Handle an HTTP exception.
+
+    This returns the same response as FastAPI's default handler, but the bodies for
+    string details (such as the body of a 401 response) are encoded only once.
+    """
+
+    headers = getattr(exc, "headers", None)
+    if isinstance(exc.detail, str):
+        return StaticJSONResponse(
+            _error_body(exc.detail), status_code=exc.status_code, headers=headers
+        )
+    return ORJSONResponse(
+        {"detail": exc.detail}, status_code=exc.status_code, headers=headers
+    )
@@ -0,0 +1,179 @@
+"""Scheduled runs of projects."""
+
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud
+from remote_command_server.cron import CronSchedule
+from remote_command_server.executor import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Scheduler for running projects according to their cron schedule.
+
+    The next run time of every scheduled project is kept in a heap, so that a single
+    task can sleep until the earliest run is due. Scheduled runs go through the same
+    executor as requested runs.
+
+    The time of the last scheduled run is stored in the database, so that runs missed
+    while the server was down are caught up when it starts again. Missed runs are
+    coalesced: however many runs were missed, a project is run once. Similarly, a
+    scheduled run is skipped if the project's previous scheduled run is still in
+    progress.
+
+    All times are in UTC.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        run: Callable[[Job], Awaitable[object]],
+    ) -> None:
+        self.session_factory = session_factory
+        self.run = run
+        self._heap: List[Tuple[datetime, int]] = []
+        self._schedules: Dict[int, Tuple[CronSchedule, Job]] = {}
+        self._running: Set[int] = set()
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def load(self, now: datetime) -> None:
+        """
+        Load the scheduled projects from the database.
+
+        This replaces all previously loaded schedules. Projects which have never been
+        run by the scheduler are treated as if they had been run now.
+        """
+
+        heap: List[Tuple[datetime, int]] = []
+        schedules: Dict[int, Tuple[CronSchedule, Job]] = {}
+        new_project_ids: List[int] = []
+        db = self.session_factory()
+        try:
+            for project in crud.get_scheduled_projects(db):
+                try:
+                    schedule = CronSchedule.parse(project.schedule)
+                except ValueError:
+                    logger.error("Invalid schedule for %s", project.name, exc_info=True)
+                    continue
+                last_run = project.last_scheduled_run
+                if last_run is None:
+                    last_run = now
+                    new_project_ids.append(project.id)
+                next_run = schedule.next_after(last_run)
+                if next_run is None:
+                    continue
+                schedules[project.id] = (schedule, Job.from_project(project))
+                heap.append((next_run, project.id))
+            if new_project_ids:
+                crud.set_last_scheduled_run(db, new_project_ids, now)
+        finally:
+            db.close()
+
+        heapq.heapify(heap)
+        self._heap = heap
+        self._schedules = schedules
+
+    def next_run(self) -> Optional[datetime]:
+        """Return the time of the next scheduled run, or None if there is none."""
+
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[Job]:
+        """
+        Remove the jobs which are due and schedule their next runs.
+
+        The time of the last scheduled run is updated in the database before the jobs
+        are returned, so that a restart does not run them again. If the update fails,
+        the jobs stay due, so that they are returned by the next call.
+        """
+
+        entries: List[Tuple[datetime, int]] = []
+        while self._heap and self._heap[0][0] <= now:
+            entries.append(heapq.heappop(self._heap))
+        if not entries:
+            return []
+
+        db = self.session_factory()
+        try:
+            crud.set_last_scheduled_run(
+                db, [project_id for _, project_id in entries], now
+            )
+        except Exception:
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+            raise
+        finally:
+            db.close()
+
+        due: List[Job] = []
+        for _, project_id in entries:
+            schedule, job = self._schedules[project_id]
+            due.append(job)
+            next_run = schedule.next_after(now)
+            if next_run is not None:
+                heapq.heappush(self._heap, (next_run, project_id))
+        return due
+
+    def start(self, job: Job) -> bool:
+        """
+        Start a run of a job in the background.
+
+        False is returned if the job's previous scheduled run is still in progress, in
+        which case no run is started.
+        """
+
+        if job.project_id in self._running:
+            logger.warning(
+                "Skipping scheduled run of %s, as its previous run is in progress",
+                job.project_name,
+            )
+            return False
+        self._running.add(job.project_id)
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, job: Job) -> None:
+        try:
+            await self.run(job)
+        except Exception:
+            logger.exception("Scheduled run of %s failed", job.project_name)
+        finally:
+            self._running.discard(job.project_id)
+
+
+async def schedule_loop(scheduler: Scheduler, reload_interval: float) -> None:
+    """
+    Run the scheduled jobs when they are due.
+
+    The schedules are reloaded from the database every reload_interval seconds, so
+    that changes to the projects are picked up.
+    """
+
+    next_reload = time.monotonic()
+    while True:
+        try:
+            if time.monotonic() >= next_reload:
+                next_reload = time.monotonic() + reload_interval
+                await run_in_threadpool(scheduler.load, datetime.utcnow())
+            for job in await run_in_threadpool(scheduler.pop_due, datetime.utcnow()):
+                scheduler.start(job)
+        except Exception:
+            logger.exception("Could not run the scheduled jobs")
+
+        delay = next_reload - time.monotonic()
+        next_run = scheduler.next_run()
+        if next_run is not None:
+            delay = min(delay, (next_run - datetime.utcnow()).total_seconds())
+        await asyncio.sleep(max(delay, 0.01))
@@ -1,7 +1,8 @@
 """Pydantic models (schemas)."""
 
 
-from typing import List
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel
 
@@ -12,6 +13,23 @@ class ProjectBase(BaseModel):
     name: str
     directory: str
     command: str
+    debounce_window: Optional[float] = None
+    environment: Optional[Dict[str, str]] = None
+    path: Optional[str] = None
+    umask: Optional[int] = None
+    cpu_time_limit: Optional[int] = None
+    memory_limit: Optional[int] = None
+    open_files_limit: Optional[int] = None
+    schedule: Optional[str] = None
+    agent_label: Optional[str] = None
+    share_window: Optional[float] = None
+    priority: Optional[int] = None
+    workspaces: Optional[int] = None
+    workspace_method: Optional[str] = None
+    output_processors: Optional[List[Dict[str, Any]]] = None
+    output_max_bytes: Optional[int] = None
+    output_head_bytes: Optional[int] = None
+    strip_ansi: Optional[bool] = None
 
 
 class ProjectCreate(ProjectBase):
@@ -45,3 +63,174 @@ class Message(BaseModel):
     """Model for a message."""
 
     message: str
+
+
+class RunSuccess(BaseModel):
+    """Model for a successful run."""
+
+    success: bool
+    run: str
+    output: Optional[Dict[str, Any]] = None
+
+
+class RunMessage(Message):
+    """Model for a message about a run."""
+
+    run: str
+    output: Optional[Dict[str, Any]] = None
+
+
+class RunBase(BaseModel):
+    """Base class for run models."""
+
+    key: str
+    started_at: datetime
+    finished_at: datetime
+    exit_code: int
+    duration: float
+    output_size: int
+    user_cpu: Optional[float] = None
+    system_cpu: Optional[float] = None
+    max_rss: Optional[int] = None
+    io_read_bytes: Optional[int] = None
+    io_write_bytes: Optional[int] = None
+    interrupted: bool = False
+
+
+class RunCreate(RunBase):
+    """Model for creating a run."""
+
+    project_id: int
+    log_path: Optional[str] = None
+
+
+class Run(RunBase):
+    """Model for a run."""
+
+    class Config:
+        orm_mode = True
+
+
+class QueuedRun(BaseModel):
+    """Model for a run waiting for an execution slot."""
+
+    run: str
+    position: int
+    waiting: float
+
+
+class QueueStatus(BaseModel):
+    """Model for the status of the run queue."""
+
+    running: int
+    capacity: int
+    queued: List[QueuedRun]
+
+
+class ActiveRun(BaseModel):
+    """Model for a run in progress, as seen by an admin."""
+
+    run: str
+    project: str
+    state: str
+    elapsed: float
+    output_bytes: int
+    pid: Optional[int] = None
+    queue_position: Optional[int] = None
+    agent_label: Optional[str] = None
+    workspace: Optional[str] = None
+
+
+class ExecutorStats(BaseModel):
+    """Model for the utilization of the executor."""
+
+    active: int
+    running: int
+    queued: int
+    capacity: int
+    utilization: Optional[float] = None
+    agents: int
+    agent_capacity: int
+    agent_active: int
+
+
+class DatabasePoolStats(BaseModel):
+    """Model for the state of the database connection pool."""
+
+    pool: str
+    status: str
+    size: Optional[int] = None
+    checked_in: Optional[int] = None
+    checked_out: Optional[int] = None
+    overflow: Optional[int] = None
+
+
+class CacheStats(BaseModel):
+    """Model for the hits of a cache."""
+
+    hits: int
+    lookups: int
+    hit_ratio: Optional[float] = None
+
+
+class ServerStats(BaseModel):
+    """Model for the internal state of the server."""
+
+    executor: ExecutorStats
+    database_pool: DatabasePoolStats
+    caches: Dict[str, CacheStats]
+    auth_rejected: int
+    events_dropped: int
+
+
+class PipelineStep(BaseModel):
+    """Model for the result of a pipeline step."""
+
+    project: str
+    status: str
+    run: Optional[str] = None
+    exit_code: Optional[int] = None
+    output: Optional[Dict[str, Any]] = None
+
+
+class PipelineResult(BaseModel):
+    """Model for the result of a pipeline."""
+
+    success: bool
+    steps: List[PipelineStep]
+
+
+class AgentHello(BaseModel):
+    """Model for the message introducing an agent."""
+
+    name: str
+    labels: List[str]
+    capacity: int
+
+
+class AgentOutput(BaseModel):
+    """Model for a chunk of a run's output, sent by an agent."""
+
+    key: str
+    stream: str
+    data: str
+
+
+class AgentUsage(BaseModel):
+    """Model for the resources used by a command, sent by an agent."""
+
+    user_cpu: float
+    system_cpu: float
+    max_rss: int
+    io_read_bytes: int
+    io_write_bytes: int
+
+
+class AgentExit(BaseModel):
+    """Model for the result of a run, sent by an agent."""
+
+    key: str
+    command: str
+    returncode: Optional[int] = None
+    error: Optional[str] = None
+    usage: Optional[AgentUsage] = None
@@ -0,0 +1,114 @@
+"""Server settings."""
+
+import functools
+from typing import Dict, List, Optional
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """
+    Settings for the server.
+
+    All settings can be changed with an environment variable whose name is the
+    setting name in upper case, prefixed with RCS_. For example, the setting
+    run_retention_days is read from the environment variable RCS_RUN_RETENTION_DAYS.
+    """
+
+    # hash of the token for admin features, as output by the admintoken command
+    admin_token_hash: Optional[str] = None
+
+    # hash of the token agents use for connecting to the server, as output by the
+    # agenttoken command
+    agent_token_hash: Optional[str] = None
+
+    # structured event log; a file name, "-" for stderr, or empty for no event log
+    event_log: Optional[str] = "-"
+    event_log_queue_size: int = 10000
+    event_log_drop_policy: str = "newest"
+    event_sample_rate: float = 1.0
+    event_sample_rates: Dict[str, float] = {}
+
+    # request profiling
+    profile_directory: Optional[str] = None
+    profile_threshold: float = 1.0
+    profile_sample_rate: float = 0.0
+
+    # rate limits (requests per second and burst size); no limit if the rate is 0
+    token_rate_limit: float = 0
+    token_rate_burst: float = 10
+    project_rate_limit: float = 0
+    project_rate_burst: float = 10
+    client_rate_limit: float = 0
+    client_rate_burst: float = 20
+    rate_limit_database: Optional[str] = None
+    rate_limit_persist_interval: float = 60
+
+    # load shedding of requests with invalid credentials; failed requests can be
+    # limited per client address (requests per second and burst size), with no limit
+    # if the rate is 0, which is the default, as all clients behind a reverse proxy
+    # share its address
+    auth_failure_rate_limit: float = 0
+    auth_failure_burst: float = 20
+    auth_negative_cache_size: int = 10000
+    auth_negative_cache_ttl: float = 60
+    auth_filter_refresh_interval: float = 10
+
+    # idempotency keys of run requests; responses are kept for idempotency_ttl
+    # seconds, and persisted to the database if one is given
+    idempotency_ttl: float = 86400
+    idempotency_max_keys: int = 100000
+    idempotency_database: Optional[str] = None
+    idempotency_sweep_interval: float = 60
+
+    # snapshot of the projects and tokens, created with rcs snapshot, which is checked
+    # against the database every snapshot_check_interval seconds
+    snapshot_file: Optional[str] = None
+    snapshot_check_interval: float = 30
+
+    # compression of responses, with the content encodings in order of preference;
+    # zstd is only used if the zstandard package is installed
+    compression_encodings: List[str] = ["zstd", "gzip"]
+    compression_minimum_size: int = 1024
+
+    # fair queueing of runs; the commands run on a thread pool with a thread per slot
+    max_concurrent_runs: Optional[int] = None
+    max_queue_wait: float = 60
+
+    # pools of workspaces for parallel runs; by default, a project's workspaces are
+    # stored next to its directory
+    workspace_root: Optional[str] = None
+
+    # debouncing
+    debounce_max_delay: float = 300
+
+    # draining of runs before the server stops
+    drain_grace_period: float = 30
+    drain_kill_timeout: float = 5
+    drain_retry_after: int = 5
+
+    # scheduled runs
+    schedule_reload_interval: float = 60
+
+    # run logs and resource accounting
+    log_directory: Optional[str] = None
+    log_follow_interval: float = 0.5
+    cgroup_root: Optional[str] = None
+
+    # run history
+    run_history_batch_size: int = 100
+    run_history_flush_interval: float = 1.0
+    run_history_max_queue_size: int = 10000
+    run_retention_days: float = 30
+    run_retention_interval: float = 3600
+    run_retention_chunk_size: int = 1000
+
+    class Config:
+        env_prefix = "RCS_"
+
+
+@functools.lru_cache()
+def get_settings() -> Settings:
+    """Return the server settings."""
+
+    return Settings()
@@ -0,0 +1,229 @@
+"""Load shedding of requests with invalid credentials."""
+
+import asyncio
+import collections
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud
+from remote_command_server.settings import Settings
+from remote_command_server.throttling import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    A Bloom filter for strings.
+
+    A Bloom filter may report a value as contained although it has never been added
+    (with a probability of about error_rate, as long as no more than capacity values
+    are added), but never the other way round.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def of(values: Iterable[str], error_rate: float = 0.001) -> "BloomFilter":
+        """Create a Bloom filter containing the given values."""
+
+        values = list(values)
+        bloom_filter = BloomFilter(capacity=2 * len(values), error_rate=error_rate)
+        for value in values:
+            bloom_filter.add(value)
+        return bloom_filter
+
+    def add(self, value: str) -> None:
+        """Add a value."""
+
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+    def _positions(self, value: str) -> Iterable[int]:
+        # double hashing: the k hash functions are derived from two 64-bit hashes
+        digest = hashlib.blake2b(value.encode("UTF-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+
+class NegativeCache:
+    """
+    Bounded cache of failed project and token combinations.
+
+    Entries expire after ttl seconds, and the oldest entries are evicted if there are
+    more than max_size entries.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expiry: "collections.OrderedDict[Tuple[str, str], float]" = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+
+    def add(self, project_name: str, hashed_token: str) -> None:
+        """Add a failed combination."""
+
+        key = (project_name, hashed_token)
+        with self._lock:
+            self._expiry[key] = time.monotonic() + self.ttl
+            self._expiry.move_to_end(key)
+            while len(self._expiry) > self.max_size:
+                self._expiry.popitem(last=False)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        with self._lock:
+            self.lookups += 1
+            expiry = self._expiry.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._expiry[key]
+                return False
+            self.hits += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+
+        with self._lock:
+            self._expiry.clear()
+
+
+class AuthGate:
+    """
+    Fast rejection of requests with invalid credentials.
+
+    The gate rejects requests without any database access if
+
+    * the client has had too many failed requests recently,
+    * the same project and token combination has failed recently, or
+    * the project name or the token hash are not in the Bloom filters of known project
+      names and token hashes.
+
+    The Bloom filters are built from the database and must be refreshed regularly, so
+    that new projects and tokens are accepted. Until they have been built, only the
+    failure limiter and the negative cache are used.
+    """
+
+    def __init__(
+        self,
+        negative_cache: NegativeCache,
+        failure_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        self.negative_cache = negative_cache
+        self.failure_limiter = failure_limiter
+        self.rejected = 0
+        self._projects: Optional[BloomFilter] = None
+        self._tokens: Optional[BloomFilter] = None
+        self._version: Optional[int] = None
+
+    @staticmethod
+    def from_settings(settings: Settings) -> "AuthGate":
+        """Create the gate defined by the settings."""
+
+        failure_limiter = (
+            RateLimiter(settings.auth_failure_rate_limit, settings.auth_failure_burst)
+            if settings.auth_failure_rate_limit
+            else None
+        )
+        return AuthGate(
+            negative_cache=NegativeCache(
+                max_size=settings.auth_negative_cache_size,
+                ttl=settings.auth_negative_cache_ttl,
+            ),
+            failure_limiter=failure_limiter,
+        )
+
+    def refresh(self, db: Session) -> bool:
+        """
+        Rebuild the Bloom filters if the projects or tokens have changed.
+
+        The negative cache is cleared when the filters are rebuilt, as a failed token
+        might have become valid. True is returned if the filters have been rebuilt.
+        """
+
+        version = crud.get_credentials_version(db)
+        if version == self._version:
+            return False
+        project_names, hashed_tokens = crud.get_credentials(db)
+        self._projects = BloomFilter.of(project_names)
+        self._tokens = BloomFilter.of(hashed_tokens)
+        self._version = version
+        self.negative_cache.clear()
+        return True
+
+    def retry_after(self, client: str) -> float:
+        """
+        Return the time (in seconds) until a client may make a request again.
+
+        Zero is returned if the client has not had too many failed requests.
+        """
+
+        if self.failure_limiter is None:
+            return 0
+        return self.failure_limiter.wait_time(client)
+
+    def rejects(self, project_name: str, hashed_token: str) -> bool:
+        """Check whether credentials are known to be invalid."""
+
+        if (project_name, hashed_token) in self.negative_cache:
+            return True
+        if self._projects is not None and project_name not in self._projects:
+            return True
+        if self._tokens is not None and hashed_token not in self._tokens:
+            return True
+        return False
+
+    def record_failure(self, project_name: str, hashed_token: str, client: str) -> None:
+        """Record a request with invalid credentials."""
+
+        self.rejected += 1
+        self.negative_cache.add(project_name, hashed_token)
+        if self.failure_limiter is not None:
+            self.failure_limiter.take(client)
+
+
+async def refresh_loop(
+    gate: AuthGate, session_factory: Callable[[], Session], interval: float
+) -> None:
+    """Refresh the Bloom filters of a gate every interval seconds."""
+
+    def refresh() -> None:
+        db = session_factory()
+        try:
+            if gate.refresh(db):
+                logger.info("Rebuilt the filters of known projects and tokens")
+        finally:
+            db.close()
+
+    while True:
+        try:
+            await run_in_threadpool(refresh)
+        except Exception:
+            logger.exception("Could not refresh the filters of known credentials")
+        await asyncio.sleep(interval)
@@ -0,0 +1,275 @@
+"""Snapshots of the projects and tokens, for lookups without database access."""
+
+import asyncio
+import logging
+import mmap
+import os
+import pathlib
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RCSSNAP3"
+
+# The file consists of a header, the token records sorted by token hash, the project
+# records sorted by project name, and the names and column values of the projects.
+# A token record holds the binary token hash and the position of its project, and a
+# project record the offsets and lengths of the project's name and column values.
+# The header holds the credentials version of the database at the time of the export,
+# which tells whether the snapshot is still up to date.
+_HEADER = struct.Struct("<8sIIQ")
+_TOKEN = struct.Struct("<32sI")
+_PROJECT = struct.Struct("<IIII")
+
+ProjectRecord = Tuple[bytes, int, bytes]
+TokenRecord = Tuple[bytes, int]
+
+
+def _export(db: Session) -> Tuple[List[ProjectRecord], List[TokenRecord]]:
+    columns = [
+        column.name
+        for column in models.Project.__table__.columns
+        if column.name not in crud.VOLATILE_PROJECT_COLUMNS
+    ]
+    projects = sorted(
+        (
+            project.name.encode(),
+            project.id,
+            orjson.dumps({column: getattr(project, column) for column in columns}),
+        )
+        for project in crud.get_projects(db)
+    )
+    positions = {project_id: i for i, (_, project_id, _) in enumerate(projects)}
+    tokens = sorted(
+        (bytes.fromhex(hashed), positions[project_id])
+        for hashed, project_id in crud.get_token_hashes(db)
+    )
+    return projects, tokens
+
+
+def write(db: Session, path: pathlib.Path) -> Tuple[int, int]:
+    """
+    Export the projects and token hashes of a database to a snapshot file.
+
+    The snapshot is written to a temporary file, which is renamed once it is
+    complete, so that a server never loads a partial snapshot. The numbers of
+    projects and tokens are returned.
+    """
+
+    # the version is read before the records, so that changes made in between make
+    # the snapshot outdated rather than go unnoticed
+    version = crud.get_credentials_version(db)
+    projects, tokens = _export(db)
+    records: List[bytes] = []
+    blobs: List[bytes] = []
+    offset = _HEADER.size + len(tokens) * _TOKEN.size + len(projects) * _PROJECT.size
+    for name, _, values in projects:
+        records.append(
+            _PROJECT.pack(offset, len(name), offset + len(name), len(values))
+        )
+        blobs.extend((name, values))
+        offset += len(name) + len(values)
+
+    temporary_path = path.with_name(path.name + ".tmp")
+    with open(temporary_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(projects), len(tokens), version))
+        f.writelines(_TOKEN.pack(digest, position) for digest, position in tokens)
+        f.writelines(records)
+        f.writelines(blobs)
+    os.replace(temporary_path, path)
+    return len(projects), len(tokens)
+
+
+class Snapshot:
+    """
+    A snapshot file, mapped into memory.
+
+    Lookups are binary searches in the mapped file, so opening a snapshot takes the
+    same time however many projects and tokens it contains, and the operating system
+    shares its pages between all processes mapping the same file.
+
+    A snapshot only knows the projects and tokens which existed when it was written,
+    so a failed lookup means that the database must be asked.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size or self._map[:8] != MAGIC:
+            self._map.close()
+            raise ValueError(f"Not a snapshot file: {path}")
+        _, project_count, token_count, version = _HEADER.unpack_from(self._map)
+        self.project_count: int = project_count
+        self.token_count: int = token_count
+        self.version: int = version
+        self.hits = 0
+        self.lookups = 0
+        self._projects_offset = _HEADER.size + self.token_count * _TOKEN.size
+
+    def close(self) -> None:
+        """Unmap the file."""
+
+        self._map.close()
+
+    def project(self, project_name: str, hashed_token: str) -> Optional[models.Project]:
+        """
+        Get a project, if a token grants permission to execute it.
+
+        The project is not attached to a database session. None is returned if the
+        project or the token are not in the snapshot, or if the token belongs to a
+        different project.
+        """
+
+        self.lookups += 1
+        try:
+            digest = bytes.fromhex(hashed_token)
+        except ValueError:
+            return None
+        position = self._find_project(project_name.encode())
+        if position is None or self._find_token(digest) != position:
+            return None
+        _, _, start, length = _PROJECT.unpack_from(
+            self._map, self._projects_offset + position * _PROJECT.size
+        )
+        end = start + length
+        values: Dict[str, object] = orjson.loads(self._map[start:end])
+        self.hits += 1
+        return models.Project(**values)
+
+    def _find_token(self, digest: bytes) -> Optional[int]:
+        low, high = 0, self.token_count
+        while low < high:
+            middle = (low + high) // 2
+            key, position = _TOKEN.unpack_from(
+                self._map, _HEADER.size + middle * _TOKEN.size
+            )
+            if key < digest:
+                low = middle + 1
+            elif key > digest:
+                high = middle
+            else:
+                return int(position)
+        return None
+
+    def _find_project(self, name: bytes) -> Optional[int]:
+        low, high = 0, self.project_count
+        while low < high:
+            middle = (low + high) // 2
+            start, length, _, _ = _PROJECT.unpack_from(
+                self._map, self._projects_offset + middle * _PROJECT.size
+            )
+            end = start + length
+            key = self._map[start:end]
+            if key < name:
+                low = middle + 1
+            elif key > name:
+                high = middle
+            else:
+                return middle
+        return None
+
+
+def load(path: pathlib.Path, version: int) -> Optional[Snapshot]:
+    """
+    Load a snapshot for a server.
+
+    A snapshot is only used if it has the credentials version of the database, as it
+    could otherwise grant access with tokens which have been deleted
+    since it was written, or run outdated commands. None is returned (and the server
+    falls back to the database) if the snapshot is out of date or can't be read.
+    """
+
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not load the snapshot %s: %s", path, e)
+        return None
+    if snapshot.version != version:
+        logger.warning("Not using the snapshot %s, as it is out of date", path)
+        snapshot.close()
+        return None
+    logger.info(
+        "Loaded the snapshot %s with %d projects and %d tokens",
+        path,
+        snapshot.project_count,
+        snapshot.token_count,
+    )
+    return snapshot
+
+
+class SnapshotLoader:
+    """
+    Loader of a server's snapshot, which keeps checking it against the database.
+
+    An outdated snapshot is dropped, and the snapshot file is loaded again once it
+    has changed, so that an exported snapshot is picked up without a restart. The
+    file is only loaded again if it has changed since the last attempt, so that an
+    outdated file isn't mapped (and reported) over and over.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.snapshot: Optional[Snapshot] = None
+        self._attempted: Optional[Tuple[int, int, int]] = None
+
+    def refresh(self, db: Session) -> None:
+        """Drop the snapshot if it is out of date, and load the file if it changed."""
+
+        version = crud.get_credentials_version(db)
+        if self.snapshot is not None:
+            if self.snapshot.version == version:
+                return
+            logger.warning(
+                "Not using the snapshot %s anymore, as it is out of date", self.path
+            )
+            # not closed, as requests may still be looking up projects in it; it is
+            # unmapped once it is garbage collected
+            self.snapshot = None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            attempted = None
+        else:
+            attempted = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if attempted == self._attempted:
+                return
+        self._attempted = attempted
+        self.snapshot = load(self.path, version)
+
+    def close(self) -> None:
+        """Unmap the snapshot."""
+
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+
+async def refresh_loop(
+    loader: SnapshotLoader, session_factory: Callable[[], Session], interval: float
+) -> None:
+    """
+    Check the snapshot of a loader now and every interval seconds.
+
+    The checks run on the thread pool, so that they don't block the event loop.
+    """
+
+    def refresh() -> None:
+        db = session_factory()
+        try:
+            loader.refresh(db)
+        finally:
+            db.close()
+
+    while True:
+        try:
+            await run_in_threadpool(refresh)
+        except Exception:
+            logger.exception("Could not check the snapshot %s", loader.path)
+        await asyncio.sleep(interval)
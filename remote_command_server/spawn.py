@@ -0,0 +1,151 @@
+"""Precompiled specifications for spawning commands."""
+
+import dataclasses
+import os
+import pathlib
+import threading
+from stat import S_ISDIR
+from typing import Dict, Mapping, Optional, Tuple
+
+from remote_command_server.resources import (
+    ResourceLimit,
+    ResourceLimits,
+    ulimit_commands,
+)
+
+Environment = Tuple[Tuple[str, str], ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class ExecutionProfile:
+    """
+    The execution settings of a project.
+
+    The environment variables are given as a tuple of name-value pairs, so that the
+    profile is hashable and can be compared cheaply. If no environment is given, the
+    command inherits the server's environment. If a path is given, it replaces the
+    PATH environment variable.
+    """
+
+    directory: str
+    environment: Optional[Environment] = None
+    path: Optional[str] = None
+    umask: Optional[int] = None
+    limits: ResourceLimits = ResourceLimits()
+
+
+@dataclasses.dataclass(frozen=True)
+class SpawnSpec:
+    """
+    Everything needed for spawning a command, ready to use.
+
+    The working directory is resolved, and its device and inode numbers are kept, so
+    that a cached spec can tell whether the directory has been replaced since. The env
+    dictionary is passed to the process as is, and None means that the server's
+    environment is inherited.
+
+    The umask and the resource limits are applied by shell commands (the prologue) run
+    before the command, as setting them in the forked child would require a preexec
+    function, which is not safe in a threaded server and prevents the fast spawning
+    paths of subprocess.
+    """
+
+    directory: pathlib.Path
+    identity: Tuple[int, int]
+    env: Optional[Dict[str, str]]
+    umask: Optional[int]
+    rlimits: Tuple[ResourceLimit, ...] = ()
+    prologue: Tuple[str, ...] = ()
+
+    def is_current(self) -> bool:
+        """Return whether the directory still is the one the spec was compiled for."""
+
+        try:
+            stat = os.stat(self.directory)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.identity
+
+
+def compile_spec(profile: ExecutionProfile) -> SpawnSpec:
+    """
+    Compile the spawn spec for an execution profile.
+
+    A ValueError is raised if the directory does not exist or is no directory.
+    """
+
+    directory = pathlib.Path(profile.directory)
+    try:
+        directory = directory.resolve(strict=True)
+        stat = os.stat(directory)
+    except OSError:
+        stat = None
+    if stat is None or not S_ISDIR(stat.st_mode):
+        raise ValueError(f"Does not exist or is no directory: {profile.directory}")
+
+    rlimits = profile.limits.rlimits()
+    prologue = ulimit_commands(rlimits)
+    if profile.umask is not None:
+        prologue = (f"umask {profile.umask:04o}",) + prologue
+    return SpawnSpec(
+        directory=directory,
+        identity=(stat.st_dev, stat.st_ino),
+        env=_environment(profile),
+        umask=profile.umask,
+        rlimits=rlimits,
+        prologue=prologue,
+    )
+
+
+def _environment(profile: ExecutionProfile) -> Optional[Dict[str, str]]:
+    if profile.environment is None and profile.path is None:
+        return None
+    base: Mapping[str, str] = (
+        os.environ if profile.environment is None else dict(profile.environment)
+    )
+    env = dict(base)
+    if profile.path is not None:
+        env["PATH"] = profile.path
+    return env
+
+
+class SpawnSpecCache:
+    """
+    Cache of spawn specs, keyed by project id.
+
+    A cached spec is reused as long as the project's execution profile is unchanged
+    and its directory hasn't been replaced. Otherwise (because the project row has
+    been updated, or the directory has been removed and created again), a new spec is
+    compiled and replaces the cached one.
+    """
+
+    def __init__(self) -> None:
+        self._specs: Dict[int, Tuple[ExecutionProfile, SpawnSpec]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, project_id: int, profile: ExecutionProfile) -> SpawnSpec:
+        """Return the spawn spec for a project's execution profile."""
+
+        with self._lock:
+            cached = self._specs.get(project_id)
+        if cached is not None and cached[0] == profile and cached[1].is_current():
+            with self._lock:
+                self.hits += 1
+            return cached[1]
+
+        spec = compile_spec(profile)
+        with self._lock:
+            self.misses += 1
+            self._specs[project_id] = (profile, spec)
+        return spec
+
+    def invalidate(self, project_id: Optional[int] = None) -> None:
+        """Remove the spec for a project, or all specs if no project id is given."""
+
+        with self._lock:
+            if project_id is None:
+                self._specs.clear()
+            else:
+                self._specs.pop(project_id, None)
@@ -0,0 +1,365 @@
+"""Rate limiting and debouncing of runs."""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from remote_command_server import util
+from remote_command_server.executor import Job
+from remote_command_server.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    A token bucket.
+
+    The bucket holds up to capacity tokens and is refilled at a rate of rate tokens
+    per second. Timestamps are wall clock times (as returned by time.time), so that the
+    bucket state remains valid when it is persisted and loaded after a restart.
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(
+        self, capacity: float, rate: float, tokens: float, updated: float
+    ) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, now: float) -> None:
+        """Add the tokens accrued since the last update."""
+
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """
+        Take a token from the bucket.
+
+        Zero is returned if a token could be taken. Otherwise the time (in seconds)
+        until the next token becomes available is returned.
+        """
+
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def wait_time(self, now: float) -> float:
+        """
+        Return the time (in seconds) until a token is available, without taking it.
+        """
+
+        tokens = self.tokens + max(now - self.updated, 0) * self.rate
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """Check whether the bucket would be full at a given time."""
+
+        return self.tokens + max(now - self.updated, 0) * self.rate >= self.capacity
+
+
+class BucketStore:
+    """
+    SQLite persistence for token buckets.
+
+    The buckets are not written on every request. Instead, all buckets are saved
+    periodically and when the server shuts down, and they are loaded when the server
+    starts.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with util.sqlite_connection(self.path) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def load(self) -> Dict[str, Tuple[float, float]]:
+        """Load all bucket states, as a dictionary of tokens and update times."""
+
+        with util.sqlite_connection(self.path) as connection:
+            rows = connection.execute("SELECT key, tokens, updated FROM buckets")
+            return {key: (tokens, updated) for key, tokens, updated in rows}
+
+    def save(self, states: Iterable[Tuple[str, float, float]]) -> None:
+        """Replace the stored bucket states with the given ones."""
+
+        with util.sqlite_connection(self.path) as connection:
+            connection.execute("DELETE FROM buckets")
+            connection.executemany(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", states
+            )
+
+
+class RateLimiter:
+    """
+    Rate limiter with a token bucket per key.
+
+    A bucket which would be full can be discarded without changing the limiter's
+    behavior. Such buckets are removed whenever there are more than max_keys buckets,
+    so that random keys (such as invalid tokens) cannot exhaust the memory.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Take a token for a key.
+
+        Zero is returned if the request is allowed. Otherwise the time (in seconds)
+        after which the request should be retried is returned.
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = TokenBucket(self.burst, self.rate, self.burst, now)
+                self._buckets[key] = bucket
+            return bucket.take(now)
+
+    def wait_time(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Return the time (in seconds) until a token is available for a key.
+
+        Unlike take, this does not take a token.
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            return bucket.wait_time(now) if bucket is not None else 0
+
+    def states(self, prefix: str = "") -> Iterable[Tuple[str, float, float]]:
+        """Return the bucket states, with a prefix added to the keys."""
+
+        with self._lock:
+            return [
+                (prefix + key, bucket.tokens, bucket.updated)
+                for key, bucket in self._buckets.items()
+            ]
+
+    def restore(self, states: Dict[str, Tuple[float, float]], prefix: str = "") -> None:
+        """Restore the buckets whose key starts with a prefix."""
+
+        with self._lock:
+            for key, (tokens, updated) in states.items():
+                if key.startswith(prefix):
+                    self._buckets[key.replace(prefix, "", 1)] = TokenBucket(
+                        self.burst, self.rate, min(tokens, self.burst), updated
+                    )
+
+    def _prune(self, now: float) -> None:
+        full_keys = [
+            key for key, bucket in self._buckets.items() if bucket.is_full(now)
+        ]
+        for key in full_keys:
+            del self._buckets[key]
+
+
+class Debouncer:
+    """
+    Trailing-edge debouncing of jobs.
+
+    A job is run once no further job for the same project has been triggered for the
+    debounce window. A burst of triggers thus results in a single run of the most
+    recent job. To avoid postponing the run forever, the job is run at the latest
+    max_delay seconds after the first trigger of the burst.
+    """
+
+    def __init__(self, max_delay: float) -> None:
+        self.max_delay = max_delay
+        self._deadlines: Dict[int, Tuple[float, float]] = {}
+        self._jobs: Dict[int, Job] = {}
+        self._tasks: Dict[int, "asyncio.Task[None]"] = {}
+
+    def trigger(
+        self, job: Job, window: float, run: Callable[[Job], Awaitable[object]]
+    ) -> bool:
+        """
+        Trigger a job.
+
+        True is returned if this is the first trigger of a burst, False otherwise.
+        """
+
+        project_id = job.project_id
+        now = time.monotonic()
+        self._jobs[project_id] = job
+        if project_id in self._tasks:
+            _, latest = self._deadlines[project_id]
+            self._deadlines[project_id] = (now + window, latest)
+            return False
+
+        self._deadlines[project_id] = (now + window, now + self.max_delay)
+        self._tasks[project_id] = asyncio.ensure_future(self._run(project_id, run))
+        return True
+
+    def pending(self) -> int:
+        """Return the number of projects with a pending run."""
+
+        return len(self._tasks)
+
+    async def _run(
+        self, project_id: int, run: Callable[[Job], Awaitable[object]]
+    ) -> None:
+        try:
+            while True:
+                deadline, latest = self._deadlines[project_id]
+                delay = min(deadline, latest) - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            job = self._jobs.pop(project_id)
+            del self._deadlines[project_id]
+            del self._tasks[project_id]
+        try:
+            await run(job)
+        except Exception:
+            logger.exception("Debounced run of %s failed", job.project_name)
+
+
+class Throttle:
+    """
+    The rate limiters and debouncer for runs.
+
+    There may be a rate limiter for tokens, one for projects and one for clients; a
+    missing rate limiter means that there is no limit. The client limiter is checked
+    before a request is authenticated, the token and project limiters only
+    afterwards, so that requests with invalid tokens can't use up the requests of a
+    project.
+    """
+
+    def __init__(
+        self,
+        token_limiter: Optional[RateLimiter],
+        project_limiter: Optional[RateLimiter],
+        debouncer: Debouncer,
+        store: Optional[BucketStore] = None,
+        client_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        self.token_limiter = token_limiter
+        self.project_limiter = project_limiter
+        self.client_limiter = client_limiter
+        self.debouncer = debouncer
+        self.store = store
+
+    @staticmethod
+    def from_settings(settings: Settings) -> "Throttle":
+        """Create the throttle defined by the settings."""
+
+        token_limiter = (
+            RateLimiter(settings.token_rate_limit, settings.token_rate_burst)
+            if settings.token_rate_limit
+            else None
+        )
+        project_limiter = (
+            RateLimiter(settings.project_rate_limit, settings.project_rate_burst)
+            if settings.project_rate_limit
+            else None
+        )
+        client_limiter = (
+            RateLimiter(settings.client_rate_limit, settings.client_rate_burst)
+            if settings.client_rate_limit
+            else None
+        )
+        store = (
+            BucketStore(settings.rate_limit_database)
+            if settings.rate_limit_database
+            else None
+        )
+        return Throttle(
+            token_limiter=token_limiter,
+            project_limiter=project_limiter,
+            debouncer=Debouncer(max_delay=settings.debounce_max_delay),
+            store=store,
+            client_limiter=client_limiter,
+        )
+
+    def check_client(self, client: str) -> float:
+        """
+        Check the rate limit for a client's request, before it is authenticated.
+
+        Zero is returned if the request is allowed. Otherwise the time (in seconds)
+        after which the request should be retried is returned.
+        """
+
+        if self.client_limiter is None:
+            return 0
+        return self.client_limiter.take(client)
+
+    def check(self, project_name: str, hashed_token: str) -> float:
+        """
+        Check the rate limits for an authenticated request.
+
+        Zero is returned if the request is allowed. Otherwise the time (in seconds)
+        after which the request should be retried is returned. A request rejected by
+        the token limiter does not use up a token of the project limiter.
+        """
+
+        if self.token_limiter is not None:
+            retry_after = self.token_limiter.take(hashed_token)
+            if retry_after:
+                return retry_after
+        if self.project_limiter is not None:
+            return self.project_limiter.take(project_name)
+        return 0
+
+    def load(self) -> None:
+        """Load the persisted bucket states, if there is a store."""
+
+        if self.store is None:
+            return
+        states = self.store.load()
+        if self.token_limiter is not None:
+            self.token_limiter.restore(states, prefix="token:")
+        if self.project_limiter is not None:
+            self.project_limiter.restore(states, prefix="project:")
+        if self.client_limiter is not None:
+            self.client_limiter.restore(states, prefix="client:")
+
+    def save(self) -> None:
+        """Persist the bucket states, if there is a store."""
+
+        if self.store is None:
+            return
+        states: List[Tuple[str, float, float]] = []
+        if self.token_limiter is not None:
+            states.extend(self.token_limiter.states(prefix="token:"))
+        if self.project_limiter is not None:
+            states.extend(self.project_limiter.states(prefix="project:"))
+        if self.client_limiter is not None:
+            states.extend(self.client_limiter.states(prefix="client:"))
+        self.store.save(states)
+
+
+async def persist_loop(throttle: Throttle, interval: float) -> None:
+    """Persist the bucket states of a throttle every interval seconds."""
+
+    if throttle.store is None:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(throttle.save)
+        except Exception:
+            logger.exception("Could not persist the rate limits")
@@ -0,0 +1,167 @@
+"""Timing and profiling of requests."""
+
+import contextlib
+import contextvars
+import cProfile
+import pathlib
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from remote_command_server import crud, events
+from remote_command_server.settings import get_settings
+
+PROFILE_HEADER = "X-RCS-Profile"
+
+_current_timer: "contextvars.ContextVar[Optional[PhaseTimer]]" = contextvars.ContextVar(
+    "current_timer", default=None
+)
+
+# held while a request is profiled, as there can only be one active profiler
+_profiler_lock = threading.Lock()
+
+
+class PhaseTimer:
+    """
+    Timer for the phases of a request.
+
+    The durations of phases with the same name are added up. All durations are in
+    milliseconds.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a phase of the request."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = 1000 * (time.perf_counter() - start)
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    def total(self) -> float:
+        """Return the time since the timer was created."""
+
+        return 1000 * (time.perf_counter() - self.start)
+
+    def server_timing(self) -> str:
+        """Return the phase durations as the value of a Server-Timing header."""
+
+        metrics = [
+            f"{name};dur={duration:.3f}" for name, duration in self.phases.items()
+        ]
+        metrics.append(f"total;dur={self.total():.3f}")
+        return ", ".join(metrics)
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Time a phase of the current request.
+
+    Nothing is timed if there is no current request, for example if the code is called
+    from a test or from the command line.
+    """
+
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware for timing requests.
+
+    The durations of the request phases are returned in a Server-Timing header and
+    emitted as a request_timing event once the response has been sent.
+
+    If a request is profiled, its profile is saved in the profile directory, provided
+    the request took at least as long as the profile threshold. A request is profiled
+    if the X-RCS-Profile header contains the admin token, or if it is randomly chosen
+    according to the profile sample rate. As the profiler runs in the event loop's
+    thread, its output includes other requests handled concurrently, but not
+    functions running in the thread pool. Only one request is profiled at a time, as
+    cProfile doesn't support several active profilers; requests arriving meanwhile
+    are not profiled.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        settings = get_settings()
+        profiler = _profiler(scope) if settings.profile_directory else None
+        if profiler is not None and not _profiler_lock.acquire(blocking=False):
+            profiler = None
+        timer = PhaseTimer()
+        status_code = 500
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = MutableHeaders(raw=message["headers"])
+                headers.append("Server-Timing", timer.server_timing())
+            await send(message)
+
+        reset_token = _current_timer.set(timer)
+        try:
+            if profiler is not None:
+                profiler.enable()
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profiler_lock.release()
+            _current_timer.reset(reset_token)
+
+        total = timer.total()
+        events.event_log.emit(
+            "request_timing",
+            method=scope["method"],
+            path=scope["path"],
+            status=status_code,
+            total_ms=round(total, 3),
+            phases_ms={
+                name: round(duration, 3) for name, duration in timer.phases.items()
+            },
+        )
+
+        if profiler is not None and total >= 1000 * settings.profile_threshold:
+            await run_in_threadpool(_save_profile, profiler, scope["path"])
+
+
+def _profiler(scope: Scope) -> Optional[cProfile.Profile]:
+    profile_token = Headers(scope=scope).get(PROFILE_HEADER)
+    if profile_token is not None and crud.verify_admin_token(profile_token):
+        return cProfile.Profile()
+    if random.random() < get_settings().profile_sample_rate:  # nosec
+        return cProfile.Profile()
+    return None
+
+
+def _save_profile(profiler: cProfile.Profile, path: str) -> None:
+    profile_directory = pathlib.Path(str(get_settings().profile_directory))
+    profile_directory.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f")
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", path).strip("_")
+    profiler.dump_stats(str(profile_directory / f"{timestamp}-{name}.prof"))
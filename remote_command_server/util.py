@@ -1,12 +1,52 @@
 """Utility functions for the server."""
 
+import contextlib
+import os
 import pathlib
+import selectors
+import signal
+import sqlite3
 import subprocess  # nosec
+from typing import IO, Callable, Dict, Iterator, List, Optional, cast
+
+from remote_command_server import timing
+from remote_command_server.resources import (
+    Cgroup,
+    ResourceUsage,
+    usage_from_rusage,
+)
+from remote_command_server.spawn import SpawnSpec
+
+OutputCallback = Callable[[str, bytes], None]
+
+_CHUNK_SIZE = 65536
+
+
+class CommandResult(subprocess.CompletedProcess):  # type: ignore
+    """A completed process with the resources used by the command."""
+
+    def __init__(
+        self,
+        args: str,
+        returncode: int,
+        stdout: Optional[bytes],
+        stderr: Optional[bytes],
+        usage: Optional[ResourceUsage],
+    ):
+        super().__init__(args, returncode, stdout, stderr)
+        self.usage = usage
 
 
 def run_command(
-    directory: pathlib.Path, command: str
-) -> subprocess.CompletedProcess:  # type: ignore
+    directory: pathlib.Path,
+    command: str,
+    spec: Optional[SpawnSpec] = None,
+    on_output: Optional[OutputCallback] = None,
+    capture_output: bool = True,
+    cgroup: Optional[Cgroup] = None,
+    on_start: Optional[Callable[[int], None]] = None,
+    on_exit: Optional[Callable[[], None]] = None,
+) -> CommandResult:
     """
     Run a command in a directory.
 
@@ -15,8 +55,33 @@ def run_command(
 
     The directory must exist (and must be a directory).
 
-    The function returns a CompletedProcess instance, with stdout and stderr captured.
-    For example:
+    If a spawn spec is passed, the command is run in the spec's working directory, with
+    the spec's environment, umask and resource limits. The directory is not checked in
+    this case, as it has been checked when the spec was compiled.
+
+    The output is read as it arrives. If an on_output callback is passed, it is called
+    with the stream name ("stdout" or "stderr") and the data for every chunk read. If
+    capture_output is false, the output is not kept in memory, and the stdout and
+    stderr of the returned result are None.
+
+    If a cgroup is passed, the command is run in it and the resource usage is taken
+    from the cgroup's accounting where possible.
+
+    The shell joins the cgroup and applies the umask and resource limits before
+    running the command. If this fails, the command is not run and the exit code is
+    126.
+
+    The command is run in a new session, so that it isn't affected by signals sent to
+    the server's process group, and so that it can be stopped together with all its
+    child processes by signalling its process group. If an on_start callback is
+    passed, it is called with the process id once the command has been started. If an
+    on_exit callback is passed, it is called once the command has exited, but (where
+    the system supports waiting without reaping) before the process is reaped, so
+    that the process id can't have been reused by another process yet. Callers which
+    signal the process should forget its id in on_exit.
+
+    The function returns a CommandResult instance, which is a CompletedProcess with
+    the resource usage of the command. For example:
 
     r = run_command(directory="./tests", command="echo $(pwd)"
     if r.returncode:
@@ -26,9 +91,130 @@ def run_command(
 
     """
 
-    if not directory.exists() or not directory.is_dir():
+    if spec is None and (not directory.exists() or not directory.is_dir()):
         raise ValueError(f"Does not exist or is no directory: {directory}")
 
-    return subprocess.run(
-        command, shell=True, cwd=directory, capture_output=True  # nosec
+    prologue = list(spec.prologue) if spec else []
+    if cgroup is not None:
+        prologue.insert(0, cgroup.join_command())
+    # the command follows on its own line, so that it can't change how the prologue
+    # is parsed
+    script = "".join(f"{line} || exit 126\n" for line in prologue) + command
+
+    with timing.phase("spawn"):
+        process = subprocess.Popen(
+            script,
+            shell=True,  # nosec
+            cwd=spec.directory if spec else directory,
+            env=spec.env if spec else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    with timing.phase("command"):
+        try:
+            if on_start is not None:
+                on_start(process.pid)
+            output = _read_output(process, on_output, capture_output)
+            if hasattr(os, "waitid"):
+                os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            if on_exit is not None:
+                on_exit()
+            _, status, rusage = os.wait4(process.pid, 0)
+        except BaseException:
+            # the command's descendants are in its process group, and they must not
+            # outlive it
+            kill_process_group(process.pid, signal.SIGKILL)
+            if on_exit is not None:
+                on_exit()
+            process.wait()
+            raise
+
+    # Popen must not wait for the process, as it has been reaped by wait4 already
+    process.returncode = _exit_code(status)
+    usage = usage_from_rusage(rusage)
+    if cgroup is not None:
+        usage = cgroup.usage(usage)
+
+    return CommandResult(
+        command,
+        process.returncode,
+        output["stdout"],
+        output["stderr"],
+        usage,
     )
+
+
+def kill_process_group(pid: int, sig: int) -> None:
+    """
+    Send a signal to the process group of a command run by run_command.
+
+    The group's id is the pid of the command's shell. Nothing happens if the group
+    doesn't exist anymore.
+    """
+
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+@contextlib.contextmanager
+def sqlite_connection(path: str) -> Iterator[sqlite3.Connection]:
+    """
+    Open a connection to an SQLite database, for a transaction.
+
+    The transaction is committed when the context is left, or rolled back if there is
+    an exception, and the connection is closed either way.
+    """
+
+    # a connection's context manager commits, but it doesn't close it
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _read_output(
+    process: "subprocess.Popen[bytes]",
+    on_output: Optional[OutputCallback],
+    capture_output: bool,
+) -> Dict[str, Optional[bytes]]:
+    streams: Dict[IO[bytes], str] = {}
+    if process.stdout is not None:
+        streams[process.stdout] = "stdout"
+    if process.stderr is not None:
+        streams[process.stderr] = "stderr"
+    chunks: Dict[str, List[bytes]] = {name: [] for name in streams.values()}
+
+    with selectors.DefaultSelector() as selector:
+        for stream in streams:
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, _CHUNK_SIZE)
+                stream = cast(IO[bytes], key.fileobj)
+                if not data:
+                    selector.unregister(stream)
+                    stream.close()
+                    continue
+                name = streams[stream]
+                if on_output is not None:
+                    on_output(name, data)
+                if capture_output:
+                    chunks[name].append(data)
+
+    return {
+        name: b"".join(chunks[name]) if capture_output else None
+        for name in ("stdout", "stderr")
+    }
+
+
+def _exit_code(status: int) -> int:
+    # the return code convention of subprocess: negative signal numbers for processes
+    # killed by a signal
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
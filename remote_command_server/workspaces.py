@@ -0,0 +1,274 @@
+"""Pools of workspaces for running a project's command in parallel."""
+
+import asyncio
+import contextlib
+import errno
+import fcntl
+import os
+import pathlib
+import shutil
+import stat
+import subprocess  # nosec
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+COPY = "copy"
+HARDLINK = "hardlink"
+GIT = "git"
+METHODS = (COPY, HARDLINK, GIT)
+
+# the ioctl for cloning a file (creating a reflink copy) on Linux
+_FICLONE = 0x40049409
+
+
+class WorkspacePool:
+    """
+    A pool of copies of a project directory, which are leased to runs.
+
+    The workspaces are created when they are first needed, with one of the methods
+
+    * "copy": a copy of the directory; files are copied as reflinks where the file
+      system supports it (as on Btrfs or XFS), so that they share their data with the
+      original until they are changed,
+    * "hardlink": a copy of the directory tree whose files are hard links to the
+      original files; this is only safe for commands which replace files rather than
+      changing them in place,
+    * "git": a git worktree of the repository's current commit.
+
+    Before a workspace is leased, it is reset incrementally to the state of the
+    directory: copies are synchronized, so that only changed files are copied and
+    files which don't exist in the directory are removed. Git worktrees are checked
+    out at the repository's current commit and cleaned, but files ignored by git
+    (such as build outputs) are kept.
+
+    Pools which share their locks (such as the pools replacing each other when a
+    project changes) never lease the same workspace directory at the same time: a run
+    of one pool waits until runs of the others have returned the directory.
+    """
+
+    def __init__(
+        self,
+        source: pathlib.Path,
+        root: pathlib.Path,
+        size: int,
+        method: str,
+        locks: Optional[Dict[pathlib.Path, asyncio.Lock]] = None,
+    ) -> None:
+        if method not in METHODS:
+            raise ValueError(f"Unknown workspace method: {method}")
+        self.source = source
+        self.root = root
+        self.size = size
+        self.method = method
+        self._free: Optional["asyncio.Queue[int]"] = None
+        self._locks: Dict[pathlib.Path, asyncio.Lock] = {} if locks is None else locks
+
+    @contextlib.asynccontextmanager
+    async def lease(self) -> AsyncIterator[pathlib.Path]:
+        """
+        Wait for a free workspace, reset it and lease it.
+
+        The workspace is returned to the pool when the context is left.
+        """
+
+        if self._free is None:
+            self._free = asyncio.Queue()
+            for index in range(self.size):
+                self._free.put_nowait(index)
+        index = await self._free.get()
+        try:
+            workspace = self.root / str(index)
+            lock = self._locks.get(workspace)
+            if lock is None:
+                lock = self._locks[workspace] = asyncio.Lock()
+            async with lock:
+                await run_in_threadpool(self.prepare, workspace)
+                yield workspace
+        finally:
+            self._free.put_nowait(index)
+
+    def prepare(self, workspace: pathlib.Path) -> None:
+        """Create a workspace, or reset it if it exists already."""
+
+        if self.method == GIT:
+            _prepare_worktree(self.source, workspace)
+        else:
+            workspace.parent.mkdir(parents=True, exist_ok=True)
+            synchronize(self.source, workspace, link=self.method == HARDLINK)
+
+
+class WorkspacePools:
+    """
+    The workspace pools of all projects, keyed by project id.
+
+    A project's pool is replaced if its definition has changed. Runs may still be
+    using the replaced pool, so all pools share their locks, so that a workspace
+    directory is never leased by the replaced pool and its successor at once.
+    """
+
+    def __init__(self) -> None:
+        self._pools: Dict[int, WorkspacePool] = {}
+        self._locks: Dict[pathlib.Path, asyncio.Lock] = {}
+
+    def get(
+        self,
+        project_id: int,
+        directory: str,
+        size: int,
+        method: Optional[str] = None,
+        root: Optional[str] = None,
+    ) -> WorkspacePool:
+        """
+        Return the workspace pool of a project.
+
+        If no method is given, a git worktree is used if the directory is a git
+        repository, and a copy otherwise. By default, the workspaces are stored next
+        to the directory, so that they are on the same file system.
+        """
+
+        source = pathlib.Path(directory)
+        if method is None:
+            method = GIT if (source / ".git").exists() else COPY
+        workspace_root = (
+            pathlib.Path(root) / str(project_id)
+            if root
+            else source.parent / f".{source.name}.workspaces"
+        )
+        pool = self._pools.get(project_id)
+        if pool is None or _definition(pool) != (source, workspace_root, size, method):
+            pool = WorkspacePool(source, workspace_root, size, method, self._locks)
+            self._pools[project_id] = pool
+        return pool
+
+
+def _definition(pool: WorkspacePool) -> Tuple[pathlib.Path, pathlib.Path, int, str]:
+    return pool.source, pool.root, pool.size, pool.method
+
+
+def synchronize(source: pathlib.Path, target: pathlib.Path, link: bool) -> None:
+    """
+    Make a directory an exact copy of another one, copying only changed files.
+
+    Files are considered unchanged if their size and modification time are the same.
+    If link is true, files are hard links to the source files rather than copies.
+    Symbolic links are copied as symbolic links.
+    """
+
+    target.mkdir(exist_ok=True)
+    with os.scandir(source) as entries:
+        source_entries = {entry.name: entry for entry in entries}
+
+    with os.scandir(target) as entries:
+        for entry in entries:
+            if entry.name not in source_entries or _kind(entry) != _kind(
+                source_entries[entry.name]
+            ):
+                _remove(entry)
+
+    for name, entry in source_entries.items():
+        source_path = source / name
+        target_path = target / name
+        if entry.is_dir(follow_symlinks=False):
+            synchronize(source_path, target_path, link)
+        elif entry.is_symlink():
+            link_target = os.readlink(source_path)
+            if not target_path.is_symlink() or os.readlink(target_path) != link_target:
+                _remove_path(target_path)
+                os.symlink(link_target, target_path)
+        elif entry.is_file(follow_symlinks=False):
+            _synchronize_file(source_path, target_path, entry.stat(), link)
+
+
+def _synchronize_file(
+    source: pathlib.Path, target: pathlib.Path, source_stat: os.stat_result, link: bool
+) -> None:
+    try:
+        target_stat: Optional[os.stat_result] = os.lstat(target)
+    except FileNotFoundError:
+        target_stat = None
+
+    if target_stat is not None:
+        if link and os.path.samestat(source_stat, target_stat):
+            return
+        if (
+            not link
+            and target_stat.st_size == source_stat.st_size
+            and target_stat.st_mtime_ns == source_stat.st_mtime_ns
+        ):
+            return
+        # a hard link must be removed before the file is replaced, as writing to it
+        # would change the source file as well
+        os.unlink(target)
+
+    if link:
+        os.link(source, target)
+    else:
+        _copy_file(source, target)
+        shutil.copystat(source, target)
+
+
+def _copy_file(source: pathlib.Path, target: pathlib.Path) -> None:
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+            return
+        except OSError as e:
+            if e.errno not in (
+                errno.EOPNOTSUPP,
+                errno.ENOTTY,
+                errno.EXDEV,
+                errno.EINVAL,
+                errno.ENOSYS,
+            ):
+                raise
+        shutil.copyfileobj(source_file, target_file)
+
+
+def _kind(entry: "os.DirEntry[str]") -> int:
+    return stat.S_IFMT(entry.stat(follow_symlinks=False).st_mode)
+
+
+def _remove(entry: "os.DirEntry[str]") -> None:
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.unlink(entry.path)
+
+
+def _remove_path(path: pathlib.Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def _prepare_worktree(repository: pathlib.Path, workspace: pathlib.Path) -> None:
+    commit = _git(repository, "rev-parse", "HEAD")
+    if not (workspace / ".git").exists():
+        _remove_path(workspace)
+        workspace.parent.mkdir(parents=True, exist_ok=True)
+        _git(repository, "worktree", "prune")
+        _git(repository, "worktree", "add", "--detach", str(workspace), commit)
+        return
+    _git(workspace, "checkout", "--force", "--detach", commit)
+    _git(workspace, "clean", "--force", "-d")
+
+
+def _git(directory: pathlib.Path, *arguments: str) -> str:
+    result = subprocess.run(  # nosec
+        ["git", "-C", str(directory), *arguments],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    if result.returncode:
+        raise ValueError(
+            f"git {arguments[0]} failed in {directory}: "
+            + result.stderr.decode(errors="replace").strip()
+        )
+    return result.stdout.decode().strip()
+
+
+# the workspace pools of all projects
+pools = WorkspacePools()
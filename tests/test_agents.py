@@ -0,0 +1,314 @@
+"""Tests for running commands on remote agents."""
+
+import asyncio
+import base64
+import json
+import pathlib
+import threading
+import time
+from typing import Any, AsyncIterator, List, Tuple
+
+import pytest
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from starlette.websockets import WebSocketDisconnect
+
+from remote_command_server import agents, crud, executor, logfiles
+from remote_command_server.agents import (
+    Agent,
+    AgentDisconnected,
+    AgentPool,
+    AgentWorker,
+    NoAgentAvailable,
+)
+from remote_command_server.executor import Job
+from remote_command_server.main import app
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+def _agent(name: str, labels: List[str], capacity: int = 1) -> Tuple[Agent, List[Any]]:
+    sent: List[Any] = []
+
+    async def send(message: Any) -> None:
+        sent.append(message)
+
+    return Agent(name, frozenset(labels), capacity, send), sent
+
+
+def test_select_least_loaded_agent() -> None:
+    """Runs are dispatched to the least loaded agent with the requested label."""
+
+    pool = AgentPool()
+    busy, _ = _agent("busy", ["linux"], capacity=2)
+    idle, _ = _agent("idle", ["linux"], capacity=4)
+    other, _ = _agent("other", ["windows"])
+    busy.active = 1
+    idle.active = 1
+    for agent in (busy, idle, other):
+        pool.register(agent)
+
+    assert pool.select("linux") is idle
+    assert pool.select("windows") is other
+    with pytest.raises(NoAgentAvailable):
+        pool.select("macos")
+
+    pool.unregister(other)
+    with pytest.raises(NoAgentAvailable):
+        pool.select("windows")
+
+
+def test_run_on_agent() -> None:
+    """The output and exit code sent by the agent are passed on."""
+
+    async def run() -> Tuple[Any, List[Any], List[Tuple[str, bytes]]]:
+        pool = AgentPool()
+        agent, sent = _agent("agent", ["linux"])
+        pool.register(agent)
+        output: List[Tuple[str, bytes]] = []
+        profile = ExecutionProfile(directory="/tmp")
+        run = asyncio.ensure_future(
+            pool.run(
+                "linux",
+                "some-key",
+                1,
+                "echo Hello",
+                profile,
+                on_output=lambda stream, data: output.append((stream, data)),
+            )
+        )
+        await asyncio.sleep(0.01)
+        assert agent.active == 1
+        data = base64.b64encode(b"Hello\n").decode()
+        pool.handle_message(
+            agent,
+            {"type": "output", "key": "some-key", "stream": "stdout", "data": data},
+        )
+        pool.handle_message(
+            agent,
+            {
+                "type": "exit",
+                "key": "some-key",
+                "command": "echo Hello",
+                "returncode": 3,
+                "usage": None,
+            },
+        )
+        result = await run
+        assert agent.active == 0
+        return result, sent, output
+
+    result, sent, output = asyncio.run(run())
+
+    assert result.returncode == 3
+    assert output == [("stdout", b"Hello\n")]
+    assert sent[0]["type"] == "run"
+    assert sent[0]["command"] == "echo Hello"
+    assert agents.profile_from_message(sent[0]["profile"]) == ExecutionProfile(
+        directory="/tmp"
+    )
+
+
+def test_disconnected_agent_fails_its_runs() -> None:
+    """Runs of an agent which disconnects fail with an AgentDisconnected error."""
+
+    async def run() -> None:
+        pool = AgentPool()
+        agent, _ = _agent("agent", ["linux"])
+        pool.register(agent)
+        run = asyncio.ensure_future(
+            pool.run("linux", "some-key", 1, "pwd", ExecutionProfile(directory="/"))
+        )
+        await asyncio.sleep(0.01)
+        pool.unregister(agent)
+        with pytest.raises(AgentDisconnected):
+            await run
+
+    asyncio.run(run())
+
+
+def test_worker_runs_commands(tmp_path: pathlib.Path) -> None:
+    """The agent worker runs commands and sends their output and exit code."""
+
+    async def run() -> List[Any]:
+        sent: List[Any] = []
+        done = asyncio.Event()
+
+        async def send(message: str) -> None:
+            sent.append(json.loads(message))
+            if sent[-1]["type"] == "exit":
+                done.set()
+
+        async def messages() -> AsyncIterator[str]:
+            yield json.dumps(
+                {
+                    "type": "run",
+                    "key": "some-key",
+                    "project_id": 1,
+                    "command": "echo Hello; exit 2",
+                    "profile": agents.profile_to_message(
+                        ExecutionProfile(directory=str(tmp_path))
+                    ),
+                }
+            )
+            await asyncio.wait_for(done.wait(), timeout=5)
+
+        await AgentWorker(send, capacity=1).serve(messages())
+        return sent
+
+    sent = asyncio.run(run())
+
+    output = b"".join(
+        base64.b64decode(message["data"])
+        for message in sent
+        if message["type"] == "output"
+    )
+    assert output == b"Hello\n"
+    assert sent[-1]["type"] == "exit"
+    assert sent[-1]["returncode"] == 2
+
+
+def test_execute_on_agent(tmp_path: pathlib.Path, monkeypatch: MonkeyPatch) -> None:
+    """
+    Jobs with an agent label are run on an agent, and their output is logged outside
+    the event loop's thread.
+    """
+
+    monkeypatch.setenv("RCS_LOG_DIRECTORY", str(tmp_path))
+    write = logfiles.LogWriter.write
+    threads: List[int] = []
+
+    def record_write(self: logfiles.LogWriter, data: bytes) -> None:
+        threads.append(threading.get_ident())
+        write(self, data)
+
+    monkeypatch.setattr(logfiles.LogWriter, "write", record_write)
+
+    async def run() -> executor.RunResult:
+        agent, sent = _agent("agent", ["linux"])
+        agents.agent_pool.register(agent)
+        try:
+            job = Job(
+                project_id=1,
+                project_name="some-project",
+                command="echo Hello",
+                profile=ExecutionProfile(directory=str(tmp_path)),
+                agent_label="linux",
+            )
+            run = asyncio.ensure_future(executor.execute(job))
+            while not sent:
+                await asyncio.sleep(0.01)
+            key = sent[0]["key"]
+            for message in (
+                {
+                    "type": "output",
+                    "key": key,
+                    "stream": "stdout",
+                    "data": base64.b64encode(b"Hello\n").decode(),
+                },
+                {"type": "exit", "key": key, "command": "echo Hello", "returncode": 0},
+            ):
+                agents.agent_pool.handle_message(agent, message)
+            return await run
+        finally:
+            agents.agent_pool.unregister(agent)
+
+    result = asyncio.run(run())
+
+    assert result.returncode == 0
+    assert not result.interrupted
+    assert list(tmp_path.glob("**/*.log"))[0].read_bytes() == b"Hello\n"
+    assert threads and threading.get_ident() not in threads
+
+
+def test_agent_connection_requires_agent_token(monkeypatch: MonkeyPatch) -> None:
+    """Agents must authenticate with the agent token."""
+
+    monkeypatch.setenv("RCS_AGENT_TOKEN_HASH", crud.hash_token("agent-token"))
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(
+            "/agents/connect", headers={"Authorization": "Bearer wrong-token"}
+        ) as websocket:
+            websocket.receive_json()
+
+    with client.websocket_connect(
+        "/agents/connect", headers={"Authorization": "Bearer agent-token"}
+    ) as websocket:
+        websocket.send_json(
+            {"type": "hello", "name": "some-agent", "labels": ["linux"], "capacity": 2}
+        )
+        for _ in range(100):
+            if agents.agent_pool.agents():
+                break
+            time.sleep(0.01)
+        (agent,) = agents.agent_pool.agents()
+        assert agent.name == "some-agent"
+        assert agent.capacity == 2
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        {"type": "hello", "name": "some-agent", "labels": "linux", "capacity": 2},
+        {"type": "hello", "name": "some-agent"},
+        ["hello"],
+    ],
+)
+def test_agent_connection_rejects_invalid_hello(
+    monkeypatch: MonkeyPatch, message: Any
+) -> None:
+    """An agent introducing itself with a malformed message is disconnected."""
+
+    monkeypatch.setenv("RCS_AGENT_TOKEN_HASH", crud.hash_token("agent-token"))
+
+    with client.websocket_connect(
+        "/agents/connect", headers={"Authorization": "Bearer agent-token"}
+    ) as websocket:
+        websocket.send_json(message)
+        with pytest.raises(WebSocketDisconnect) as excinfo:
+            websocket.receive_json()
+
+    assert excinfo.value.code == 1008
+    assert agents.agent_pool.agents() == []
+
+
+def test_agent_connection_closes_on_malformed_message(
+    monkeypatch: MonkeyPatch,
+) -> None:
+    """An agent sending a malformed message is disconnected."""
+
+    monkeypatch.setenv("RCS_AGENT_TOKEN_HASH", crud.hash_token("agent-token"))
+
+    with client.websocket_connect(
+        "/agents/connect", headers={"Authorization": "Bearer agent-token"}
+    ) as websocket:
+        websocket.send_json(
+            {"type": "hello", "name": "some-agent", "labels": ["linux"], "capacity": 2}
+        )
+        websocket.send_json({"type": "exit"})
+        with pytest.raises(WebSocketDisconnect) as excinfo:
+            websocket.receive_json()
+
+    assert excinfo.value.code == 1008
+    assert agents.agent_pool.agents() == []
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        {"type": "output", "key": "run", "stream": "stdout", "data": "not base64!"},
+        {"type": "output", "key": "run"},
+        {"type": "exit", "key": "run", "command": "pwd"},
+        {"type": "unknown"},
+        "exit",
+    ],
+)
+def test_pool_rejects_malformed_messages(message: Any) -> None:
+    """Malformed messages of agents raise a ValueError."""
+
+    agent, _ = _agent("some-agent", ["linux"])
+
+    with pytest.raises(ValueError):
+        AgentPool().handle_message(agent, message)
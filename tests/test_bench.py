@@ -0,0 +1,73 @@
+"""Tests for the load generator."""
+
+import asyncio
+import pathlib
+
+from click.testing import CliRunner
+
+from remote_command_server import bench, executor
+from remote_command_server.bench import LatencyHistogram
+from remote_command_server.cli import cli
+from remote_command_server.executor import Job
+from remote_command_server.spawn import ExecutionProfile
+
+
+def test_latency_histogram_percentiles() -> None:
+    """Percentiles are accurate to 2%, and histograms can be merged."""
+
+    histogram = LatencyHistogram()
+    for i in range(1, 101):
+        histogram.add(i / 1000)
+    other = LatencyHistogram()
+    other.add(1.0)
+    histogram.merge(other)
+
+    assert histogram.count == 101
+    assert abs(histogram.percentile(50) - 0.051) <= 0.02 * 0.051
+    assert abs(histogram.percentile(99) - 0.1) <= 0.02 * 0.1
+    assert histogram.percentile(100) == histogram.max == 1.0
+    assert LatencyHistogram().percentile(50) == 0
+
+
+def test_fake_executor_replaces_commands(tmp_path: pathlib.Path) -> None:
+    """With the fake executor, no command is run, but output is produced."""
+
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="touch started",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+
+    with bench.fake_executor(latency=0, output_size=100000):
+        result = asyncio.run(executor.execute(job))
+
+    assert result.returncode == 0
+    assert result.output_size == 100000
+    assert not (tmp_path / "started").exists()
+
+
+def test_bench_reports_requests() -> None:
+    """The bench command makes requests against the server and reports them."""
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "bench",
+            "--projects",
+            "2",
+            "--concurrency",
+            "2",
+            "--requests",
+            "20",
+            "--latency",
+            "0",
+            "--report-interval",
+            "0.5",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Requests:    20 " in result.output
+    assert "Statuses:    200: 20" in result.output
@@ -1,12 +1,13 @@
 """Tests for the commabd line interface."""
+
 import pathlib
 from typing import List, Tuple
 
 import pytest
-from click.testing import CliRunner
+from click.testing import CliRunner, Result
 from sqlalchemy.orm import Session
 
-from remote_command_server import models, schemas
+from remote_command_server import models, schemas, snapshots
 from remote_command_server.cli import cli
 from remote_command_server.crud import create_project, create_token, hash_token
 from remote_command_server.database import database_connection
@@ -41,6 +42,458 @@ def test_project_creates_project(
     assert project.command == str("some command")
     assert project.directory == str(tmp_path)
     assert project.name == "Test Project"
+    assert project.debounce_window is None
+
+
+def test_project_stores_debounce_window(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the debounce window."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--debounce",
+            "2.5",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.debounce_window == 2.5
+
+
+def test_project_stores_share_window(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the share window."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--share-window",
+            "0",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.share_window == 0
+
+
+def test_project_stores_priority(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the priority."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--priority",
+            "-2",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.priority == -2
+
+
+def test_project_stores_workspaces(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the number of workspaces and their method."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--workspaces",
+            "3",
+            "--workspace-method",
+            "hardlink",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.workspaces == 3
+    assert project.workspace_method == "hardlink"
+
+
+def test_snapshot_exports_projects_and_tokens(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The snapshot command writes a snapshot which verifies the tokens."""
+
+    db, db_file = file_based_db
+    create_project(
+        db,
+        schemas.ProjectCreate(name="shiny-project", directory=".", command="true"),
+    )
+    token = create_token(db, "shiny-project")
+    snapshot_file = tmp_path / "snapshot"
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["snapshot", "--database", str(db_file), str(snapshot_file)]
+    )
+
+    assert result.exit_code == 0
+    assert "Exported 1 projects and 1 tokens" in result.output
+    snapshot = snapshots.Snapshot(snapshot_file)
+    assert snapshot.project("shiny-project", hash_token(token)) is not None
+    snapshot.close()
+
+
+def test_project_stores_output_policy(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the output policy, which must be valid."""
+
+    db, db_file = file_based_db
+    runner = CliRunner()
+    arguments = [
+        "project",
+        "--command",
+        "some command",
+        "--database",
+        str(db_file),
+        "--directory",
+        str(tmp_path),
+        "--name",
+        "Test Project",
+    ]
+
+    # a head can't be larger than the maximum size
+    result = runner.invoke(
+        cli, arguments + ["--output-max-bytes", "1K", "--output-head-bytes", "2K"]
+    )
+    assert result.exit_code != 0
+
+    result = runner.invoke(
+        cli,
+        arguments
+        + ["--output-max-bytes", "1M", "--output-head-bytes", "0", "--strip-ansi"],
+    )
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.output_max_bytes == 1024**2
+    assert project.output_head_bytes == 0
+    assert project.strip_ansi
+
+
+def test_project_stores_output_processors(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the output processors, which must be valid."""
+
+    db, db_file = file_based_db
+    runner = CliRunner()
+    arguments = [
+        "project",
+        "--command",
+        "some command",
+        "--database",
+        str(db_file),
+        "--directory",
+        str(tmp_path),
+        "--name",
+        "Test Project",
+    ]
+
+    # an invalid pattern is rejected
+    result = runner.invoke(cli, arguments + ["--extract", "coverage=(\\d+"])
+    assert result.exit_code != 0
+
+    result = runner.invoke(
+        cli,
+        arguments
+        + ["--extract", "coverage=(\\d+)%", "--junit", "--json-summary", "--tail", "3"],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.output_processors == [
+        {"type": "regex", "name": "coverage", "pattern": "(\\d+)%"},
+        {"type": "junit"},
+        {"type": "json"},
+        {"type": "tail", "lines": 3},
+    ]
+
+
+def test_project_stores_execution_profile(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the environment, path and umask."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--env",
+            "A=1",
+            "--env",
+            "B=x=y",
+            "--path",
+            "/usr/bin:/bin",
+            "--umask",
+            "027",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.environment == {"A": "1", "B": "x=y"}
+    assert project.path == "/usr/bin:/bin"
+    assert project.umask == 0o27
+
+
+def test_project_stores_resource_limits(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the resource limits."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--cpu-time",
+            "60",
+            "--memory",
+            "512M",
+            "--open-files",
+            "256",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.cpu_time_limit == 60
+    assert project.memory_limit == 512 * 1024**2
+    assert project.open_files_limit == 256
+
+
+def test_project_stores_schedule(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the schedule."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--schedule",
+            "*/5 * * * *",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.schedule == "*/5 * * * *"
+    assert project.last_scheduled_run is None
+
+
+def test_project_stores_agent_label(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the agent label."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            "--agent-label",
+            "gpu",
+        ],
+    )
+
+    # check the result
+    assert result.exit_code == 0
+    project = db.query(models.Project).first()
+    assert project.agent_label == "gpu"
+
+
+def test_project_stores_dependencies(
+    tmp_path: pathlib.Path, file_based_db: Tuple[Session, pathlib.Path]
+) -> None:
+    """The project command stores the dependencies, which must exist."""
+
+    db, db_file = file_based_db
+    runner = CliRunner()
+
+    def add_project(name: str, *dependencies: str) -> Result:
+        options = [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            name,
+        ]
+        for dependency in dependencies:
+            options.extend(["--depends-on", dependency])
+        return runner.invoke(cli, options)
+
+    # create projects with dependencies
+    assert add_project("pull").exit_code == 0
+    assert add_project("build", "pull").exit_code == 0
+    assert add_project("restart", "pull", "build").exit_code == 0
+    project = db.query(models.Project).filter(models.Project.name == "restart").one()
+    assert sorted(p.name for p in project.dependencies) == ["build", "pull"]
+
+    # dependencies must exist
+    result = add_project("deploy", "unknown")
+    assert result.exit_code != 0
+    assert "unknown" in result.output
+    assert db.query(models.Project).filter(models.Project.name == "deploy").count() == 0
+
+
+@pytest.mark.parametrize(
+    "option,value",
+    (
+        ("--env", "NO_VALUE"),
+        ("--umask", "0o8"),
+        ("--umask", "abc"),
+        ("--memory", "12X"),
+        ("--memory", "0"),
+        ("--schedule", "61 * * * *"),
+    ),
+)
+def test_project_rejects_invalid_execution_profile(
+    option: str,
+    value: str,
+    tmp_path: pathlib.Path,
+    file_based_db: Tuple[Session, pathlib.Path],
+) -> None:
+    """The project command rejects invalid environment variables and umasks."""
+
+    # execute the CLI command
+    db, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "project",
+            "--command",
+            "some command",
+            "--database",
+            str(db_file),
+            "--directory",
+            str(tmp_path),
+            "--name",
+            "Test Project",
+            option,
+            value,
+        ],
+    )
+
+    # check this has failed
+    assert result.exit_code != 0
+    assert value in result.output
+    assert db.query(models.Project).count() == 0
 
 
 def test_project_directory_must_exist(
@@ -324,6 +777,17 @@ def test_initdb_argument_must_not_exist(tmp_path: pathlib.Path) -> None:
     assert "exists" in result.output.lower()
 
 
+def test_upgradedb_reports_changes(file_based_db: Tuple[Session, pathlib.Path]) -> None:
+    """The upgradedb command leaves a current database unchanged."""
+
+    _, db_file = file_based_db
+    runner = CliRunner()
+    result = runner.invoke(cli, ["upgradedb", str(db_file)])
+
+    assert result.exit_code == 0
+    assert "up to date" in result.output
+
+
 def test_initdb_argument_must_be_present() -> None:
     """The initdb command must be called with an argument."""
 
@@ -334,3 +798,18 @@ def test_initdb_argument_must_be_present() -> None:
     # check this has failed
     assert result.exit_code != 0
     assert "usage" in result.output.lower()
+
+
+def test_admintoken_outputs_token_and_hash() -> None:
+    """The admintoken command outputs a token and its hash."""
+
+    # execute the CLI command
+    runner = CliRunner()
+    result = runner.invoke(cli, ["admintoken"])
+    assert result.exit_code == 0
+
+    # the token hash is consistent with the token
+    output_lines = result.output.split("\n")
+    output_token = output_lines[0].split(": ")[1]
+    output_hash = output_lines[1].split(": ")[1]
+    assert hash_token(output_token) == output_hash
@@ -0,0 +1,191 @@
+"""Tests for the compression of responses."""
+
+import asyncio
+import pathlib
+import zlib
+from datetime import datetime
+from typing import List, Optional
+
+import pytest
+import requests
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from sqlalchemy.orm import Session
+from starlette.types import Message, Receive, Scope, Send
+
+from remote_command_server import crud, logfiles, schemas
+from remote_command_server.compression import CompressionMiddleware, negotiate
+from remote_command_server.main import app, get_db
+
+client = TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    (
+        ("gzip, deflate", "gzip"),
+        ("gzip, zstd", "zstd"),
+        ("gzip;q=1.0, zstd;q=0.5", "gzip"),
+        ("zstd;q=0, gzip", "gzip"),
+        ("*", "zstd"),
+        ("*, zstd;q=0", "gzip"),
+        ("identity", None),
+        ("", None),
+    ),
+)
+def test_negotiate(accept_encoding: str, expected: Optional[str]) -> None:
+    """The accepted encoding with the highest quality and preference is chosen."""
+
+    assert negotiate(accept_encoding, ["zstd", "gzip"]) == expected
+
+
+def _get_log(
+    tmp_path: pathlib.Path, db: Session, content: bytes, accept_encoding: str
+) -> requests.Response:
+    project = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    path = logfiles.log_path(tmp_path / "logs", "abcd1234")
+    path.parent.mkdir(parents=True)
+    path.write_bytes(content)
+    now = datetime.utcnow()
+    run = schemas.RunCreate(
+        key="abcd1234",
+        project_id=project.id,
+        started_at=now,
+        finished_at=now,
+        exit_code=0,
+        duration=0,
+        output_size=len(content),
+        log_path=str(path),
+    )
+    crud.create_runs(db, [run])
+    token = crud.create_token(db, "shiny-project")
+
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        return client.get(
+            app.url_path_for("run_log", run_key="abcd1234"),
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Accept-Encoding": accept_encoding,
+            },
+        )
+    finally:
+        app.dependency_overrides = {}
+
+
+def test_large_responses_are_compressed(tmp_path: pathlib.Path, db: Session) -> None:
+    """Responses at least as large as the minimum size are compressed."""
+
+    content = b"Hello World\n" * 1000
+    response = _get_log(tmp_path, db, content, "gzip")
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert "Accept-Ranges" not in response.headers
+    assert response.content == content
+
+
+def test_small_responses_are_not_compressed(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Responses smaller than the minimum size are sent as they are."""
+
+    response = _get_log(tmp_path, db, b"Hello World\n", "gzip")
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.content == b"Hello World\n"
+
+
+def test_compression_can_be_disabled(
+    tmp_path: pathlib.Path, db: Session, monkeypatch: MonkeyPatch
+) -> None:
+    """Without any compression encodings, no responses are compressed."""
+
+    monkeypatch.setenv("RCS_COMPRESSION_ENCODINGS", "[]")
+    content = b"Hello World\n" * 1000
+
+    response = _get_log(tmp_path, db, content, "gzip")
+
+    assert "Content-Encoding" not in response.headers
+    assert response.content == content
+
+
+def test_streamed_chunks_are_flushed() -> None:
+    """Each chunk of a streamed response can be decompressed as soon as it is sent."""
+
+    async def streaming_app(scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/plain")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"Hello ", "more_body": True})
+        await send({"type": "http.response.body", "body": b"World\n"})
+
+    messages: List[Message] = []
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    async def receive() -> Message:  # pragma: no cover
+        return {"type": "http.disconnect"}
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [(b"accept-encoding", b"gzip")],
+    }
+    asyncio.run(CompressionMiddleware(streaming_app)(scope, receive, send))
+
+    start, first, last = messages
+    assert (b"content-encoding", b"gzip") in start["headers"]
+    decompressor = zlib.decompressobj(31)
+    assert decompressor.decompress(first["body"]) == b"Hello "
+    assert decompressor.decompress(last["body"]) == b"World\n"
+    assert decompressor.eof
+
+
+def test_zero_copy_bodies_follow_their_start() -> None:
+    """The start of an uncompressed response is sent before a zero-copy body."""
+
+    async def zero_copy_app(scope: Scope, receive: Receive, send: Send) -> None:
+        assert "http.response.zerocopysend" in scope["extensions"]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 206,
+                "headers": [(b"content-type", b"text/plain")],
+            }
+        )
+        await send({"type": "http.response.zerocopysend", "file": 0, "count": 5})
+
+    messages: List[Message] = []
+
+    async def send(message: Message) -> None:
+        messages.append(message)
+
+    async def receive() -> Message:  # pragma: no cover
+        return {"type": "http.disconnect"}
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [(b"accept-encoding", b"gzip"), (b"range", b"bytes=0-4")],
+        "extensions": {"http.response.zerocopysend": {}},
+    }
+    asyncio.run(CompressionMiddleware(zero_copy_app)(scope, receive, send))
+
+    assert [message["type"] for message in messages] == [
+        "http.response.start",
+        "http.response.zerocopysend",
+    ]
+    assert (b"vary", b"Accept-Encoding") in messages[0]["headers"]
+    assert all(name != b"content-encoding" for name, _ in messages[0]["headers"])
@@ -0,0 +1,56 @@
+"""Tests for cron expressions."""
+
+from datetime import datetime
+
+import pytest
+
+from remote_command_server.cron import CronSchedule
+
+
+@pytest.mark.parametrize(
+    "expression,after,expected",
+    (
+        ("* * * * *", datetime(2021, 3, 4, 5, 6, 7), datetime(2021, 3, 4, 5, 7)),
+        ("*/15 * * * *", datetime(2021, 3, 4, 5, 6), datetime(2021, 3, 4, 5, 15)),
+        ("0 * * * *", datetime(2021, 3, 4, 5, 0), datetime(2021, 3, 4, 6, 0)),
+        ("30 2 * * *", datetime(2021, 3, 4, 5, 6), datetime(2021, 3, 5, 2, 30)),
+        ("0 9-17/4 * * *", datetime(2021, 3, 4, 14, 0), datetime(2021, 3, 4, 17, 0)),
+        ("0 0 1 jan *", datetime(2021, 3, 4), datetime(2022, 1, 1)),
+        ("0 0 31 * *", datetime(2021, 4, 1), datetime(2021, 5, 31)),
+        ("0 0 29 2 *", datetime(2021, 1, 1), datetime(2024, 2, 29)),
+        ("0 12 * * mon-fri", datetime(2021, 3, 5, 13, 0), datetime(2021, 3, 8, 12, 0)),
+        ("0 0 * * 7", datetime(2021, 3, 4), datetime(2021, 3, 7)),
+        ("0 0 13 * fri", datetime(2021, 3, 4), datetime(2021, 3, 5)),
+        ("0 0 13 * fri", datetime(2021, 3, 6), datetime(2021, 3, 12)),
+        ("@daily", datetime(2021, 12, 31, 23, 59), datetime(2022, 1, 1)),
+        ("@hourly", datetime(2021, 3, 4, 5, 6), datetime(2021, 3, 4, 6, 0)),
+    ),
+)
+def test_next_after(expression: str, after: datetime, expected: datetime) -> None:
+    """The next matching time after a given time is found."""
+
+    assert CronSchedule.parse(expression).next_after(after) == expected
+
+
+@pytest.mark.parametrize(
+    "expression",
+    (
+        "* * * *",
+        "* * * * * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * * 13 *",
+        "* * * * 8",
+        "5-1 * * * *",
+        "*/0 * * * *",
+        "a * * * *",
+        "0 0 30 feb *",
+        "@sometimes",
+    ),
+)
+def test_parse_rejects_invalid_expressions(expression: str) -> None:
+    """Invalid cron expressions and expressions which never match are rejected."""
+
+    with pytest.raises(ValueError):
+        CronSchedule.parse(expression)
@@ -1,13 +1,23 @@
 """Tests for database operations."""
+
+from datetime import datetime, timedelta
+
 import pytest
+from pytest import MonkeyPatch
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 from remote_command_server import models, schemas
 from remote_command_server.crud import (
     create_project,
+    create_runs,
     create_token,
+    delete_runs_before,
+    get_credentials_version,
+    get_runs,
     hash_token,
+    set_last_scheduled_run,
+    verify_admin_token,
     verify_token,
 )
 
@@ -210,3 +220,145 @@ def test_verify_token_for_wrong_project(db: Session) -> None:
 
     # try to verify the token for the wrong project
     assert not verify_token(db, token=token, project_name="Other Project")
+
+
+def _run(key: str, project_id: int, started_at: datetime) -> schemas.RunCreate:
+    return schemas.RunCreate(
+        key=key,
+        project_id=project_id,
+        started_at=started_at,
+        finished_at=started_at + timedelta(seconds=1),
+        exit_code=0,
+        duration=1,
+        output_size=0,
+    )
+
+
+def test_credentials_version_increases_with_credential_changes(db: Session) -> None:
+    """The version changes with the projects and tokens, but not with other data."""
+
+    assert get_credentials_version(db) == 0
+    project = create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Some Project", directory="/wherever", command="whatever"
+        ),
+    )
+    create_token(db, "Some Project")
+    assert get_credentials_version(db) == 2
+
+    project.name = "Renamed Project"
+    db.commit()
+    token = db.query(models.Token).one()
+    db.delete(token)
+    db.commit()
+    assert get_credentials_version(db) == 4
+
+    set_last_scheduled_run(db, [project.id], datetime.utcnow())
+    project.last_scheduled_run = datetime.utcnow()
+    db.commit()
+    create_runs(db, [_run("run", project.id, datetime.utcnow())])
+    assert get_credentials_version(db) == 4
+
+
+def test_create_runs_adds_runs(db: Session) -> None:
+    """create_runs adds all the runs to the database."""
+
+    # create a project
+    project = create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Some Project", directory="/wherever", command="whatever"
+        ),
+    )
+
+    # add some runs
+    now = datetime.utcnow()
+    create_runs(db, [_run(f"run-{i}", project.id, now) for i in range(3)])
+
+    # the runs have been added
+    assert db.query(models.Run).count() == 3
+    assert {run.project.name for run in db.query(models.Run)} == {"Some Project"}
+
+
+def test_get_runs_returns_recent_runs_of_project(db: Session) -> None:
+    """get_runs returns the most recent runs of a project only."""
+
+    # create two projects with runs
+    some_project = create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Some Project", directory="/wherever", command="whatever"
+        ),
+    )
+    other_project = create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Other Project", directory="/wherever", command="whatever"
+        ),
+    )
+    now = datetime.utcnow()
+    create_runs(
+        db,
+        [_run(f"some-{i}", some_project.id, now - timedelta(hours=i)) for i in range(5)]
+        + [_run("other", other_project.id, now)],
+    )
+
+    # get the runs
+    assert [run.key for run in get_runs(db, some_project.id)] == [
+        f"some-{i}" for i in range(5)
+    ]
+    assert [run.key for run in get_runs(db, some_project.id, limit=2)] == [
+        "some-0",
+        "some-1",
+    ]
+    since = now - timedelta(hours=2)
+    assert [run.key for run in get_runs(db, some_project.id, since=since)] == [
+        "some-0",
+        "some-1",
+        "some-2",
+    ]
+
+
+def test_delete_runs_before_deletes_oldest_runs_in_chunk(db: Session) -> None:
+    """delete_runs_before deletes at most a chunk of the oldest runs."""
+
+    # create a project with runs
+    project = create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Some Project", directory="/wherever", command="whatever"
+        ),
+    )
+    now = datetime.utcnow()
+    create_runs(
+        db, [_run(f"run-{i}", project.id, now - timedelta(days=i)) for i in range(6)]
+    )
+
+    # delete runs which are older than two and a half days in chunks of two
+    before = now - timedelta(days=2.5)
+    assert delete_runs_before(db, before=before, chunk_size=2) == (2, [])
+    assert {run.key for run in db.query(models.Run)} == {
+        "run-0",
+        "run-1",
+        "run-2",
+        "run-3",
+    }
+    assert delete_runs_before(db, before=before, chunk_size=2) == (1, [])
+    assert delete_runs_before(db, before=before, chunk_size=2) == (0, [])
+    assert db.query(models.Run).count() == 3
+
+
+def test_verify_admin_token(monkeypatch: MonkeyPatch) -> None:
+    """Only the token whose hash is defined in the settings is the admin token."""
+
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", hash_token("admin-token"))
+
+    assert verify_admin_token("admin-token")
+    assert not verify_admin_token("other-token")
+
+
+def test_verify_admin_token_without_admin_token_hash() -> None:
+    """No token is the admin token if no admin token hash is defined."""
+
+    assert not verify_admin_token("")
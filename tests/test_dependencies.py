@@ -19,7 +19,9 @@ def test_get_project_returns_correct_project(
     token = crud.create_token(db, "shiny-project")
 
     # check the correct project is returned
-    project = get_project("shiny-project", db, token)
+    project = get_project(
+        "shiny-project", db, token, client="127.0.0.1", gate=None, snapshot=None
+    )
     assert project.name == "shiny-project"
     assert project.directory == dir
     assert project.command == "echo"
@@ -37,5 +39,12 @@ def test_get_project_raises_error_for_invalid_token(
 
     # check an exception is raised for an invalid token
     with pytest.raises(HTTPException) as excinfo:
-        get_project("shiny-project", db, "invalid-token")
+        get_project(
+            "shiny-project",
+            db,
+            "invalid-token",
+            client="127.0.0.1",
+            gate=None,
+            snapshot=None,
+        )
     assert "unauthorized" in str(excinfo).lower()
@@ -0,0 +1,156 @@
+"""Tests for draining runs before the server stops."""
+
+import asyncio
+import pathlib
+from typing import Any, List, Tuple
+
+import pytest
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from pytest_mock import MockerFixture
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, executor, schemas
+from remote_command_server.executor import Drainer, Job, RunResult
+from remote_command_server.main import app, get_db, get_drainer
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+def _job(tmp_path: pathlib.Path, command: str) -> Job:
+    return Job(
+        project_id=1,
+        project_name="some-project",
+        command=command,
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+
+
+async def _execute_and_drain(
+    job: Job, grace_period: float, kill_timeout: float = 1
+) -> Tuple[RunResult, List[str]]:
+    drainer = Drainer(poll_interval=0.01)
+    run = asyncio.ensure_future(executor.execute(job))
+    await asyncio.sleep(0.1)
+    interrupted = await drainer.drain(grace_period, kill_timeout)
+    return await run, interrupted
+
+
+def test_drain_waits_for_runs(tmp_path: pathlib.Path) -> None:
+    """Runs finishing within the grace period are not interrupted."""
+
+    job = _job(tmp_path, "sleep 0.2")
+    result, interrupted = asyncio.run(_execute_and_drain(job, grace_period=5))
+
+    assert interrupted == []
+    assert result.returncode == 0
+    assert not result.interrupted
+
+
+def test_drain_interrupts_runs_after_grace_period(tmp_path: pathlib.Path) -> None:
+    """Runs still in progress after the grace period are interrupted."""
+
+    job = _job(tmp_path, "sleep 10; echo Done")
+    result, interrupted = asyncio.run(_execute_and_drain(job, grace_period=0.1))
+
+    assert interrupted == [result.key]
+    assert result.interrupted
+    assert result.returncode != 0
+    assert result.duration < 5
+
+
+def test_drain_kills_runs_ignoring_sigterm(tmp_path: pathlib.Path) -> None:
+    """Runs which don't exit after being interrupted are killed."""
+
+    job = _job(tmp_path, "trap '' TERM; while true; do sleep 0.05; done")
+    result, interrupted = asyncio.run(
+        _execute_and_drain(job, grace_period=0.1, kill_timeout=0.2)
+    )
+
+    assert interrupted == [result.key]
+    assert result.returncode == -9
+    assert not executor.active_runs
+
+
+def _create_project(tmp_path: pathlib.Path, db: Session) -> str:
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    return crud.create_token(db, "shiny-project")
+
+
+def test_run_returns_503_while_draining(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """New runs are rejected while draining."""
+
+    run_command = mocker.patch("remote_command_server.util.run_command")
+    token = _create_project(tmp_path, db)
+    drainer = Drainer()
+    drainer.start()
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_drainer] = lambda: drainer
+
+    response = client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    run_command.assert_not_called()
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_returns_503_if_run_is_interrupted(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """The caller of an interrupted run gets a 503 response with the run key."""
+
+    def run_command(**kwargs: Any) -> Any:
+        (key,) = executor.active_runs
+        executor.interrupt(key)
+        return mocker.Mock(returncode=-15, usage=None)
+
+    mocker.patch("remote_command_server.util.run_command", side_effect=run_command)
+    token = _create_project(tmp_path, db)
+    app.dependency_overrides[get_db] = lambda: db
+
+    response = client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 503
+    assert "interrupted" in response.json()["message"]
+    assert response.json()["run"]
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+@pytest.mark.parametrize("token,status_code", (("secret", 202), ("wrong", 401)))
+def test_admin_drain_starts_draining(
+    token: str, status_code: int, monkeypatch: MonkeyPatch
+) -> None:
+    """The drain endpoint requires the admin token and starts draining."""
+
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", crud.hash_token("secret"))
+    drainer = Drainer()
+    app.dependency_overrides[get_drainer] = lambda: drainer
+
+    response = client.post(
+        app.url_path_for("drain"), headers={"Authorization": f"Bearer {token}"}
+    )
+
+    assert response.status_code == status_code
+    assert drainer.draining == (status_code == 202)
+
+    # clean up
+    app.dependency_overrides = {}
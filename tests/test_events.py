@@ -0,0 +1,177 @@
+"""Tests for the structured event log."""
+
+import asyncio
+import json
+import logging
+import pathlib
+import threading
+import time
+from typing import Any, Dict, List
+
+import pytest
+
+from remote_command_server import executor
+from remote_command_server.events import (
+    BoundedQueueHandler,
+    EventLog,
+    event_log,
+)
+from remote_command_server.executor import Job
+from remote_command_server.spawn import ExecutionProfile
+
+
+class SlowHandler(logging.Handler):
+    """Handler collecting records, which blocks until it is released."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.released = threading.Event()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.released.wait()
+        self.records.append(record)
+
+
+def _read_events(path: pathlib.Path) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def _record(message: str) -> logging.LogRecord:
+    return logging.makeLogRecord({"msg": message})
+
+
+@pytest.mark.parametrize(
+    "drop_policy,expected", [("newest", ["1", "2"]), ("oldest", ["2", "3"])]
+)
+def test_bounded_queue_handler_drops_records(
+    drop_policy: str, expected: List[str]
+) -> None:
+    """Records are dropped according to the drop policy if the queue is full."""
+
+    handler = BoundedQueueHandler(queue_size=2, drop_policy=drop_policy)
+    for message in ("1", "2", "3"):
+        handler.handle(_record(message))
+
+    queued = [handler.bounded_queue.get_nowait().msg for _ in range(2)]
+    assert queued == expected
+    assert handler.dropped == 1
+
+
+def test_bounded_queue_handler_rejects_invalid_drop_policy() -> None:
+    """Only the drop policies newest and oldest are accepted."""
+
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(queue_size=2, drop_policy="random")
+
+
+def test_event_log_writes_json_events(tmp_path: pathlib.Path) -> None:
+    """Events are written as JSON objects with their fields."""
+
+    path = tmp_path / "events.log"
+    log = EventLog()
+    log.start(logging.FileHandler(path))
+    log.emit("run_queued", project="some-project", run="abc", agent_label=None)
+    log.stop()
+
+    (event,) = _read_events(path)
+    assert event["event"] == "run_queued"
+    assert event["level"] == "info"
+    assert event["project"] == "some-project"
+    assert event["run"] == "abc"
+    assert event["agent_label"] is None
+    assert event["time"].endswith("Z")
+
+
+def test_event_log_discards_events_before_start(tmp_path: pathlib.Path) -> None:
+    """Events emitted before the log is started or after it is stopped are lost."""
+
+    path = tmp_path / "events.log"
+    log = EventLog()
+    log.emit("before")
+    log.start(logging.FileHandler(path))
+    log.emit("during")
+    log.stop()
+    log.emit("after")
+
+    assert [event["event"] for event in _read_events(path)] == ["during"]
+
+
+def test_event_log_samples_projects(tmp_path: pathlib.Path) -> None:
+    """
+    Informational events are sampled per project and run, but warnings and errors are
+    always logged.
+    """
+
+    path = tmp_path / "events.log"
+    log = EventLog()
+    log.start(
+        logging.FileHandler(path),
+        sample_rates={"sampled": 0.5, "muted": 0},
+    )
+    keys = [f"{i:032x}" for i in range(200)]
+    for key in keys:
+        log.emit("run_queued", project="sampled", run=key)
+        log.emit("run_finished", project="sampled", run=key)
+        log.emit("run_queued", project="muted", run=key)
+    log.emit("run_queued", project="other")
+    log.emit("run_error", level=logging.ERROR, project="muted")
+    log.stop()
+
+    events = _read_events(path)
+    sampled = [event for event in events if event["project"] == "sampled"]
+    queued = {event["run"] for event in sampled if event["event"] == "run_queued"}
+    finished = {event["run"] for event in sampled if event["event"] == "run_finished"}
+    assert queued == finished
+    assert 50 < len(queued) < 150
+    assert [event["event"] for event in events if event["project"] == "muted"] == [
+        "run_error"
+    ]
+    assert any(event["project"] == "other" for event in events)
+
+
+def test_emitting_does_not_block_on_slow_handler() -> None:
+    """Events are dropped rather than waiting for a slow handler."""
+
+    handler = SlowHandler()
+    log = EventLog()
+    log.start(handler, queue_size=10)
+    try:
+        start = time.monotonic()
+        for i in range(1000):
+            log.emit("event", number=i)
+        assert time.monotonic() - start < 1
+        assert log.handler is not None
+        assert log.handler.dropped >= 1000 - 11
+    finally:
+        handler.released.set()
+        log.stop()
+
+    assert handler.records[-1].getMessage() == "events_dropped"
+    assert handler.records[-1].fields["count"] >= 1000 - 11  # type: ignore
+
+
+def test_execute_emits_run_events(tmp_path: pathlib.Path) -> None:
+    """Runs emit events when they are queued, spawned and finished."""
+
+    path = tmp_path / "events.log"
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="exit 3",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+    event_log.start(logging.FileHandler(path))
+    try:
+        result = asyncio.run(executor.execute(job))
+    finally:
+        event_log.stop()
+
+    events = _read_events(path)
+    assert [event["event"] for event in events] == [
+        "run_queued",
+        "run_spawned",
+        "run_finished",
+    ]
+    assert all(event["run"] == result.key for event in events)
+    assert events[2]["returncode"] == 3
@@ -0,0 +1,85 @@
+"""Tests for the output filters."""
+
+import asyncio
+import pathlib
+from typing import Any, Dict
+
+import pytest
+from pytest import MonkeyPatch
+
+from remote_command_server import executor
+from remote_command_server.filters import (
+    AnsiStripper,
+    HeadTailTruncator,
+    OutputPolicy,
+)
+from remote_command_server.processors import ProcessorSpec
+from remote_command_server.spawn import ExecutionProfile
+
+
+def test_ansi_stripper_removes_sequences_split_across_chunks() -> None:
+    """Escape sequences are removed even if they are split across chunks."""
+
+    stripper = AnsiStripper()
+    chunks = [
+        b"\x1b[1;3",
+        b"1mred\x1b[0m \x1b]0;title\x07plain \x1b]8;;http://example.com\x1b",
+        b"\\link\x1b]8;;\x1b\\ \x1b",
+    ]
+
+    output = b"".join(stripper.feed(chunk) for chunk in chunks) + stripper.flush()
+
+    assert output == b"red plain link \x1b"
+
+
+def test_head_tail_truncator_keeps_head_and_tail() -> None:
+    """Long output is truncated in the middle, and short output is kept."""
+
+    truncator = HeadTailTruncator(max_bytes=10, head_bytes=4)
+    passed = b"".join(truncator.feed(bytes([c]) * 5) for c in b"abcde")
+    assert passed == b"aaaa"
+    assert truncator.finish() == b"\n[... 15 bytes omitted ...]\n" + b"d" + b"e" * 5
+
+    short = HeadTailTruncator(max_bytes=10)
+    assert short.feed(b"abcdefgh") + short.finish() == b"abcdefgh"
+
+
+@pytest.mark.parametrize(
+    "policy",
+    (
+        {"max_bytes": 0},
+        {"head_bytes": 10},
+        {"max_bytes": 10, "head_bytes": 11},
+    ),
+)
+def test_invalid_output_policies_are_rejected(policy: Dict[str, Any]) -> None:
+    """Sizes must be positive, and a head must fit within the maximum size."""
+
+    with pytest.raises(ValueError):
+        OutputPolicy(**policy)
+
+
+def test_execute_applies_output_policy(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch
+) -> None:
+    """The log is stripped and truncated, and processors see the stripped output."""
+
+    monkeypatch.setenv("RCS_LOG_DIRECTORY", str(tmp_path / "logs"))
+    job = executor.Job(
+        project_id=1,
+        project_name="some-project",
+        command="printf '\\033[32mok\\033[0m\\n'; seq 1000; echo done",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+        processors=(ProcessorSpec.from_dict({"type": "tail", "lines": 1}),),
+        output_policy=OutputPolicy(max_bytes=20, head_bytes=6, strip_ansi=True),
+    )
+
+    result = asyncio.run(executor.execute(job))
+
+    assert result.log_path is not None
+    log = result.log_path.read_bytes()
+    assert log.startswith(b"ok\n1\n2\n")
+    assert b"bytes omitted ...]\n" in log
+    assert log.endswith(b"999\n1000\ndone\n")
+    assert result.output == {"tail": ["done"]}
+    assert result.output_size > 3000
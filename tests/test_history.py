@@ -0,0 +1,106 @@
+"""Tests for the run history."""
+
+import pathlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, logfiles, models, schemas
+from remote_command_server.history import RunRecorder, prune_runs
+
+
+def _run(
+    key: str, project_id: int, started_at: datetime, log_path: Optional[str] = None
+) -> schemas.RunCreate:
+    return schemas.RunCreate(
+        key=key,
+        project_id=project_id,
+        started_at=started_at,
+        finished_at=started_at,
+        exit_code=0,
+        duration=0,
+        output_size=0,
+        log_path=log_path,
+    )
+
+
+def _create_project(db: Session) -> models.Project:
+    return crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="Some Project", directory="/wherever", command="whatever"
+        ),
+    )
+
+
+def test_recorder_writes_runs_in_batches(db: Session) -> None:
+    """The recorder writes queued runs in batches."""
+
+    # record some runs
+    project = _create_project(db)
+    recorder = RunRecorder(lambda: db, batch_size=2)
+    for i in range(5):
+        recorder.record(_run(f"run-{i}", project.id, datetime.utcnow()))
+
+    # nothing is written before the recorder flushes...
+    assert db.query(models.Run).count() == 0
+
+    # ... but then all runs are written
+    assert recorder.flush() == 5
+    assert db.query(models.Run).count() == 5
+
+
+def test_recorder_drops_runs_if_queue_is_full(db: Session) -> None:
+    """The recorder drops runs rather than blocking if its queue is full."""
+
+    # record more runs than fit in the queue
+    project = _create_project(db)
+    recorder = RunRecorder(lambda: db, max_queue_size=2)
+    for i in range(3):
+        recorder.record(_run(f"run-{i}", project.id, datetime.utcnow()))
+
+    # only the runs in the queue are written
+    assert recorder.dropped == 1
+    assert recorder.flush() == 2
+
+
+def test_prune_runs_deletes_old_runs(db: Session) -> None:
+    """prune_runs deletes all runs older than the maximum age."""
+
+    # create runs
+    project = _create_project(db)
+    now = datetime.utcnow()
+    crud.create_runs(
+        db, [_run(f"run-{i}", project.id, now - timedelta(days=i)) for i in range(10)]
+    )
+
+    # prune the runs
+    deleted = prune_runs(lambda: db, max_age=timedelta(days=4.5), chunk_size=2, pause=0)
+    assert deleted == 5
+    assert {run.key for run in db.query(models.Run)} == {f"run-{i}" for i in range(5)}
+
+
+def test_prune_runs_removes_logs(tmp_path: pathlib.Path, db: Session) -> None:
+    """The logs of pruned runs are removed, together with their compressed copies."""
+
+    project = _create_project(db)
+    now = datetime.utcnow()
+    paths = [logfiles.log_path(tmp_path, f"run-{i}") for i in range(3)]
+    for path in paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("output\n")
+    logfiles.precompress(paths[2])
+    # the log of the second run has been lost already
+    paths[1].unlink()
+    crud.create_runs(
+        db,
+        [
+            _run(f"run-{i}", project.id, now - timedelta(days=i), str(path))
+            for i, path in enumerate(paths)
+        ],
+    )
+
+    assert prune_runs(lambda: db, max_age=timedelta(days=0.5), chunk_size=1) == 2
+    assert paths[0].exists()
+    assert sorted(path.name for path in tmp_path.glob("*/*")) == ["run-0.log"]
@@ -0,0 +1,169 @@
+"""Tests for idempotency keys."""
+
+import asyncio
+import pathlib
+import time
+from typing import List
+
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, responses, schemas
+from remote_command_server.idempotency import IdempotencyTable, ResponseStore
+from remote_command_server.main import app, get_db, get_idempotency_table
+
+client = TestClient(app)
+
+
+def test_retries_get_stored_response() -> None:
+    """A request is handled once per key, and retries get the same response."""
+
+    table = IdempotencyTable(ttl=60)
+    keys: List[str] = []
+
+    async def handle() -> Response:
+        keys.append(f"run{len(keys)}")
+        return responses.run_succeeded(keys[-1])
+
+    async def run() -> List[Response]:
+        return [
+            await table.respond("project", "a", handle),
+            await table.respond("project", "a", handle),
+            await table.respond("other-project", "a", handle),
+        ]
+
+    first, retry, other = asyncio.run(run())
+
+    assert keys == ["run0", "run1"]
+    assert retry.body == first.body
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in other.headers
+    assert table.replayed == 1
+
+
+def test_retries_attach_to_request_in_progress() -> None:
+    """A retry made while the first request is handled waits for its response."""
+
+    table = IdempotencyTable(ttl=60)
+    calls = 0
+
+    async def handle() -> Response:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return responses.run_failed("run")
+
+    async def run() -> List[Response]:
+        return list(
+            await asyncio.gather(
+                table.respond("project", "a", handle),
+                table.respond("project", "a", handle),
+            )
+        )
+
+    first, retry = asyncio.run(run())
+
+    assert calls == 1
+    assert (retry.status_code, retry.body) == (500, first.body)
+
+
+def test_unavailable_responses_are_not_stored() -> None:
+    """Responses with the status 503 are not stored, so that retries run again."""
+
+    table = IdempotencyTable(ttl=60)
+    calls = 0
+
+    async def handle() -> Response:
+        nonlocal calls
+        calls += 1
+        return Response(b"", status_code=503)
+
+    async def run() -> None:
+        await table.respond("project", "a", handle)
+        await table.respond("project", "a", handle)
+
+    asyncio.run(run())
+
+    assert calls == 2
+    assert len(table) == 0
+
+
+def test_expired_and_oldest_responses_are_removed() -> None:
+    """Expired responses are swept, and the oldest ones are evicted if full."""
+
+    table = IdempotencyTable(ttl=60, max_keys=2)
+
+    async def handle() -> Response:
+        return responses.run_scheduled()
+
+    async def run() -> None:
+        for key in ("a", "b", "c"):
+            await table.respond("project", key, handle)
+
+    asyncio.run(run())
+
+    assert len(table) == 2
+    assert table.sweep() == 0
+    assert table.sweep(now=time.time() + 61) == 2
+    assert len(table) == 0
+
+
+def test_responses_are_persisted(tmp_path: pathlib.Path) -> None:
+    """Saved responses are loaded by a new table until they expire."""
+
+    database = str(tmp_path / "idempotency.sqlite3")
+    table = IdempotencyTable(ttl=60, store=ResponseStore(database))
+
+    async def handle() -> Response:
+        return responses.run_succeeded("run")
+
+    asyncio.run(table.respond("project", "a", handle))
+    table.save()
+
+    loaded = IdempotencyTable(ttl=60, store=ResponseStore(database))
+    loaded.load()
+    assert len(loaded) == 1
+
+    ResponseStore(database).save([], now=time.time() + 61)
+    expired = IdempotencyTable(ttl=60, store=ResponseStore(database))
+    expired.load()
+    assert len(expired) == 0
+
+
+def test_run_with_idempotency_key_runs_once(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Retries of the run endpoint with the same key don't run the command again."""
+
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="echo run >> runs"
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+    table = IdempotencyTable(ttl=60)
+
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_idempotency_table] = lambda: table
+    try:
+        url = app.url_path_for("run", project_name="shiny-project")
+        headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "a"}
+        first = client.post(url, headers=headers)
+        retry = client.post(url, headers=headers)
+        too_long = client.post(
+            url,
+            headers={**headers, "Idempotency-Key": "x" * 256},
+        )
+    finally:
+        app.dependency_overrides = {}
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert (tmp_path / "runs").read_text() == "run\n"
+    assert too_long.status_code == 400
@@ -0,0 +1,138 @@
+"""Tests for the admin introspection endpoints."""
+
+import asyncio
+import pathlib
+from datetime import datetime, timedelta
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, executor, introspection, schemas
+from remote_command_server.executor import ActiveRun, Job
+from remote_command_server.idempotency import IdempotencyTable
+from remote_command_server.main import app, get_db, get_idempotency_table
+from remote_command_server.queueing import RunQueue
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+def _job(directory: pathlib.Path) -> Job:
+    return Job(
+        project_id=1,
+        project_name="some-project",
+        command="true",
+        profile=ExecutionProfile(directory=str(directory)),
+    )
+
+
+def test_active_runs_include_queued_runs(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch
+) -> None:
+    """Queued runs are listed with their queue positions."""
+
+    monkeypatch.setattr(executor, "run_queue", RunQueue(capacity=1))
+
+    async def run() -> List[schemas.ActiveRun]:
+        async with executor.run_queue.slot("blocker", 2):
+            queued = asyncio.ensure_future(executor.execute(_job(tmp_path)))
+            await asyncio.sleep(0.01)
+            snapshot = introspection.active_runs()
+            executor.interrupt(snapshot[0].run)
+            await queued
+        return snapshot
+
+    (active_run,) = asyncio.run(run())
+
+    assert active_run.project == "some-project"
+    assert active_run.state == "queued"
+    assert active_run.queue_position == 0
+    assert active_run.pid is None
+
+
+@pytest.mark.parametrize("token,status_code", (("secret", 200), ("wrong", 401)))
+def test_admin_runs_lists_running_commands(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch, token: str, status_code: int
+) -> None:
+    """The runs endpoint requires the admin token and lists the runs in progress."""
+
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", crud.hash_token("secret"))
+    active_run = ActiveRun(
+        key="abc",
+        job=_job(tmp_path),
+        started_at=datetime.utcnow() - timedelta(seconds=5),
+        output_bytes=42,
+        pid=1234,
+    )
+    monkeypatch.setattr(executor, "active_runs", {"abc": active_run})
+
+    response = client.get(
+        app.url_path_for("admin_runs"), headers={"Authorization": f"Bearer {token}"}
+    )
+
+    assert response.status_code == status_code
+    if status_code == 200:
+        (run,) = response.json()
+        assert run["run"] == "abc"
+        assert run["state"] == "running"
+        assert run["pid"] == 1234
+        assert run["output_bytes"] == 42
+        assert run["elapsed"] >= 5
+
+
+def test_admin_interrupt_marks_run_as_interrupted(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch
+) -> None:
+    """Runs in progress can be interrupted, and unknown runs are not found."""
+
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", crud.hash_token("secret"))
+    active_run = ActiveRun(key="abc", job=_job(tmp_path), started_at=datetime.utcnow())
+    monkeypatch.setattr(executor, "active_runs", {"abc": active_run})
+    headers = {"Authorization": "Bearer secret"}
+
+    response = client.post(
+        app.url_path_for("admin_interrupt", run_key="abc"), headers=headers
+    )
+    missing = client.post(
+        app.url_path_for("admin_interrupt", run_key="missing"), headers=headers
+    )
+
+    assert response.status_code == 200
+    assert active_run.interrupted
+    assert missing.status_code == 404
+
+
+def test_admin_stats(db: Session, monkeypatch: MonkeyPatch) -> None:
+    """The stats endpoint reports the executor, the database pool and the caches."""
+
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", crud.hash_token("secret"))
+    monkeypatch.setattr(executor, "run_queue", RunQueue(capacity=4))
+    table = IdempotencyTable(ttl=60)
+    table.requests, table.replayed = 4, 1
+
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_idempotency_table] = lambda: table
+    try:
+        response = client.get(
+            app.url_path_for("admin_stats"), headers={"Authorization": "Bearer secret"}
+        )
+    finally:
+        app.dependency_overrides = {}
+
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["executor"]["capacity"] == 4
+    assert stats["executor"]["utilization"] == 0
+    assert stats["database_pool"]["status"] == db.get_bind().pool.status()
+    assert stats["caches"]["idempotency_keys"] == {
+        "hits": 1,
+        "lookups": 4,
+        "hit_ratio": 0.25,
+    }
+    assert "spawn_specs" in stats["caches"]
@@ -0,0 +1,248 @@
+"""Tests for storing and serving run logs."""
+
+import asyncio
+import gzip
+import pathlib
+import threading
+from datetime import datetime
+from typing import Optional, Tuple
+
+import pytest
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, executor, logfiles, schemas
+from remote_command_server.main import app, get_db
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "range_header,expected",
+    (
+        ("bytes=0-9", (0, 9)),
+        ("bytes=10-", (10, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=90-200", (90, 99)),
+        ("bytes=0-1,5-6", None),
+        ("lines=0-9", None),
+        ("bytes=abc", None),
+        ("bytes=9-0", None),
+    ),
+)
+def test_parse_range(range_header: str, expected: Optional[Tuple[int, int]]) -> None:
+    """Single byte ranges are parsed, and other ranges are ignored."""
+
+    assert logfiles.parse_range(range_header, 100) == expected
+
+
+def test_parse_range_rejects_ranges_beyond_content() -> None:
+    """A range starting after the end of the content cannot be satisfied."""
+
+    with pytest.raises(logfiles.RangeNotSatisfiable):
+        logfiles.parse_range("bytes=100-", 100)
+
+
+def test_precompress_creates_compressed_copies(tmp_path: pathlib.Path) -> None:
+    """Precompressing a log file creates a gzip and (if possible) a zstd copy."""
+
+    path = tmp_path / "run.log"
+    path.write_bytes(b"some output\n" * 1000)
+    logfiles.precompress(path)
+
+    assert gzip.decompress((tmp_path / "run.log.gz").read_bytes()) == (
+        path.read_bytes()
+    )
+    assert not list(tmp_path.glob("*.tmp"))
+    zstandard = pytest.importorskip("zstandard")
+    decompressor = zstandard.ZstdDecompressor()
+    with open(tmp_path / "run.log.zst", "rb") as f:
+        assert decompressor.stream_reader(f).read() == path.read_bytes()
+
+
+def test_execute_writes_log(tmp_path: pathlib.Path, monkeypatch: MonkeyPatch) -> None:
+    """The output of a run is written to a log file."""
+
+    monkeypatch.setenv("RCS_LOG_DIRECTORY", str(tmp_path / "logs"))
+    job = executor.Job(
+        project_id=1,
+        project_name="some-project",
+        command="echo Hello; echo World >&2",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+    result = asyncio.run(executor.execute(job))
+
+    assert result.log_path == logfiles.log_path(tmp_path / "logs", result.key)
+    assert sorted(result.log_path.read_text().split()) == ["Hello", "World"]
+    assert result.output_size == 12
+    assert result.key not in executor.active_runs
+
+
+def _create_run_with_log(
+    tmp_path: pathlib.Path, db: Session, content: bytes
+) -> Tuple[str, pathlib.Path]:
+    project = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    path = logfiles.log_path(tmp_path / "logs", "abcd1234")
+    path.parent.mkdir(parents=True)
+    path.write_bytes(content)
+    now = datetime.utcnow()
+    crud.create_runs(
+        db,
+        [
+            schemas.RunCreate(
+                key="abcd1234",
+                project_id=project.id,
+                started_at=now,
+                finished_at=now,
+                exit_code=0,
+                duration=0,
+                output_size=len(content),
+                log_path=str(path),
+            )
+        ],
+    )
+    token = crud.create_token(db, "shiny-project")
+    return token, path
+
+
+def test_run_log_returns_log(tmp_path: pathlib.Path, db: Session) -> None:
+    """The run log endpoint returns the full log."""
+
+    token, _ = _create_run_with_log(tmp_path, db, b"Hello World\n")
+    app.dependency_overrides[get_db] = lambda: db
+
+    response = client.get(
+        app.url_path_for("run_log", run_key="abcd1234"),
+        headers={"Authorization": f"Bearer {token}", "Accept-Encoding": "identity"},
+    )
+
+    assert response.status_code == 200
+    assert response.content == b"Hello World\n"
+    assert response.headers["Content-Length"] == "12"
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_log_returns_range(tmp_path: pathlib.Path, db: Session) -> None:
+    """The run log endpoint supports byte ranges."""
+
+    token, _ = _create_run_with_log(tmp_path, db, b"Hello World\n")
+    app.dependency_overrides[get_db] = lambda: db
+
+    url = app.url_path_for("run_log", run_key="abcd1234")
+    response = client.get(
+        url, headers={"Authorization": f"Bearer {token}", "Range": "bytes=6-10"}
+    )
+    assert response.status_code == 206
+    assert response.content == b"World"
+    assert response.headers["Content-Range"] == "bytes 6-10/12"
+
+    response = client.get(
+        url, headers={"Authorization": f"Bearer {token}", "Range": "bytes=12-"}
+    )
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */12"
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_log_returns_precompressed_log(tmp_path: pathlib.Path, db: Session) -> None:
+    """The run log endpoint returns a precompressed log if the client accepts it."""
+
+    token, path = _create_run_with_log(tmp_path, db, b"Hello World\n" * 100)
+    logfiles.precompress(path)
+    app.dependency_overrides[get_db] = lambda: db
+
+    response = client.get(
+        app.url_path_for("run_log", run_key="abcd1234"),
+        headers={"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip"},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.content == b"Hello World\n" * 100
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_log_requires_valid_token(tmp_path: pathlib.Path, db: Session) -> None:
+    """The run log endpoint requires a token for the run's project."""
+
+    _create_run_with_log(tmp_path, db, b"Hello World\n")
+    app.dependency_overrides[get_db] = lambda: db
+
+    response = client.get(
+        app.url_path_for("run_log", run_key="abcd1234"),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 401
+
+    response = client.get(
+        app.url_path_for("run_log", run_key="missing"),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 404
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_log_follows_active_run(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch, db: Session
+) -> None:
+    """The run log endpoint follows the log of a run in progress."""
+
+    # set up an active run which writes more output and finishes a bit later
+    monkeypatch.setenv("RCS_LOG_FOLLOW_INTERVAL", "0.01")
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+    path = tmp_path / "active.log"
+    path.write_bytes(b"Hello ")
+    job = executor.Job(
+        project_id=1,
+        project_name="shiny-project",
+        command="pwd",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+    executor.active_runs["active"] = executor.ActiveRun(
+        key="active", job=job, started_at=datetime.utcnow(), log_path=path
+    )
+
+    def finish_run() -> None:
+        with open(path, "ab") as f:
+            f.write(b"World\n")
+        del executor.active_runs["active"]
+
+    timer = threading.Timer(0.2, finish_run)
+    timer.start()
+    app.dependency_overrides[get_db] = lambda: db
+
+    # follow the log
+    response = client.get(
+        app.url_path_for("run_log", run_key="active"),
+        params={"follow": "true"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    timer.join()
+    assert response.status_code == 200
+    assert response.content == b"Hello World\n"
+
+    # clean up
+    app.dependency_overrides = {}
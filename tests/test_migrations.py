@@ -0,0 +1,47 @@
+"""Tests for upgrading databases."""
+
+import pathlib
+
+from sqlalchemy import inspect, text
+
+from remote_command_server import crud, migrations, models
+from remote_command_server.database import database_connection
+
+# the schema created by the first version of the initdb command
+_INITIAL_SCHEMA = (
+    "CREATE TABLE projects (id INTEGER NOT NULL, command VARCHAR NOT NULL, "
+    "directory VARCHAR NOT NULL, name VARCHAR NOT NULL, PRIMARY KEY (id))",
+    "CREATE UNIQUE INDEX ix_projects_name ON projects (name)",
+    "CREATE INDEX ix_projects_id ON projects (id)",
+    "CREATE TABLE tokens (id INTEGER NOT NULL, hashed_token VARCHAR NOT NULL, "
+    "project_id INTEGER NOT NULL, PRIMARY KEY (id), UNIQUE (hashed_token), "
+    "FOREIGN KEY(project_id) REFERENCES projects (id))",
+    "CREATE INDEX ix_tokens_id ON tokens (id)",
+    "INSERT INTO projects (id, command, directory, name) "
+    "VALUES (1, 'echo', '.', 'shiny-project')",
+)
+
+
+def test_upgrade_adds_missing_tables_and_columns(tmp_path: pathlib.Path) -> None:
+    """An initial database is upgraded without losing data, and only once."""
+
+    connection = database_connection(f"sqlite:///{tmp_path / 'commands.sqlite3'}")
+    with connection.engine.begin() as db_connection:
+        for statement in _INITIAL_SCHEMA:
+            db_connection.execute(text(statement))
+
+    changes = migrations.upgrade(connection.engine)
+
+    assert "Added column projects.priority" in changes
+    assert "Created table runs" in changes
+    assert migrations.upgrade(connection.engine) == []
+    inspector = inspect(connection.engine)
+    assert set(inspector.get_table_names()) == set(models.Project.metadata.tables)
+    db = connection.LocalSession()
+    try:
+        token = crud.create_token(db, "shiny-project")
+        assert crud.verify_token(db, token, "shiny-project")
+        project = crud.get_project(db, "shiny-project")
+        assert project is not None and project.command == "echo"
+    finally:
+        db.close()
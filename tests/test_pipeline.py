@@ -0,0 +1,178 @@
+"""Tests for pipelines of projects."""
+
+import asyncio
+import pathlib
+from datetime import datetime
+from typing import Any, Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+from pytest_mock import MockerFixture
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models, schemas
+from remote_command_server.executor import Job, RunResult
+from remote_command_server.main import app, get_db
+from remote_command_server.pipeline import Pipeline, StepStatus
+
+client = TestClient(app)
+
+
+def _create_projects(db: Session, directory: str = "/wherever") -> Dict[str, int]:
+    # a diamond: build-docs and build-code depend on pull, and restart depends on both
+    ids = {}
+    for name in ("pull", "build-docs", "build-code", "restart"):
+        project = crud.create_project(
+            db,
+            schemas.ProjectCreate(name=name, directory=directory, command=name),
+        )
+        ids[name] = project.id
+    crud.add_dependency(db, "build-docs", "pull")
+    crud.add_dependency(db, "build-code", "pull")
+    crud.add_dependency(db, "restart", "build-docs")
+    crud.add_dependency(db, "restart", "build-code")
+    return ids
+
+
+def _pipeline(db: Session, name: str) -> Pipeline:
+    project = db.query(models.Project).filter(models.Project.name == name).one()
+    return Pipeline.for_project(db, project)
+
+
+def test_pipeline_contains_dependencies_in_order(db: Session) -> None:
+    """A pipeline contains a project and its dependencies, in topological order."""
+
+    ids = _create_projects(db)
+
+    pipeline = _pipeline(db, "restart")
+    assert [pipeline.jobs[p].project_name for p in pipeline.order] == [
+        "pull",
+        "build-docs",
+        "build-code",
+        "restart",
+    ]
+    assert pipeline.dependencies[ids["restart"]] == {
+        ids["build-docs"],
+        ids["build-code"],
+    }
+
+    pipeline = _pipeline(db, "build-code")
+    assert [pipeline.jobs[p].project_name for p in pipeline.order] == [
+        "pull",
+        "build-code",
+    ]
+
+
+def test_add_dependency_rejects_cycles(db: Session) -> None:
+    """Dependencies creating a cycle are rejected."""
+
+    _create_projects(db)
+
+    with pytest.raises(ValueError):
+        crud.add_dependency(db, "pull", "restart")
+    with pytest.raises(ValueError):
+        crud.add_dependency(db, "pull", "pull")
+    with pytest.raises(ValueError):
+        crud.add_dependency(db, "pull", "unknown")
+
+
+def _fake_execute(
+    failing: List[str], started: List[str], concurrency: List[int]
+) -> Any:
+    running: List[str] = []
+
+    async def execute(job: Job) -> RunResult:
+        started.append(job.project_name)
+        running.append(job.project_name)
+        concurrency.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(job.project_name)
+        return RunResult(
+            key=job.project_name,
+            returncode=1 if job.project_name in failing else 0,
+            started_at=datetime.utcnow(),
+            duration=0.05,
+            output_size=0,
+        )
+
+    return execute
+
+
+def test_pipeline_runs_branches_in_parallel(db: Session) -> None:
+    """Independent steps of a pipeline run in parallel."""
+
+    _create_projects(db)
+    started: List[str] = []
+    concurrency: List[int] = []
+
+    steps = asyncio.run(
+        _pipeline(db, "restart").run(_fake_execute([], started, concurrency))
+    )
+
+    assert [step.status for step in steps] == [StepStatus.SUCCEEDED] * 4
+    assert started[0] == "pull"
+    assert started[-1] == "restart"
+    assert max(concurrency) == 2
+
+
+def test_pipeline_skips_steps_after_failure(db: Session) -> None:
+    """Steps depending on a failed step are skipped, but other branches still run."""
+
+    _create_projects(db)
+    started: List[str] = []
+
+    steps = asyncio.run(
+        _pipeline(db, "restart").run(_fake_execute(["build-docs"], started, []))
+    )
+
+    assert {step.project_name: step.status for step in steps} == {
+        "pull": StepStatus.SUCCEEDED,
+        "build-docs": StepStatus.FAILED,
+        "build-code": StepStatus.SUCCEEDED,
+        "restart": StepStatus.SKIPPED,
+    }
+    assert "restart" not in started
+
+
+def test_pipeline_endpoint_runs_pipeline(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """The pipeline endpoint runs a project after its dependencies."""
+
+    def run_command(**kwargs: Any) -> Any:
+        return mocker.Mock(
+            returncode=int(kwargs["command"] == "build-code"), usage=None
+        )
+
+    mocker.patch("remote_command_server.util.run_command", side_effect=run_command)
+    _create_projects(db, directory=str(tmp_path))
+    token = crud.create_token(db, "restart")
+    app.dependency_overrides[get_db] = lambda: db
+
+    response = client.post(
+        app.url_path_for("run_pipeline", project_name="restart"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 500
+    result = response.json()
+    assert not result["success"]
+    assert [(step["project"], step["status"]) for step in result["steps"]] == [
+        ("pull", "succeeded"),
+        ("build-docs", "succeeded"),
+        ("build-code", "failed"),
+        ("restart", "skipped"),
+    ]
+    assert result["steps"][2]["exit_code"] == 1
+    assert result["steps"][2]["run"]
+    assert result["steps"][3]["run"] is None
+
+    # a token for another project in the pipeline does not grant access
+    response = client.post(
+        app.url_path_for("run_pipeline", project_name="restart"),
+        headers={"Authorization": f"Bearer {crud.create_token(db, 'pull')}"},
+    )
+    assert response.status_code == 401
+
+    # clean up
+    app.dependency_overrides = {}
@@ -0,0 +1,184 @@
+"""Tests for the output processors."""
+
+import asyncio
+import pathlib
+import re
+from typing import Any, Dict, Iterable
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from remote_command_server import (
+    crud,
+    executor,
+    processors,
+    responses,
+    schemas,
+)
+from remote_command_server.executor import Job
+from remote_command_server.main import app, get_db
+from remote_command_server.processors import (
+    JSONSummary,
+    JUnitSummary,
+    OutputProcessor,
+    ProcessorSpec,
+    RegexExtractor,
+    TailSummary,
+)
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+def _feed(processor: OutputProcessor, chunks: Iterable[bytes]) -> None:
+    for chunk in chunks:
+        processor.feed("stdout", chunk)
+    processor.close()
+
+
+def test_regex_extractor_matches_lines_split_across_chunks() -> None:
+    """Lines are reassembled from chunks, and the last match is kept."""
+
+    extractor = RegexExtractor("coverage", re.compile(r"TOTAL.* (\d+)%"))
+    _feed(extractor, [b"TOTAL  100  10  90%\nTO", b"TAL  100  5  95", b"%\nDone\n"])
+
+    assert extractor.result() == {"coverage": "95"}
+
+
+def test_regex_extractor_returns_named_groups_or_match() -> None:
+    """Named groups are returned as a dictionary, and without groups the match."""
+
+    named = RegexExtractor("version", re.compile(r"v(?P<major>\d+)\.(?P<minor>\d+)"))
+    whole = RegexExtractor("version", re.compile(r"v\d+\.\d+"))
+    missing = RegexExtractor("version", re.compile(r"nothing"))
+    for extractor in (named, whole, missing):
+        _feed(extractor, [b"Built v2.13"])
+
+    assert named.result() == {"version": {"major": "2", "minor": "13"}}
+    assert whole.result() == {"version": "v2.13"}
+    assert missing.result() == {}
+
+
+def test_junit_summary_adds_up_test_suites() -> None:
+    """The test counts of all testsuite elements are added up."""
+
+    summary = JUnitSummary()
+    _feed(
+        summary,
+        [
+            b'<?xml version="1.0"?>\n<testsuites><testsuite name="a" tests="3" fail',
+            b'ures="1" errors="0" skipped="1">\n<testcase name="x"/>\n</testsuite>\n',
+            b'<testsuite name="b" tests="2" failures="0" errors="1"></testsuite>\n',
+        ],
+    )
+
+    assert summary.result() == {
+        "junit": {"tests": 5, "failures": 1, "errors": 1, "skipped": 1}
+    }
+    assert JUnitSummary().result() == {}
+
+
+def test_json_summary_keeps_last_json_object() -> None:
+    """The last line which is a JSON object is kept."""
+
+    summary = JSONSummary()
+    _feed(summary, [b'{"passed": 1}\n', b"[1, 2]\n{broken}\n", b'  {"passed": 2}'])
+
+    assert summary.result() == {"json": {"passed": 2}}
+
+
+def test_json_summary_result_can_be_encoded() -> None:
+    """Huge integers are kept as floats, and lines with NaN are not matched."""
+
+    summary = JSONSummary()
+    _feed(summary, [b'{"n": 123456789012345678901234567890}\n{"n": NaN}\n'])
+
+    assert summary.result() == {"json": {"n": 1.2345678901234568e29}}
+    assert responses.run_succeeded("abc123", summary.result()).status_code == 200
+
+
+def test_tail_summary_keeps_last_lines() -> None:
+    """The last lines are kept, and overlong lines are truncated."""
+
+    summary = TailSummary(2)
+    long_line = b"x" * (processors.MAX_LINE_LENGTH + 100)
+    _feed(summary, [b"first\nsecond\r\n", long_line, long_line, b"\nlast"])
+
+    assert summary.result() == {
+        "tail": ["x" * processors.MAX_LINE_LENGTH, "last"],
+    }
+
+    # the number of lines is capped as well
+    summary = TailSummary(processors.MAX_TAIL_LINES + 1)
+    _feed(summary, [b"line\n" * (processors.MAX_TAIL_LINES + 1)])
+    assert len(summary.result()["tail"]) == processors.MAX_TAIL_LINES
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        {"type": "regex", "name": "x"},
+        {"type": "regex", "name": "x", "pattern": "("},
+        {"type": "tail"},
+        {"type": "unknown"},
+    ],
+)
+def test_invalid_processor_specs_are_rejected(spec: Dict[str, Any]) -> None:
+    """Invalid processor definitions raise a ValueError."""
+
+    with pytest.raises(ValueError):
+        ProcessorSpec.from_dict(spec)
+
+
+def test_execute_returns_extracted_output(tmp_path: pathlib.Path) -> None:
+    """The fields extracted by the job's processors are part of the run result."""
+
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        # the pause orders the output of the two streams
+        command="echo oops >&2; sleep 0.1; echo 'coverage: 87%'; echo Done",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+        processors=(
+            ProcessorSpec(type="regex", name="coverage", pattern=r"coverage: (\d+)%"),
+            ProcessorSpec(type="tail", lines=1),
+        ),
+    )
+
+    result = asyncio.run(executor.execute(job))
+
+    assert result.output == {"coverage": "87", "tail": ["Done"]}
+
+
+@pytest.mark.parametrize("exit_code,status_code", [(0, 200), (1, 500)])
+def test_run_returns_extracted_output(
+    tmp_path: pathlib.Path, db: Session, exit_code: int, status_code: int
+) -> None:
+    """The run endpoint returns the extracted fields."""
+
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project",
+            directory=str(tmp_path),
+            command=f"echo '{{\"passed\": 12}}'; exit {exit_code}",
+            output_processors=[{"type": "json"}],
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        response = client.post(
+            app.url_path_for("run", project_name="shiny-project"),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    finally:
+        app.dependency_overrides = {}
+
+    assert response.status_code == status_code
+    assert response.json()["output"] == {"json": {"passed": 12}}
@@ -0,0 +1,212 @@
+"""Tests for the fair queueing of runs."""
+
+import asyncio
+import pathlib
+import threading
+from typing import List, Tuple
+
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, executor, schemas
+from remote_command_server.executor import Job
+from remote_command_server.main import app, get_db
+from remote_command_server.queueing import RunQueue
+from remote_command_server.spawn import ExecutionProfile
+
+client = TestClient(app)
+
+
+async def _serve(
+    run_queue: RunQueue, runs: List[Tuple[str, int, int]], delay: float = 0
+) -> List[str]:
+    """
+    Queue runs (given as key, flow and priority) while all slots are taken, and
+    return the order in which they are served.
+    """
+
+    served: List[str] = []
+
+    async def run(key: str, flow: int, priority: int) -> None:
+        async with run_queue.slot(key, flow, priority):
+            served.append(key)
+            await asyncio.sleep(0)
+
+    async with run_queue.slot("blocker", 0):
+        tasks = []
+        for key, flow, priority in runs:
+            tasks.append(asyncio.ensure_future(run(key, flow, priority)))
+            await asyncio.sleep(0)
+        await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    return served
+
+
+def test_unlimited_queue_does_not_wait() -> None:
+    """Runs never wait if the capacity is zero."""
+
+    async def run() -> None:
+        run_queue = RunQueue(capacity=0)
+        async with run_queue.slot("a", 1):
+            async with run_queue.slot("b", 1):
+                assert run_queue.running == 2
+                assert run_queue.queued() == []
+
+    asyncio.run(run())
+
+
+def test_commands_run_on_threads_of_the_queue() -> None:
+    """Functions run on the queue's own threads, with a thread per slot."""
+
+    run_queue = RunQueue(capacity=2)
+    barrier = threading.Barrier(2, timeout=1)
+
+    def command() -> str:
+        # both commands must be running at the same time to pass the barrier
+        barrier.wait()
+        return threading.current_thread().name
+
+    async def run() -> List[str]:
+        return list(await asyncio.gather(*(run_queue.run(command) for _ in range(2))))
+
+    names = asyncio.run(run())
+    run_queue.close()
+
+    assert all(name.startswith("rcs-run") for name in names)
+
+
+def test_busy_project_does_not_monopolize_slots() -> None:
+    """A project with a single queued run is served after one run of a busy project."""
+
+    runs = [(f"a{i}", 1, 0) for i in range(5)] + [("b0", 2, 0)]
+    served = asyncio.run(_serve(RunQueue(capacity=1), runs))
+
+    assert served == ["a0", "b0", "a1", "a2", "a3", "a4"]
+
+
+def test_priority_weights_slots() -> None:
+    """A project with a higher priority gets proportionally more slots."""
+
+    runs = [(f"b{i}", 2, 0) for i in range(6)] + [(f"a{i}", 1, 1) for i in range(6)]
+    served = asyncio.run(_serve(RunQueue(capacity=1), runs))
+
+    assert sum(key.startswith("a") for key in served[:6]) == 4
+    assert served[-1] == "b5"
+
+
+def test_starving_runs_are_served_first() -> None:
+    """A run which has waited for longer than max_wait is served next."""
+
+    async def run() -> List[str]:
+        run_queue = RunQueue(capacity=1, max_wait=0.05)
+        runs = [("low", 2, -5)] + [(f"high{i}", 1, 5) for i in range(5)]
+        return await _serve(run_queue, runs, delay=0.1)
+
+    assert asyncio.run(run())[0] == "low"
+
+
+def test_queue_positions_and_cancellation() -> None:
+    """Waiting runs have queue positions, and cancelled runs leave the queue."""
+
+    async def run() -> None:
+        run_queue = RunQueue(capacity=1)
+        async with run_queue.slot("running", 1):
+            first_slot = run_queue.slot("first", 1)
+            second_slot = run_queue.slot("second", 2)
+            first = asyncio.ensure_future(first_slot.__aenter__())
+            second = asyncio.ensure_future(second_slot.__aenter__())
+            await asyncio.sleep(0)
+            assert run_queue.position("first") == 0
+            assert run_queue.position("second") == 1
+
+            first.cancel()
+            await asyncio.sleep(0)
+            assert run_queue.position("first") is None
+            assert run_queue.position("second") == 0
+        await second
+        assert run_queue.running == 1
+
+    asyncio.run(run())
+
+
+def test_interrupted_queued_run_is_not_started(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch
+) -> None:
+    """A queued run which is interrupted leaves the queue without running."""
+
+    monkeypatch.setattr(executor, "run_queue", RunQueue(capacity=1))
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="touch started",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+    )
+
+    async def run() -> executor.RunResult:
+        async with executor.run_queue.slot("blocker", 2):
+            queued = asyncio.ensure_future(executor.execute(job))
+            await asyncio.sleep(0.01)
+            (key,) = executor.active_runs
+            assert executor.interrupt(key)
+            return await asyncio.wait_for(queued, timeout=1)
+
+    result = asyncio.run(run())
+
+    assert result.interrupted
+    assert not (tmp_path / "started").exists()
+
+
+def test_queue_endpoint_lists_queued_runs(
+    tmp_path: pathlib.Path, db: Session, monkeypatch: MonkeyPatch
+) -> None:
+    """The queue endpoint lists the project's waiting runs with their positions."""
+
+    project = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    project_id = project.id
+    token = crud.create_token(db, "shiny-project")
+
+    run_queue = RunQueue(capacity=1)
+    monkeypatch.setattr(executor, "run_queue", run_queue)
+
+    # the slots are kept, as they would be released when they are garbage collected
+    slots = [run_queue.slot("running", project_id)]
+    for key, flow in (("other", project_id + 1), ("mine", project_id)):
+        slots.append(run_queue.slot(key, flow))
+
+    async def fill_queue() -> None:
+        await slots[0].__aenter__()
+        for slot in slots[1:]:
+            asyncio.ensure_future(slot.__aenter__())
+            await asyncio.sleep(0)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(fill_queue())
+
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        response = client.get(
+            app.url_path_for("queue", project_name="shiny-project"),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    finally:
+        app.dependency_overrides = {}
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["running"] == 1
+    assert body["capacity"] == 1
+    assert [(run["run"], run["position"]) for run in body["queued"]] == [("mine", 1)]
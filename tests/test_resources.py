@@ -0,0 +1,177 @@
+"""Tests for resource limits and accounting."""
+
+import pathlib
+import resource
+import time
+from typing import List, Optional
+
+import pytest
+
+from remote_command_server.resources import (
+    Cgroup,
+    ResourceLimits,
+    ResourceUsage,
+    ulimit_commands,
+)
+from remote_command_server.spawn import ExecutionProfile, compile_spec
+from remote_command_server.util import run_command
+
+
+def _process_state(pid: int) -> Optional[str]:
+    try:
+        stat = pathlib.Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return None
+    return stat.rsplit(")", 1)[1].split()[0]
+
+
+def test_resource_limits_contain_defined_limits_only() -> None:
+    """Only limits which are defined are included in the rlimits."""
+
+    assert ResourceLimits().rlimits() == ()
+    assert ResourceLimits(cpu_time=10, open_files=64).rlimits() == (
+        (resource.RLIMIT_CPU, 10),
+        (resource.RLIMIT_NOFILE, 64),
+    )
+
+
+def test_ulimit_commands_round_up() -> None:
+    """Limits are rounded up to the units of ulimit."""
+
+    assert ulimit_commands(ResourceLimits(memory=100).rlimits()) == ("ulimit -v 1",)
+    assert ulimit_commands(ResourceLimits(memory=2049).rlimits()) == ("ulimit -v 3",)
+
+
+def test_run_command_applies_resource_limits(tmp_path: pathlib.Path) -> None:
+    """
+    The resource limits of a spawn spec are applied to the command.
+
+    NOTE: This test requires a shell with ulimit.
+    """
+
+    spec = compile_spec(
+        ExecutionProfile(
+            directory=str(tmp_path),
+            limits=ResourceLimits(cpu_time=5, memory=1 << 30, open_files=64),
+        )
+    )
+    result = run_command(
+        directory=tmp_path, command="ulimit -n; ulimit -t; ulimit -v", spec=spec
+    )
+
+    assert result.stdout.decode().split() == ["64", "5", str(1 << 20)]
+
+
+def test_run_command_joins_cgroup(tmp_path: pathlib.Path) -> None:
+    """The command's shell writes 0 to the process list of the cgroup."""
+
+    # fake the cgroup's process list
+    (tmp_path / "cgroup.procs").write_text("")
+    result = run_command(directory=tmp_path, command="true", cgroup=Cgroup(tmp_path))
+
+    assert result.returncode == 0
+    assert (tmp_path / "cgroup.procs").read_text() == "0\n"
+
+
+def test_run_command_returns_resource_usage(tmp_path: pathlib.Path) -> None:
+    """run_command returns the resources used by the command."""
+
+    result = run_command(
+        directory=tmp_path, command="i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"
+    )
+
+    assert result.usage is not None
+    assert result.usage.user_cpu + result.usage.system_cpu > 0
+    assert result.usage.max_rss > 0
+
+
+def test_run_command_streams_output(tmp_path: pathlib.Path) -> None:
+    """Output is passed to the callback and need not be captured."""
+
+    chunks = []
+    result = run_command(
+        directory=tmp_path,
+        command="echo out; echo err >&2",
+        on_output=lambda stream, data: chunks.append((stream, data)),
+        capture_output=False,
+    )
+
+    assert result.stdout is None and result.stderr is None
+    assert sorted(chunks) == [("stderr", b"err\n"), ("stdout", b"out\n")]
+
+
+def test_run_command_calls_on_exit_before_reaping(tmp_path: pathlib.Path) -> None:
+    """The process has exited but still holds its pid when on_exit is called."""
+
+    pids: List[int] = []
+    states: List[Optional[str]] = []
+
+    def on_exit() -> None:
+        states.append(_process_state(pids[0]))
+
+    result = run_command(
+        directory=tmp_path, command="exit 3", on_start=pids.append, on_exit=on_exit
+    )
+
+    assert result.returncode == 3
+    assert states == ["Z"]
+
+
+def test_run_command_kills_descendants_on_errors(tmp_path: pathlib.Path) -> None:
+    """If reading the output fails, the command's background processes are killed."""
+
+    pids: List[int] = []
+
+    def on_output(stream: str, data: bytes) -> None:
+        pids.append(int(data))
+        raise RuntimeError("Failed")
+
+    with pytest.raises(RuntimeError):
+        run_command(
+            directory=tmp_path, command="sleep 30 & echo $!; wait", on_output=on_output
+        )
+
+    # the orphaned process is gone, or a zombie which hasn't been reaped yet
+    deadline = time.monotonic() + 5
+    while _process_state(pids[0]) not in (None, "Z"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_run_command_returns_negative_code_for_signals(tmp_path: pathlib.Path) -> None:
+    """A command killed by a signal has the negative signal number as return code."""
+
+    result = run_command(directory=tmp_path, command="kill -9 $$")
+
+    assert result.returncode == -9
+
+
+def test_cgroup_creation_fails_gracefully(tmp_path: pathlib.Path) -> None:
+    """No cgroup is created if the root is not a cgroup."""
+
+    assert Cgroup.create(tmp_path, "rcs-test") is None
+    assert not (tmp_path / "rcs-test").exists()
+
+
+def test_cgroup_usage_is_read_from_accounting_files(tmp_path: pathlib.Path) -> None:
+    """The cgroup's accounting overrides the rusage values."""
+
+    # fake the cgroup's accounting files
+    (tmp_path / "cpu.stat").write_text(
+        "usage_usec 3000000\nuser_usec 2000000\nsystem_usec 1000000\n"
+    )
+    (tmp_path / "io.stat").write_text(
+        "8:0 rbytes=100 wbytes=200 rios=1 wios=2\n8:16 rbytes=10 wbytes=20\n"
+    )
+    (tmp_path / "memory.peak").write_text("4096\n")
+
+    cgroup = Cgroup(tmp_path)
+    usage = cgroup.usage(
+        ResourceUsage(
+            user_cpu=0, system_cpu=0, max_rss=1, io_read_bytes=0, io_write_bytes=0
+        )
+    )
+
+    assert usage == ResourceUsage(
+        user_cpu=2, system_cpu=1, max_rss=4096, io_read_bytes=110, io_write_bytes=220
+    )
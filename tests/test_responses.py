@@ -0,0 +1,74 @@
+"""Tests for the fast JSON responses."""
+
+import asyncio
+import json
+from typing import Any
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from remote_command_server import responses
+from remote_command_server.main import app
+
+client = TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "response,status_code,content",
+    (
+        (responses.run_succeeded("abc123"), 200, {"success": True, "run": "abc123"}),
+        (
+            responses.run_failed("abc123"),
+            500,
+            {
+                "message": "Command returned with a non-zero return code.",
+                "run": "abc123",
+            },
+        ),
+        (responses.run_scheduled(), 202, {"message": "The run has been scheduled."}),
+    ),
+)
+def test_run_responses(
+    response: responses.StaticJSONResponse, status_code: int, content: Any
+) -> None:
+    """The precomputed run responses have the expected content and headers."""
+
+    assert response.status_code == status_code
+    assert json.loads(response.body) == content
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["content-length"] == str(len(response.body))
+
+
+def test_run_responses_encode_huge_integers() -> None:
+    """Output which orjson can't encode doesn't make the response fail."""
+
+    output = {"json": {"n": 123456789012345678901234567890}}
+    response = responses.run_failed("abc123", output)
+
+    assert response.status_code == 500
+    assert json.loads(response.body)["output"] == output
+
+
+@pytest.mark.parametrize("detail", ("Unauthorized", ["some", "list"]))
+def test_http_exception_handler(detail: Any) -> None:
+    """HTTP exceptions are turned into JSON responses with the exception's headers."""
+
+    exception = HTTPException(
+        status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"}
+    )
+    response = asyncio.run(responses.http_exception_handler(None, exception))
+
+    assert response.status_code == 401
+    assert json.loads(response.body) == {"detail": detail}
+    assert response.headers["www-authenticate"] == "Bearer"
+
+
+def test_missing_token_response() -> None:
+    """A request without a token gets the usual response."""
+
+    response = client.post(app.url_path_for("run", project_name="some-project"))
+
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Not authenticated"}
+    assert response.headers["WWW-Authenticate"] == "Bearer"
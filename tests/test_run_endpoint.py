@@ -1,4 +1,5 @@
 import pathlib
+from datetime import datetime, timedelta
 from typing import Any, NamedTuple, cast
 
 from fastapi.testclient import TestClient
@@ -7,14 +8,18 @@ from sqlalchemy.orm import Session
 
 import remote_command_server
 import remote_command_server.util
-from remote_command_server import crud, schemas
-from remote_command_server.main import app, get_db
+from remote_command_server import crud, models, schemas
+from remote_command_server.history import RunRecorder
+from remote_command_server.main import app, get_db, get_run_recorder
 
 
 class MockCompletedProcess(NamedTuple):
     """Mock for the CompletedProcess class."""
 
     returncode: int
+    stdout: bytes = b""
+    stderr: bytes = b""
+    usage: Any = None
 
 
 client = TestClient(app)
@@ -81,9 +86,9 @@ def test_run_executes_command(
     )
 
     assert response.status_code == 200
-    cast(Any, remote_command_server.util.run_command).assert_called_with(
-        directory=tmp_path, command="pwd"
-    )
+    run_command_kwargs = cast(Any, remote_command_server.util.run_command).call_args[1]
+    assert run_command_kwargs["directory"] == tmp_path
+    assert run_command_kwargs["command"] == "pwd"
 
     # clean up
     app.dependency_overrides = {}
@@ -121,9 +126,136 @@ def test_run_returns_500_if_command_fails(
     )
 
     assert response.status_code == 500
-    cast(Any, remote_command_server.util.run_command).assert_called_with(
-        directory=tmp_path, command="pwd"
+    run_command_kwargs = cast(Any, remote_command_server.util.run_command).call_args[1]
+    assert run_command_kwargs["directory"] == tmp_path
+    assert run_command_kwargs["command"] == "pwd"
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_run_records_run(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """The run endpoint records the run in the run history."""
+
+    def run_command(**kwargs: Any) -> MockCompletedProcess:
+        kwargs["on_output"]("stdout", b"out")
+        kwargs["on_output"]("stderr", b"err")
+        return MockCompletedProcess(returncode=3)
+
+    mocker.patch("remote_command_server.util.run_command", side_effect=run_command)
+
+    # set up the database content
+    project_id = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    ).id
+    token = crud.create_token(db, "shiny-project")
+
+    # use the test database and a recorder writing to it
+    def override_get_db() -> Session:
+        return db
+
+    recorder = RunRecorder(lambda: db)
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_run_recorder] = lambda: recorder
+
+    # make the server call
+    client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    # the run is only written when the recorder flushes
+    assert db.query(models.Run).count() == 0
+    assert recorder.flush() == 1
+    run = db.query(models.Run).first()
+    assert run.project_id == project_id
+    assert run.exit_code == 3
+    assert run.output_size == 6
+    assert run.finished_at >= run.started_at
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_runs_returns_runs_since(tmp_path: pathlib.Path, db: Session) -> None:
+    """The runs endpoint returns the runs of a project since a given time."""
+
+    # set up the database content
+    project = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
     )
+    now = datetime.utcnow()
+    crud.create_runs(
+        db,
+        [
+            schemas.RunCreate(
+                key=f"run-{days}",
+                project_id=project.id,
+                started_at=now - timedelta(days=days),
+                finished_at=now - timedelta(days=days),
+                exit_code=0,
+                duration=0,
+                output_size=0,
+            )
+            for days in range(5)
+        ],
+    )
+    token = crud.create_token(db, "shiny-project")
+
+    # use the test database
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+
+    # make the server call
+    since = now - timedelta(days=2, hours=1)
+    response = client.get(
+        app.url_path_for("runs", project_name="shiny-project"),
+        params={"since": since.isoformat()},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 200
+    assert [run["key"] for run in response.json()] == ["run-0", "run-1", "run-2"]
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_runs_requires_a_valid_token(tmp_path: pathlib.Path, db: Session) -> None:
+    """The runs endpoint requires a valid token."""
+
+    # set up the database content
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    crud.create_token(db, "shiny-project")
+
+    # use the test database
+    def override_get_db() -> Session:
+        return db
+
+    app.dependency_overrides[get_db] = override_get_db
+
+    # make the server call with an invalid token
+    response = client.get(
+        app.url_path_for("runs", project_name="shiny-project"),
+        headers={"Authorization": "Bearer fake-token"},
+    )
+    assert response.status_code == 401
 
     # clean up
     app.dependency_overrides = {}
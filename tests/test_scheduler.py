@@ -0,0 +1,130 @@
+"""Tests for scheduled runs."""
+
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+import pytest
+from pytest_mock import MockerFixture
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models, schemas
+from remote_command_server.executor import Job
+from remote_command_server.scheduler import Scheduler
+
+
+async def _no_run(job: Job) -> None:
+    pass
+
+
+def _create_project(
+    db: Session,
+    name: str,
+    schedule: Optional[str],
+    last_scheduled_run: Optional[datetime] = None,
+) -> models.Project:
+    project = crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name=name, directory="/wherever", command="whatever", schedule=schedule
+        ),
+    )
+    project.last_scheduled_run = last_scheduled_run
+    db.commit()
+    return project
+
+
+def test_scheduler_runs_due_jobs_in_order(db: Session) -> None:
+    """The scheduler returns the due jobs and schedules their next runs."""
+
+    _create_project(db, "hourly", "0 * * * *", datetime(2021, 3, 4, 5, 0))
+    _create_project(db, "quarterly", "*/15 * * * *", datetime(2021, 3, 4, 5, 0))
+    _create_project(db, "unscheduled", None)
+    scheduler = Scheduler(lambda: db, _no_run)
+    scheduler.load(datetime(2021, 3, 4, 5, 10))
+
+    assert scheduler.next_run() == datetime(2021, 3, 4, 5, 15)
+    assert scheduler.pop_due(datetime(2021, 3, 4, 5, 10)) == []
+
+    due = scheduler.pop_due(datetime(2021, 3, 4, 5, 15))
+    assert [job.project_name for job in due] == ["quarterly"]
+    assert scheduler.next_run() == datetime(2021, 3, 4, 5, 30)
+
+    due = scheduler.pop_due(datetime(2021, 3, 4, 6, 0))
+    assert sorted(job.project_name for job in due) == ["hourly", "quarterly"]
+    assert scheduler.next_run() == datetime(2021, 3, 4, 6, 15)
+
+
+def test_scheduler_catches_up_missed_runs_once(db: Session) -> None:
+    """Runs missed while the server was down are caught up, but only once."""
+
+    _create_project(db, "hourly", "0 * * * *", datetime(2021, 3, 4, 5, 0))
+    scheduler = Scheduler(lambda: db, _no_run)
+    scheduler.load(datetime(2021, 3, 4, 9, 30))
+
+    due = scheduler.pop_due(datetime(2021, 3, 4, 9, 30))
+    assert [job.project_name for job in due] == ["hourly"]
+    assert scheduler.next_run() == datetime(2021, 3, 4, 10, 0)
+
+    # the run has been recorded, so that it isn't repeated after another restart
+    scheduler = Scheduler(lambda: db, _no_run)
+    scheduler.load(datetime(2021, 3, 4, 9, 31))
+    assert scheduler.pop_due(datetime(2021, 3, 4, 9, 31)) == []
+    project = db.query(models.Project).filter(models.Project.name == "hourly").one()
+    assert project.last_scheduled_run == datetime(2021, 3, 4, 9, 30)
+
+
+def test_scheduler_keeps_jobs_due_if_update_fails(
+    db: Session, mocker: MockerFixture
+) -> None:
+    """Jobs stay due if the time of their run cannot be stored."""
+
+    _create_project(db, "hourly", "0 * * * *", datetime(2021, 3, 4, 5, 0))
+    scheduler = Scheduler(lambda: db, _no_run)
+    scheduler.load(datetime(2021, 3, 4, 5, 30))
+
+    mocker.patch.object(crud, "set_last_scheduled_run", side_effect=OSError)
+    with pytest.raises(OSError):
+        scheduler.pop_due(datetime(2021, 3, 4, 6, 0))
+    assert scheduler.next_run() == datetime(2021, 3, 4, 6, 0)
+
+    mocker.stopall()
+    due = scheduler.pop_due(datetime(2021, 3, 4, 6, 0))
+    assert [job.project_name for job in due] == ["hourly"]
+    assert scheduler.next_run() == datetime(2021, 3, 4, 7, 0)
+
+
+def test_scheduler_starts_new_projects_now(db: Session) -> None:
+    """A project which the scheduler has never run is scheduled from now on."""
+
+    _create_project(db, "daily", "@daily")
+    scheduler = Scheduler(lambda: db, _no_run)
+    scheduler.load(datetime(2021, 3, 4, 9, 30))
+
+    assert scheduler.pop_due(datetime(2021, 3, 4, 9, 30)) == []
+    assert scheduler.next_run() == datetime(2021, 3, 5)
+    project = db.query(models.Project).one()
+    assert project.last_scheduled_run == datetime(2021, 3, 4, 9, 30)
+
+
+def test_scheduler_skips_overlapping_runs(db: Session) -> None:
+    """A scheduled run is skipped while the project's previous run is in progress."""
+
+    project = _create_project(db, "busy", "* * * * *")
+    job = Job.from_project(project)
+    started: List[str] = []
+
+    async def run(job: Job) -> None:
+        started.append(job.project_name)
+        await asyncio.sleep(0.05)
+
+    async def start_runs() -> List[bool]:
+        scheduler = Scheduler(lambda: db, run)
+        results = [scheduler.start(job), scheduler.start(job)]
+        await asyncio.sleep(0.1)
+        results.append(scheduler.start(job))
+        await asyncio.sleep(0.1)
+        return results
+
+    assert asyncio.run(start_runs()) == [True, False, True]
+    assert started == ["busy", "busy"]
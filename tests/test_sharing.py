@@ -0,0 +1,167 @@
+"""Tests for sharing runs between identical jobs."""
+
+import asyncio
+import pathlib
+from datetime import datetime
+from typing import List, Optional
+
+import pytest
+
+from remote_command_server import executor
+from remote_command_server.executor import Job, RunResult, SingleFlight
+from remote_command_server.spawn import ExecutionProfile
+
+
+def _job(command: str = "pwd", share_window: Optional[float] = 0) -> Job:
+    return Job(
+        project_id=1,
+        project_name="some-project",
+        command=command,
+        profile=ExecutionProfile(directory="/tmp"),
+        share_window=share_window,
+    )
+
+
+class FakeExecutor:
+    """Executor returning a new result for every run after a short delay."""
+
+    def __init__(self, delay: float = 0.05, interrupted: bool = False) -> None:
+        self.delay = delay
+        self.interrupted = interrupted
+        self.jobs: List[Job] = []
+
+    async def __call__(self, job: Job) -> RunResult:
+        self.jobs.append(job)
+        key = str(len(self.jobs))
+        await asyncio.sleep(self.delay)
+        return RunResult(
+            key=key,
+            returncode=0,
+            started_at=datetime.utcnow(),
+            duration=self.delay,
+            output_size=0,
+            interrupted=self.interrupted,
+        )
+
+
+def test_identical_jobs_share_run_in_progress() -> None:
+    """Identical jobs started while a run is in progress get its result."""
+
+    async def run() -> None:
+        single_flight = SingleFlight()
+        execute = FakeExecutor()
+        results = await asyncio.gather(
+            *(single_flight.run(_job(), execute) for _ in range(5)),
+            single_flight.run(_job("other command"), execute),
+        )
+
+        assert len(execute.jobs) == 2
+        assert {result.key for result in results[:5]} == {"1"}
+        assert results[5].key == "2"
+        assert single_flight.shared == 4
+        assert single_flight.in_progress() == 0
+
+        # without a share window, the finished run is not reused
+        assert (await single_flight.run(_job(), execute)).key == "3"
+
+    asyncio.run(run())
+
+
+def test_results_are_shared_within_share_window() -> None:
+    """Results are reused until the share window after the run has passed."""
+
+    async def run() -> None:
+        single_flight = SingleFlight()
+        execute = FakeExecutor(delay=0)
+        job = _job(share_window=0.1)
+
+        assert (await single_flight.run(job, execute)).key == "1"
+        assert (await single_flight.run(job, execute)).key == "1"
+        await asyncio.sleep(0.15)
+        assert (await single_flight.run(job, execute)).key == "2"
+
+    asyncio.run(run())
+
+
+def test_interrupted_runs_are_not_reused() -> None:
+    """The results of interrupted runs are not reused after they have finished."""
+
+    async def run() -> None:
+        single_flight = SingleFlight()
+        execute = FakeExecutor(delay=0, interrupted=True)
+        job = _job(share_window=10)
+
+        assert (await single_flight.run(job, execute)).key == "1"
+        assert (await single_flight.run(job, execute)).key == "2"
+
+    asyncio.run(run())
+
+
+def test_errors_are_passed_to_all_callers() -> None:
+    """An error raised by the run is raised for all callers, and is not reused."""
+
+    calls = 0
+
+    async def execute(job: Job) -> RunResult:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        raise ValueError("Broken")
+
+    async def run() -> None:
+        single_flight = SingleFlight()
+        job = _job(share_window=10)
+        results = await asyncio.gather(
+            single_flight.run(job, execute),
+            single_flight.run(job, execute),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+        with pytest.raises(ValueError):
+            await single_flight.run(job, execute)
+
+    asyncio.run(run())
+    assert calls == 2
+
+
+def test_cancelled_caller_does_not_cancel_run() -> None:
+    """The run continues for the other callers if the first caller is cancelled."""
+
+    async def run() -> None:
+        single_flight = SingleFlight()
+        execute = FakeExecutor()
+        first = asyncio.ensure_future(single_flight.run(_job(), execute))
+        second = asyncio.ensure_future(single_flight.run(_job(), execute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+
+        assert (await second).key == "1"
+        assert len(execute.jobs) == 1
+
+    asyncio.run(run())
+
+
+def test_execute_shares_runs(tmp_path: pathlib.Path) -> None:
+    """Jobs with a share window are run only once if they are run concurrently."""
+
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="sleep 0.2",
+        profile=ExecutionProfile(directory=str(tmp_path)),
+        share_window=0,
+    )
+
+    async def run() -> List[RunResult]:
+        return list(
+            await asyncio.gather(
+                executor.execute(job),
+                executor.execute(job),
+                executor.execute(job),
+            )
+        )
+
+    results = asyncio.run(run())
+
+    assert len({result.key for result in results}) == 1
+    assert results[0].returncode == 0
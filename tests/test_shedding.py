@@ -0,0 +1,169 @@
+"""Tests for the load shedding of requests with invalid credentials."""
+
+import pathlib
+import secrets
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models, schemas
+from remote_command_server.main import app, get_auth_gate, get_db
+from remote_command_server.settings import get_settings
+from remote_command_server.shedding import AuthGate, BloomFilter, NegativeCache
+from remote_command_server.throttling import RateLimiter
+
+client = TestClient(app)
+
+
+def test_bloom_filter_contains_added_values() -> None:
+    """A Bloom filter contains all added values and few others."""
+
+    values = [secrets.token_hex() for _ in range(1000)]
+    bloom_filter = BloomFilter.of(values, error_rate=0.01)
+
+    assert all(value in bloom_filter for value in values)
+    false_positives = sum(secrets.token_hex() in bloom_filter for _ in range(10000))
+    assert false_positives < 200
+
+
+def test_negative_cache_expires_and_evicts_entries() -> None:
+    """Entries of the negative cache expire, and the oldest entries are evicted."""
+
+    cache = NegativeCache(max_size=2, ttl=0.1)
+    for token in ("a", "b", "c"):
+        cache.add("project", token)
+
+    assert ("project", "a") not in cache
+    assert ("project", "b") in cache
+    assert ("project", "c") in cache
+
+    time.sleep(0.15)
+    assert ("project", "c") not in cache
+
+
+def _create_project(tmp_path: pathlib.Path, db: Session) -> str:
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    return crud.create_token(db, "shiny-project")
+
+
+def test_gate_rejects_unknown_credentials(tmp_path: pathlib.Path, db: Session) -> None:
+    """The gate rejects unknown projects and tokens once its filters are built."""
+
+    token = _create_project(tmp_path, db)
+    hashed_token = crud.hash_token(token)
+    gate = AuthGate(NegativeCache(max_size=100, ttl=60))
+
+    # without filters, nothing is rejected
+    assert not gate.rejects("unknown-project", hashed_token)
+
+    assert gate.refresh(db)
+    assert not gate.rejects("shiny-project", hashed_token)
+    assert gate.rejects("unknown-project", hashed_token)
+    assert gate.rejects("shiny-project", crud.hash_token("invalid"))
+
+    # recorded failures are rejected
+    gate.record_failure("shiny-project", hashed_token, "127.0.0.1")
+    assert gate.rejects("shiny-project", hashed_token)
+
+    # the filters are only rebuilt if the credentials have changed, in which case
+    # the failures are forgotten
+    assert not gate.refresh(db)
+    new_token = crud.create_token(db, "shiny-project")
+    assert gate.refresh(db)
+    assert not gate.rejects("shiny-project", hashed_token)
+    assert not gate.rejects("shiny-project", crud.hash_token(new_token))
+
+
+def test_gate_notices_reused_ids_and_renames(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """
+    The filters are rebuilt when a token is replaced by one with the same id, or
+    when a project is renamed.
+    """
+
+    _create_project(tmp_path, db)
+    gate = AuthGate(NegativeCache(max_size=100, ttl=60))
+    gate.refresh(db)
+
+    token = db.query(models.Token).one()
+    token_id = token.id
+    db.delete(token)
+    db.commit()
+    new_token = crud.create_token(db, "shiny-project")
+    assert db.query(models.Token.id).scalar() == token_id
+    assert gate.refresh(db)
+    assert not gate.rejects("shiny-project", crud.hash_token(new_token))
+
+    project = crud.get_project(db, "shiny-project")
+    assert project is not None
+    project.name = "renamed-project"
+    db.commit()
+    assert gate.refresh(db)
+    assert not gate.rejects("renamed-project", crud.hash_token(new_token))
+
+
+def test_gate_limits_no_clients_by_default() -> None:
+    """Clients are only limited if a failure rate limit is configured."""
+
+    assert AuthGate.from_settings(get_settings()).failure_limiter is None
+
+
+def test_gate_limits_failures_per_client() -> None:
+    """Clients with too many failed requests must wait."""
+
+    gate = AuthGate(NegativeCache(max_size=100, ttl=60), RateLimiter(1, 3))
+    for i in range(3):
+        assert gate.retry_after("1.2.3.4") == 0
+        gate.record_failure("project", f"token-{i}", "1.2.3.4")
+
+    assert gate.retry_after("1.2.3.4") > 0
+    assert gate.retry_after("5.6.7.8") == 0
+
+
+def test_invalid_credentials_are_rejected_without_database(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Requests with invalid credentials are rejected before a session is created."""
+
+    token = _create_project(tmp_path, db)
+    gate = AuthGate(NegativeCache(max_size=100, ttl=60), RateLimiter(1, 2))
+    gate.refresh(db)
+    sessions = []
+
+    def get_test_db() -> Session:
+        sessions.append(db)
+        return db
+
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_auth_gate] = lambda: gate
+
+    # an unknown project or token is rejected without a session
+    for project_name, request_token in (
+        ("unknown-project", token),
+        ("shiny-project", "invalid-token"),
+    ):
+        response = client.get(
+            app.url_path_for("runs", project_name=project_name),
+            headers={"Authorization": f"Bearer {request_token}"},
+        )
+        assert response.status_code == 401
+    assert not sessions
+
+    # after too many failures, even valid requests are rejected for a while
+    response = client.get(
+        app.url_path_for("runs", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert not sessions
+
+    # clean up
+    app.dependency_overrides = {}
@@ -0,0 +1,141 @@
+"""Tests for snapshots of the projects and tokens."""
+
+import pathlib
+from typing import Tuple
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, models, schemas, snapshots
+from remote_command_server.main import app, get_db, get_snapshot
+
+client = TestClient(app)
+
+
+def _create_projects(
+    db: Session, directory: pathlib.Path, count: int = 3
+) -> Tuple[str, ...]:
+    for i in range(count):
+        crud.create_project(
+            db,
+            schemas.ProjectCreate(
+                name=f"project-{i}",
+                directory=str(directory),
+                command=f"echo {i} | tee -a runs",
+                environment={"NUMBER": str(i)},
+                output_processors=[{"type": "tail", "lines": 1}],
+            ),
+        )
+    return tuple(crud.create_token(db, f"project-{i}") for i in range(count))
+
+
+def test_snapshot_finds_projects_by_token(tmp_path: pathlib.Path, db: Session) -> None:
+    """A project is found if the token belongs to it, and nothing is found else."""
+
+    tokens = _create_projects(db, tmp_path)
+    path = tmp_path / "snapshot"
+    assert snapshots.write(db, path) == (3, 3)
+    snapshot = snapshots.Snapshot(path)
+
+    for i, token in enumerate(tokens):
+        project = snapshot.project(f"project-{i}", crud.hash_token(token))
+        assert project is not None
+        assert project.command == f"echo {i} | tee -a runs"
+        assert project.environment == {"NUMBER": str(i)}
+        assert project.output_processors == [{"type": "tail", "lines": 1}]
+    assert snapshot.project("project-0", crud.hash_token(tokens[1])) is None
+    assert snapshot.project("project-0", crud.hash_token("unknown")) is None
+    assert snapshot.project("project-3", crud.hash_token(tokens[0])) is None
+    assert snapshot.project("project-0", "not a hash") is None
+    assert (snapshot.hits, snapshot.lookups) == (3, 7)
+    snapshot.close()
+
+
+def test_load_rejects_outdated_and_invalid_snapshots(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Snapshots are only loaded if they can be read and match the database."""
+
+    _create_projects(db, tmp_path, count=1)
+    path = tmp_path / "snapshot"
+    snapshots.write(db, path)
+
+    snapshot = snapshots.load(path, crud.get_credentials_version(db))
+    assert snapshot is not None
+    snapshot.close()
+
+    crud.create_token(db, "project-0")
+    assert snapshots.load(path, crud.get_credentials_version(db)) is None
+    path.write_bytes(b"something else")
+    assert snapshots.load(path, crud.get_credentials_version(db)) is None
+    assert (
+        snapshots.load(tmp_path / "missing", crud.get_credentials_version(db)) is None
+    )
+
+
+def test_loader_notices_changes(tmp_path: pathlib.Path, db: Session) -> None:
+    """
+    A loaded snapshot is dropped once a project or token changes, and the snapshot
+    file is loaded again once it has been exported again.
+    """
+
+    _create_projects(db, tmp_path, count=2)
+    path = tmp_path / "snapshot"
+    snapshots.write(db, path)
+    loader = snapshots.SnapshotLoader(path)
+    loader.refresh(db)
+    assert loader.snapshot is not None
+
+    # a changed command
+    project = crud.get_project(db, "project-0")
+    assert project is not None
+    project.command = "echo changed"
+    db.commit()
+    loader.refresh(db)
+    assert loader.snapshot is None
+
+    snapshots.write(db, path)
+    loader.refresh(db)
+    assert loader.snapshot is not None
+
+    # a token which is replaced by a token with the same (reused) id
+    token = db.query(models.Token).order_by(models.Token.id.desc()).first()
+    token_id = token.id
+    db.delete(token)
+    db.commit()
+    crud.create_token(db, "project-1")
+    assert db.query(models.Token.id).order_by(models.Token.id.desc()).first() == (
+        token_id,
+    )
+    loader.refresh(db)
+    assert loader.snapshot is None
+    loader.close()
+
+
+def test_run_uses_snapshot_and_falls_back_to_database(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Projects are taken from the snapshot, and unknown tokens from the database."""
+
+    (token,) = _create_projects(db, tmp_path, count=1)
+    path = tmp_path / "snapshot"
+    snapshots.write(db, path)
+    snapshot = snapshots.Snapshot(path)
+    new_token = crud.create_token(db, "project-0")
+
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_snapshot] = lambda: snapshot
+    try:
+        url = app.url_path_for("run", project_name="project-0")
+        responses = [
+            client.post(url, headers={"Authorization": f"Bearer {t}"})
+            for t in (token, new_token, "wrong")
+        ]
+    finally:
+        app.dependency_overrides = {}
+        snapshot.close()
+
+    assert [response.status_code for response in responses] == [200, 200, 401]
+    assert responses[0].json()["output"] == {"tail": ["0"]}
+    assert (tmp_path / "runs").read_text() == "0\n0\n"
+    assert (snapshot.hits, snapshot.lookups) == (1, 3)
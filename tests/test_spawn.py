@@ -0,0 +1,117 @@
+"""Tests for spawn specs."""
+
+import os
+import pathlib
+
+import pytest
+
+from remote_command_server.spawn import (
+    ExecutionProfile,
+    SpawnSpecCache,
+    compile_spec,
+)
+from remote_command_server.util import run_command
+
+
+def test_compile_spec_directory_must_exist(tmp_path: pathlib.Path) -> None:
+    """The directory of an execution profile must exist."""
+
+    directory = tmp_path / "i-am-missing"
+    with pytest.raises(ValueError) as excinfo:
+        compile_spec(ExecutionProfile(directory=str(directory)))
+
+    assert "exist" in str(excinfo) and "i-am-missing" in str(excinfo)
+
+
+def test_compile_spec_directory_must_be_directory(tmp_path: pathlib.Path) -> None:
+    """The directory of an execution profile must be a directory."""
+
+    file = tmp_path / "command.sh"
+    file.write_text("")
+    with pytest.raises(ValueError) as excinfo:
+        compile_spec(ExecutionProfile(directory=str(file)))
+
+    assert "directory" in str(excinfo) and str(file) in str(excinfo)
+
+
+def test_compile_spec_inherits_environment_by_default(tmp_path: pathlib.Path) -> None:
+    """Without environment and path the server environment is inherited."""
+
+    spec = compile_spec(ExecutionProfile(directory=str(tmp_path)))
+
+    assert spec.env is None
+
+
+def test_compile_spec_uses_explicit_environment(tmp_path: pathlib.Path) -> None:
+    """An explicit environment replaces the server environment."""
+
+    spec = compile_spec(
+        ExecutionProfile(
+            directory=str(tmp_path), environment=(("A", "1"),), path="/bin"
+        )
+    )
+    assert spec.env == {"A": "1", "PATH": "/bin"}
+
+    spec = compile_spec(ExecutionProfile(directory=str(tmp_path), path="/bin"))
+    assert spec.env is not None
+    assert spec.env["PATH"] == "/bin"
+    assert len(spec.env) == len({**os.environ, "PATH": "/bin"})
+
+
+def test_spawn_spec_cache_reuses_specs(tmp_path: pathlib.Path) -> None:
+    """Specs are reused until the execution profile changes."""
+
+    cache = SpawnSpecCache()
+    profile = ExecutionProfile(directory=str(tmp_path))
+    spec = cache.get(1, profile)
+
+    # an unchanged profile gets the cached spec
+    assert cache.get(1, ExecutionProfile(directory=str(tmp_path))) is spec
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a changed profile gets a new spec
+    changed_spec = cache.get(1, ExecutionProfile(directory=str(tmp_path), umask=0o77))
+    assert changed_spec is not spec
+    assert changed_spec.umask == 0o77
+
+    # a spec for a directory which has been replaced is compiled again
+    directory = tmp_path / "workspace"
+    directory.mkdir()
+    workspace_profile = ExecutionProfile(directory=str(directory))
+    workspace_spec = cache.get(2, workspace_profile)
+    directory.rename(tmp_path / "old-workspace")
+    directory.mkdir()
+    assert cache.get(2, workspace_profile) is not workspace_spec
+
+    # an invalidated spec is compiled again
+    cache.invalidate(1)
+    compiled_spec = cache.get(1, ExecutionProfile(directory=str(tmp_path), umask=0o77))
+    assert compiled_spec is not spec and compiled_spec is not changed_spec
+
+
+def test_run_command_uses_spawn_spec(tmp_path: pathlib.Path) -> None:
+    """
+    A command is run with the directory, environment and umask of a spawn spec.
+
+    NOTE: This test requires that the system commands pwd and umask exist.
+    """
+
+    directory = tmp_path / "some-directory"
+    directory.mkdir()
+    spec = compile_spec(
+        ExecutionProfile(
+            directory=str(directory),
+            environment=(("GREETING", "hello"),),
+            path=os.environ["PATH"],
+            umask=0o27,
+        )
+    )
+    result = run_command(
+        directory=directory, command="pwd; echo $GREETING; umask", spec=spec
+    )
+
+    assert result.returncode == 0
+    lines = result.stdout.decode().split()
+    assert lines[0].endswith("some-directory")
+    assert lines[1] == "hello"
+    assert lines[2] == "0027"
@@ -0,0 +1,256 @@
+"""Tests for rate limiting and debouncing."""
+
+import asyncio
+import pathlib
+from typing import List
+
+from fastapi.testclient import TestClient
+from pytest_mock import MockerFixture
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, schemas
+from remote_command_server.executor import Job
+from remote_command_server.main import app, get_db, get_throttle
+from remote_command_server.spawn import ExecutionProfile
+from remote_command_server.throttling import (
+    BucketStore,
+    Debouncer,
+    RateLimiter,
+    Throttle,
+    TokenBucket,
+)
+
+client = TestClient(app)
+
+
+def _job(command: str) -> Job:
+    return Job(
+        project_id=1,
+        project_name="p",
+        command=command,
+        profile=ExecutionProfile(directory="/tmp"),
+    )
+
+
+def test_token_bucket_allows_burst_and_refills() -> None:
+    """A token bucket allows a burst and is refilled at the given rate."""
+
+    bucket = TokenBucket(capacity=2, rate=0.5, tokens=2, updated=100)
+
+    assert bucket.take(100) == 0
+    assert bucket.take(100) == 0
+    assert bucket.take(100) == 2
+    assert bucket.take(101) == 1
+    assert bucket.take(102) == 0
+
+
+def test_rate_limiter_limits_keys_separately() -> None:
+    """A rate limiter has a separate bucket for every key."""
+
+    limiter = RateLimiter(rate=1, burst=1)
+
+    assert limiter.take("a", now=100) == 0
+    assert limiter.take("a", now=100) > 0
+    assert limiter.take("b", now=100) == 0
+
+
+def test_rate_limiter_removes_full_buckets() -> None:
+    """Full buckets are removed if there are too many buckets."""
+
+    # bucket a is full again when bucket c is created, but bucket b isn't
+    limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+    limiter.take("a", now=100)
+    limiter.take("b", now=105)
+    limiter.take("c", now=105.5)
+
+    assert {key for key, _, _ in limiter.states()} == {"b", "c"}
+
+
+def test_throttle_persists_buckets(tmp_path: pathlib.Path) -> None:
+    """The bucket states of a throttle can be saved and loaded."""
+
+    # use up a token
+    store = BucketStore(str(tmp_path / "buckets.sqlite3"))
+    throttle = Throttle(
+        token_limiter=RateLimiter(rate=0.001, burst=1),
+        project_limiter=RateLimiter(rate=0.001, burst=2),
+        debouncer=Debouncer(max_delay=1),
+        store=store,
+    )
+    assert throttle.check("project", "token") == 0
+    throttle.save()
+
+    # the token limiter state is restored after "restarting"
+    restarted_throttle = Throttle(
+        token_limiter=RateLimiter(rate=0.001, burst=1),
+        project_limiter=RateLimiter(rate=0.001, burst=2),
+        debouncer=Debouncer(max_delay=1),
+        store=store,
+    )
+    restarted_throttle.load()
+    assert restarted_throttle.check("project", "token") > 0
+    assert restarted_throttle.check("project", "other-token") == 0
+    assert restarted_throttle.check("project", "yet-another-token") > 0
+
+
+def test_debouncer_runs_burst_once() -> None:
+    """A burst of triggers results in a single run of the last job."""
+
+    commands: List[str] = []
+
+    async def run(job: Job) -> None:
+        commands.append(job.command)
+
+    async def trigger_burst() -> None:
+        debouncer = Debouncer(max_delay=10)
+        assert debouncer.trigger(_job("first"), 0.05, run)
+        await asyncio.sleep(0.02)
+        assert not debouncer.trigger(_job("second"), 0.05, run)
+        await asyncio.sleep(0.02)
+        assert not debouncer.trigger(_job("third"), 0.05, run)
+        assert commands == []
+        await asyncio.sleep(0.1)
+        assert debouncer.pending() == 0
+
+    asyncio.run(trigger_burst())
+    assert commands == ["third"]
+
+
+def test_debouncer_respects_max_delay() -> None:
+    """A job is run after the maximum delay, even if it is triggered repeatedly."""
+
+    commands: List[str] = []
+
+    async def run(job: Job) -> None:
+        commands.append(job.command)
+
+    async def trigger_continuously() -> None:
+        debouncer = Debouncer(max_delay=0.1)
+        for i in range(10):
+            debouncer.trigger(_job(str(i)), 0.05, run)
+            await asyncio.sleep(0.02)
+
+        await asyncio.sleep(0.1)
+
+    # the first burst is cut off by the maximum delay, and the remaining triggers
+    # form a second burst
+    asyncio.run(trigger_continuously())
+    assert len(commands) == 2
+    assert commands[-1] == "9"
+
+
+def test_run_rejects_clients_before_database_access(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Requests exceeding the client limit are rejected without database access."""
+
+    # set up the database content
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+
+    # use up the only request of the test client
+    throttle = Throttle(
+        token_limiter=None,
+        project_limiter=None,
+        debouncer=Debouncer(max_delay=1),
+        client_limiter=RateLimiter(rate=0.001, burst=1),
+    )
+    throttle.check_client("testclient")
+
+    # make sure the database is not accessed
+    def override_get_db() -> Session:
+        raise AssertionError("The database has been accessed.")
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_throttle] = lambda: throttle
+
+    # make the server call
+    response = client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_invalid_tokens_dont_use_up_project_limit(
+    tmp_path: pathlib.Path, db: Session
+) -> None:
+    """Only authenticated requests are charged to the project's rate limit."""
+
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+    throttle = Throttle(
+        token_limiter=None,
+        project_limiter=RateLimiter(rate=0.001, burst=1),
+        debouncer=Debouncer(max_delay=1),
+    )
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_throttle] = lambda: throttle
+
+    url = app.url_path_for("run", project_name="shiny-project")
+    try:
+        statuses = [
+            client.post(url, headers={"Authorization": f"Bearer {t}"}).status_code
+            for t in ("invalid", "invalid", token, token)
+        ]
+    finally:
+        app.dependency_overrides = {}
+
+    assert statuses == [401, 401, 200, 429]
+
+
+def test_run_debounces_project(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """Runs are debounced for projects with a debounce window."""
+
+    mocker.patch("remote_command_server.util.run_command")
+
+    # set up the database content
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project",
+            directory=str(tmp_path),
+            command="pwd",
+            debounce_window=5,
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+
+    # use a throttle whose debouncer is spied on
+    throttle = Throttle(
+        token_limiter=None, project_limiter=None, debouncer=Debouncer(max_delay=1)
+    )
+    trigger = mocker.patch.object(throttle.debouncer, "trigger")
+    app.dependency_overrides[get_db] = lambda: db
+    app.dependency_overrides[get_throttle] = lambda: throttle
+
+    # make the server call
+    response = client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 202
+    trigger.assert_called_once()
+    assert trigger.call_args[0][0].command == "pwd"
+    assert trigger.call_args[0][1] == 5
+
+    # clean up
+    app.dependency_overrides = {}
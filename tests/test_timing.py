@@ -0,0 +1,140 @@
+"""Tests for the timing and profiling of requests."""
+
+import json
+import logging
+import pathlib
+from typing import Any, NamedTuple
+
+from fastapi.testclient import TestClient
+from pytest import MonkeyPatch
+from pytest_mock import MockerFixture
+from sqlalchemy.orm import Session
+
+from remote_command_server import crud, schemas, timing
+from remote_command_server.events import event_log
+from remote_command_server.main import app, get_db
+
+
+class MockCompletedProcess(NamedTuple):
+    """Mock for the CompletedProcess class."""
+
+    returncode: int
+    stdout: bytes = b""
+    stderr: bytes = b""
+    usage: Any = None
+
+
+client = TestClient(app)
+
+
+def test_phase_without_request_does_nothing() -> None:
+    """Phases outside a request are not timed, but the code is executed."""
+
+    executed = False
+    with timing.phase("something"):
+        executed = True
+
+    assert executed
+
+
+def test_phase_timer_adds_up_phases() -> None:
+    """The durations of phases with the same name are added up."""
+
+    timer = timing.PhaseTimer()
+    with timer.phase("a"):
+        pass
+    first_duration = timer.phases["a"]
+    with timer.phase("a"):
+        pass
+    with timer.phase("b"):
+        pass
+
+    assert set(timer.phases.keys()) == {"a", "b"}
+    assert timer.phases["a"] >= first_duration
+    server_timing = timer.server_timing()
+    assert server_timing.startswith("a;dur=")
+    assert ", b;dur=" in server_timing
+    assert ", total;dur=" in server_timing
+
+
+def test_run_returns_server_timing_header(
+    tmp_path: pathlib.Path, mocker: MockerFixture, db: Session
+) -> None:
+    """The run endpoint returns the phase durations in a Server-Timing header."""
+
+    mocker.patch(
+        "remote_command_server.util.run_command",
+        return_value=MockCompletedProcess(returncode=0),
+    )
+
+    # set up the database content
+    crud.create_project(
+        db,
+        schemas.ProjectCreate(
+            name="shiny-project", directory=str(tmp_path), command="pwd"
+        ),
+    )
+    token = crud.create_token(db, "shiny-project")
+    app.dependency_overrides[get_db] = lambda: db
+
+    # make the server call
+    response = client.post(
+        app.url_path_for("run", project_name="shiny-project"),
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 200
+    phases = [
+        metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")
+    ]
+    assert phases == ["verify_token", "project_query", "total"]
+
+    # clean up
+    app.dependency_overrides = {}
+
+
+def test_requests_emit_timing_events(tmp_path: pathlib.Path, db: Session) -> None:
+    """The phase durations of a request are written to the event log."""
+
+    path = tmp_path / "events.log"
+    app.dependency_overrides[get_db] = lambda: db
+    event_log.start(logging.FileHandler(path))
+    try:
+        client.get(app.url_path_for("runs", project_name="shiny-project"))
+    finally:
+        event_log.stop()
+        app.dependency_overrides = {}
+
+    (event,) = [json.loads(line) for line in path.read_text().splitlines()]
+    assert event["event"] == "request_timing"
+    assert event["path"] == "/projects/shiny-project/runs"
+    assert event["status"] == 401
+    assert event["total_ms"] >= 0 and event["phases_ms"] == {}
+
+
+def test_slow_requests_are_profiled_with_admin_token(
+    tmp_path: pathlib.Path, monkeypatch: MonkeyPatch, db: Session
+) -> None:
+    """A profile is saved for slow requests with the admin token in the header."""
+
+    # configure the profiling
+    profile_directory = tmp_path / "profiles"
+    monkeypatch.setenv("RCS_ADMIN_TOKEN_HASH", crud.hash_token("admin-token"))
+    monkeypatch.setenv("RCS_PROFILE_DIRECTORY", str(profile_directory))
+    monkeypatch.setenv("RCS_PROFILE_THRESHOLD", "0")
+    app.dependency_overrides[get_db] = lambda: db
+
+    # make server calls without and with the admin token
+    url = app.url_path_for("runs", project_name="shiny-project")
+    client.get(url, headers={timing.PROFILE_HEADER: "wrong-token"})
+    assert not profile_directory.exists()
+    client.get(url, headers={timing.PROFILE_HEADER: "admin-token"})
+
+    # a request is not profiled while another request is
+    with timing._profiler_lock:
+        client.get(url, headers={timing.PROFILE_HEADER: "admin-token"})
+
+    assert len(list(profile_directory.glob("*-projects_shiny-project_runs.prof"))) == 1
+
+    # clean up
+    app.dependency_overrides = {}
@@ -0,0 +1,244 @@
+"""Tests for the workspace pools."""
+
+import asyncio
+import dataclasses
+import os
+import pathlib
+import shutil
+import subprocess  # nosec
+from typing import List
+
+import pytest
+
+from remote_command_server import executor, workspaces
+from remote_command_server.executor import Job
+from remote_command_server.queueing import RunQueue
+from remote_command_server.spawn import ExecutionProfile
+from remote_command_server.workspaces import WorkspacePool
+
+
+def _create_tree(directory: pathlib.Path) -> None:
+    (directory / "src").mkdir()
+    (directory / "src" / "main.c").write_text("int main() { return 0; }\n")
+    (directory / "Makefile").write_text("all:\n")
+    (directory / "link").symlink_to("Makefile")
+
+
+def test_synchronize_copies_only_changed_files(tmp_path: pathlib.Path) -> None:
+    """Changed files are copied again, and files not in the source are removed."""
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    _create_tree(source)
+    workspaces.synchronize(source, target, link=False)
+
+    assert (target / "src" / "main.c").read_text() == "int main() { return 0; }\n"
+    assert os.readlink(target / "link") == "Makefile"
+    assert not os.path.samefile(source / "Makefile", target / "Makefile")
+
+    unchanged_inode = (target / "src" / "main.c").stat().st_ino
+    (target / "Makefile").write_text("changed by a run\n")
+    (target / "build").mkdir()
+    (target / "build" / "main.o").write_text("object")
+    (source / "README").write_text("new")
+
+    workspaces.synchronize(source, target, link=False)
+
+    assert (target / "Makefile").read_text() == "all:\n"
+    assert (target / "README").read_text() == "new"
+    assert not (target / "build").exists()
+    assert (target / "src" / "main.c").stat().st_ino == unchanged_inode
+
+
+def test_synchronize_links_files(tmp_path: pathlib.Path) -> None:
+    """With hard links, replaced files are linked again without touching the source."""
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    _create_tree(source)
+    workspaces.synchronize(source, target, link=True)
+
+    assert os.path.samefile(source / "Makefile", target / "Makefile")
+
+    (target / "Makefile").unlink()
+    (target / "Makefile").write_text("replaced by a run\n")
+    workspaces.synchronize(source, target, link=True)
+
+    assert (source / "Makefile").read_text() == "all:\n"
+    assert os.path.samefile(source / "Makefile", target / "Makefile")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_git_workspaces_are_reset_to_current_commit(tmp_path: pathlib.Path) -> None:
+    """Git worktrees are checked out at the current commit and cleaned."""
+
+    repository = tmp_path / "repository"
+    repository.mkdir()
+    (repository / ".gitignore").write_text("build/\n")
+    (repository / "file").write_text("first")
+
+    def git(*arguments: str) -> None:
+        subprocess.run(  # nosec
+            ["git", "-C", str(repository), *arguments],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            env={
+                **os.environ,
+                "GIT_AUTHOR_NAME": "test",
+                "GIT_AUTHOR_EMAIL": "test@example.com",
+                "GIT_COMMITTER_NAME": "test",
+                "GIT_COMMITTER_EMAIL": "test@example.com",
+            },
+        )
+
+    git("init", "--quiet")
+    git("add", "--all")
+    git("commit", "--quiet", "--message", "first")
+
+    pool = workspaces.WorkspacePools().get(1, str(repository), 1)
+    assert pool.method == workspaces.GIT
+    workspace = pool.root / "0"
+    pool.prepare(workspace)
+    assert (workspace / "file").read_text() == "first"
+
+    (workspace / "file").write_text("changed by a run")
+    (workspace / "untracked").write_text("")
+    (workspace / "build").mkdir()
+    (workspace / "build" / "output").write_text("")
+    (repository / "file").write_text("second")
+    git("commit", "--quiet", "--all", "--message", "second")
+
+    pool.prepare(workspace)
+
+    assert (workspace / "file").read_text() == "second"
+    assert not (workspace / "untracked").exists()
+    assert (workspace / "build" / "output").exists()
+
+
+def test_pool_leases_each_workspace_once(tmp_path: pathlib.Path) -> None:
+    """A workspace is leased to one run at a time, and reused afterwards."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    pool = WorkspacePool(source, tmp_path / "workspaces", 2, workspaces.COPY)
+    leased: List[pathlib.Path] = []
+    concurrent = 0
+    max_concurrent = 0
+
+    async def run() -> None:
+        nonlocal concurrent, max_concurrent
+        async with pool.lease() as workspace:
+            assert workspace not in leased
+            leased.append(workspace)
+            concurrent += 1
+            max_concurrent = max(max_concurrent, concurrent)
+            await asyncio.sleep(0.01)
+            concurrent -= 1
+            leased.remove(workspace)
+
+    async def run_all() -> None:
+        await asyncio.gather(*(run() for _ in range(5)))
+
+    asyncio.run(run_all())
+
+    assert max_concurrent == 2
+    assert sorted(path.name for path in pool.root.iterdir()) == ["0", "1"]
+
+
+def test_pools_are_replaced_when_projects_change(tmp_path: pathlib.Path) -> None:
+    """A project's pool is reused until its definition changes."""
+
+    pools = workspaces.WorkspacePools()
+    pool = pools.get(1, str(tmp_path / "app"), 2)
+
+    assert pool.root == tmp_path / ".app.workspaces"
+    assert pool.method == workspaces.COPY
+    assert pools.get(1, str(tmp_path / "app"), 2) is pool
+    assert pools.get(1, str(tmp_path / "app"), 3) is not pool
+    assert pools.get(1, str(tmp_path / "app"), 3, root="/srv").root == pathlib.Path(
+        "/srv/1"
+    )
+
+
+def test_replaced_pool_and_successor_dont_share_workspaces(
+    tmp_path: pathlib.Path,
+) -> None:
+    """A workspace leased by a replaced pool is only leased again once returned."""
+
+    (tmp_path / "app").mkdir()
+    pools = workspaces.WorkspacePools()
+    pool = pools.get(1, str(tmp_path / "app"), 1)
+    successor = pools.get(1, str(tmp_path / "app"), 2)
+    leased: List[pathlib.Path] = []
+
+    async def lease() -> None:
+        async with successor.lease() as workspace:
+            leased.append(workspace)
+
+    async def run() -> None:
+        async with pool.lease() as workspace:
+            task = asyncio.ensure_future(lease())
+            await asyncio.sleep(0.05)
+            assert leased == []
+        await task
+        assert leased == [workspace]
+
+    asyncio.run(run())
+
+
+def test_execute_runs_command_in_workspace(tmp_path: pathlib.Path) -> None:
+    """A job with workspaces runs its command in a workspace, not in its directory."""
+
+    directory = tmp_path / "app"
+    directory.mkdir()
+    (directory / "input").write_text("data")
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="cat input > output && pwd",
+        profile=ExecutionProfile(directory=str(directory)),
+        workspaces=1,
+        workspace_method=workspaces.COPY,
+    )
+    workspace = tmp_path / ".app.workspaces" / "0"
+
+    result = asyncio.run(executor.execute(job))
+
+    assert result.returncode == 0
+    assert (workspace / "output").read_text() == "data"
+    assert not (directory / "output").exists()
+
+    # the output of the previous run is removed before the next run
+    asyncio.run(executor.execute(dataclasses.replace(job, command="ls")))
+    assert not (workspace / "output").exists()
+
+
+def test_queued_runs_dont_lease_workspaces(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A run only leases (and prepares) a workspace once it has a queue slot."""
+
+    monkeypatch.setattr(executor, "run_queue", RunQueue(capacity=1))
+    directory = tmp_path / "app"
+    directory.mkdir()
+    job = Job(
+        project_id=1,
+        project_name="some-project",
+        command="true",
+        profile=ExecutionProfile(directory=str(directory)),
+        workspaces=1,
+        workspace_method=workspaces.COPY,
+    )
+    workspace = tmp_path / ".app.workspaces" / "0"
+
+    async def run() -> executor.RunResult:
+        async with executor.run_queue.slot("blocker", 2):
+            queued = asyncio.ensure_future(executor.execute(job))
+            await asyncio.sleep(0.05)
+            assert not workspace.exists()
+        return await queued
+
+    assert asyncio.run(run()).returncode == 0
+    assert workspace.exists()